@@ -0,0 +1,209 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015-2016 European Synchrotron Radiation Facility
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""LASDiA benchmark script file.
+This script compares the timing and the accuracy of the fast engines with the
+reference implementations on synthetic data.
+
+For the variables name I used this convention:
+if the variable symbolizes a mathematical function, its argument is preceded by
+an underscore: f(x) -> f_x
+otherwise it is symbolized with just its name.
+"""
+
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+
+import timeit
+
+import numpy as np
+
+from modules import Geometry
+from modules import MainFunctions
+from modules import UtilityAnalysis
+
+
+# maximum relative errors of the fft engines stated in MainFunctions
+FrTolerance = 1e-13
+SQCorrTolerance = 2e-6
+
+
+def time_function(function, repeat=5):
+    """Function to measure the best execution time of a function.
+
+    Parameters
+    ----------
+    function : function
+               function without arguments to time
+    repeat   : int
+               number of repetitions
+
+    Returns
+    -------
+    bestTime : float
+               best execution time (s)
+    """
+
+    bestTime = min(timeit.repeat(function, number=1, repeat=repeat))
+
+    return bestTime
+
+
+def synthetic_QiQ(Q):
+    """Function to generate a synthetic Qi(Q) similar to a liquid one.
+
+    Parameters
+    ----------
+    Q    : numpy array
+           momentum transfer (nm^-1)
+
+    Returns
+    -------
+    Qi_Q : numpy array
+           synthetic Qi(Q)
+    """
+
+    Qi_Q = (Q*np.sin(0.37*Q)*np.exp(-(Q-50)**2/2000) \
+        + 3*np.sin(2.5*Q)) * np.exp(-0.0005*Q**2)
+
+    return Qi_Q
+
+
+def bench_SQCorr(numPointsList=(500, 1000, 2000, 4000)):
+    """Function to compare the dense and the fft engines of calc_SQCorr.
+    The error is checked against SQCorrTolerance.
+
+    Parameters
+    ----------
+    numPointsList : tuple
+                    numbers of points of the Q grid
+    """
+
+    print("calc_SQCorr: dense vs fft engine")
+    print("numPoints   dense (s)   fft (s)   speed-up   max rel error   check")
+    for numPoints in numPointsList:
+        Q = np.linspace(3.0, 109.0, numPoints)
+        Qi_Q = synthetic_QiQ(Q)
+        r, F_r = MainFunctions.calc_Fr(Q[Q<=98.0], Qi_Q[Q<=98.0], "fft")
+
+        S_Q = MainFunctions.calc_SQCorr(F_r, r, Q, 1.0)
+        Sfft_Q = MainFunctions.calc_SQCorr(F_r, r, Q, 1.0, "fft")
+        error = np.amax(np.abs(S_Q[1:]-Sfft_Q[1:])*Q[1:]) / np.amax(np.abs((S_Q[1:]-1)*Q[1:]))
+
+        denseTime = time_function(lambda: MainFunctions.calc_SQCorr(F_r, r, Q, 1.0))
+        fftTime = time_function(lambda: MainFunctions.calc_SQCorr(F_r, r, Q, 1.0, "fft"))
+
+        print("%9d   %9.5f   %7.5f   %8.1f   %13.2e   %5s" % (numPoints, denseTime,
+            fftTime, denseTime/fftTime, error,
+            "ok" if error < SQCorrTolerance else "FAIL"))
+
+
+def bench_Fr(numPointsList=(500, 1000, 2000, 4000)):
+    """Function to compare the simps and the fft engines of calc_Fr.
+    The error is checked against FrTolerance.
+
+    Parameters
+    ----------
+    numPointsList : tuple
+                    numbers of points of the Q grid
+    """
+
+    print("calc_Fr: simps vs fft engine")
+    print("numPoints   simps (s)   fft (s)   speed-up   max rel error   check")
+    for numPoints in numPointsList:
+        Q = np.linspace(3.0, 98.0, numPoints)
+        Qi_Q = synthetic_QiQ(Q)
+
+        _, F_r = MainFunctions.calc_Fr(Q, Qi_Q)
+        _, Ffft_r = MainFunctions.calc_Fr(Q, Qi_Q, "fft")
+        error = np.amax(np.abs(F_r-Ffft_r)) / np.amax(np.abs(F_r))
+
+        simpsTime = time_function(lambda: MainFunctions.calc_Fr(Q, Qi_Q))
+        fftTime = time_function(lambda: MainFunctions.calc_Fr(Q, Qi_Q, "fft"))
+
+        print("%9d   %9.5f   %7.5f   %8.1f   %13.2e   %5s" % (numPoints, simpsTime,
+            fftTime, simpsTime/fftTime, error,
+            "ok" if error < FrTolerance else "FAIL"))
+
+
+def calc_phi_matrixLoop(two_theta, ws1, ws2, r1, r2, d, num_point=1000, thickness=0.17):
+    """Function to calculate the phi matrix point by point, as
+    Geometry.calc_phi_matrix did before its vectorization.
+
+    Parameters
+    ----------
+    the same of Geometry.calc_phi_matrix
+
+    Returns
+    -------
+    phi_matrix : 2D numpy array
+                 dispersion angle matrix (rad)
+    """
+
+    thickness_sampling = np.linspace(0, thickness, num=num_point)
+    phi_matrix = np.zeros((thickness_sampling.size, two_theta.size))
+
+    for i in range(thickness_sampling.size):
+        for j in range(two_theta.size):
+            phi_matrix[i][j] = Geometry.calc_phi_angle(ws1, ws2, r1, r2, d,
+                two_theta[j], thickness_sampling[i])
+
+    return phi_matrix
+
+
+def bench_phi_matrix(numPointsList=(100, 500, 2000), num_point=1000):
+    """Function to compare the loop and the vectorized phi matrix calculation.
+
+    Parameters
+    ----------
+    numPointsList : tuple
+                    numbers of points of the Q grid
+    num_point     : int
+                    number of points of the thickness sampling
+    """
+
+    print("calc_phi_matrix: loop vs vectorized")
+    print("numPoints   loop (s)   vectorized (s)   speed-up   max abs diff")
+    for numPoints in numPointsList:
+        Q = np.linspace(3.0, 109.0, numPoints)
+        two_theta = UtilityAnalysis.Qto2theta(Q)
+
+        phiLoop = calc_phi_matrixLoop(two_theta, 0.005, 0.02, 5, 20, 1, num_point)
+        phi = Geometry.calc_phi_matrix(two_theta, 0.005, 0.02, 5, 20, 1, num_point)
+        diff = np.amax(np.abs(phi-phiLoop))
+
+        loopTime = time_function(lambda: calc_phi_matrixLoop(two_theta, 0.005,
+            0.02, 5, 20, 1, num_point), 1)
+        vectorTime = time_function(lambda: Geometry.calc_phi_matrix(two_theta,
+            0.005, 0.02, 5, 20, 1, num_point))
+
+        print("%9d   %8.3f   %14.5f   %8.1f   %12.2e" % (numPoints, loopTime,
+            vectorTime, loopTime/vectorTime, diff))
+
+
+if __name__ == "__main__":
+
+    bench_Fr()
+    print()
+    bench_SQCorr()
+    print()
+    bench_phi_matrix()
@@ -0,0 +1,73 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015-2016 European Synchrotron Radiation Facility
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""LASDiA phi matrix archive script.
+This script calculates the phi matrices of all the Soller slits models of
+mccModelsPath for all the wavelengths of phiArchiveWavelengths, on the Q grid
+and thickness sampling of the input file, and stores them in the archive
+phiArchivePath (Geometry.calc_phi_archive), which LASDiAScript.py reads through
+Geometry.check_phi_matrix.
+The matrices are calculated by numWorkers processes, in this process if
+numWorkers is 0.
+"""
+
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+
+import time
+
+import numpy as np
+
+from modules import Geometry
+from modules import Utility
+
+
+if __name__ == "__main__":
+    
+    inputVariables = Utility.read_inputFile("./inputFile.txt")
+    
+    models = Utility.read_MCC_models(inputVariables.get("mccModelsPath",
+        "./SollerSlits.txt"))
+    wavelengths = [float(wavelength) for wavelength in
+        inputVariables.get("phiArchiveWavelengths", "0.03738").split(",")]
+    archivePath = inputVariables.get("phiArchivePath", "./phiArchive")
+    numWorkers = inputVariables.get("numWorkers", 0)
+    
+    Q = np.linspace(inputVariables["minQ"], inputVariables["maxQ"],
+        int(inputVariables["numPoints"]), endpoint=True)
+    
+    if "phiMatrixDenseThickness" in inputVariables:
+        thickness_sampling = Geometry.calc_thickness_sampling(
+            inputVariables["phiMatrixDenseThickness"],
+            inputVariables.get("phiMatrixThickness", 0.17))
+    else:
+        thickness_sampling = None
+    
+    print("Start phi matrix archive calculation:", len(models), "models,",
+        len(wavelengths), "wavelengths")
+    startTime = time.time()
+    entries = Geometry.calc_phi_archive(archivePath, models, wavelengths, Q,
+        thickness_sampling, numWorkers)
+    print("End phi matrix archive calculation", time.time()-startTime, "s")
+    
+    for index, entry in enumerate(entries):
+        print(index, entry["model"], entry["wavelength"])
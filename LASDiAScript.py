@@ -39,6 +39,8 @@ from __future__ import (absolute_import, division, print_function, unicode_liter
 import matplotlib.pyplot as plt
 import numpy as np
 
+from modules import Cache
+from modules import Context
 # from modules import Formalism
 from modules import Geometry
 from modules import IgorFunctions
@@ -96,22 +98,22 @@ if __name__ == "__main__":
     # plt.plot(Qbkg, Ibkg_Q)
     # plt.show
 
-    fe_Q, Ztot = MainFunctions.calc_eeff(elementList, Q, elementParameters)
-    Iincoh_Q = MainFunctions.calc_Iincoh(elementList, Q, elementParameters)
-    J_Q = MainFunctions.calc_JQ(Iincoh_Q, Ztot, fe_Q)
-    Sinf = MainFunctions.calc_Sinf(elementList, fe_Q, Q, Ztot, elementParameters)
-    dampingFunction = UtilityAnalysis.calc_dampingFunction(Q, inputVariables["dampingFactor"],
-        inputVariables["QmaxIntegrate"], inputVariables["typeFunction"])
+    context = Context.make_sampleContext(inputVariables, Q, elementList, elementParameters)
+    fe_Q, Ztot = context.fe_Q, context.Ztot
+    Iincoh_Q = context.Iincoh_Q
+    J_Q = context.J_Q
+    Sinf = context.Sinf
+    dampingFunction = context.dampingFunction
+    FrEngine = inputVariables.get("FrEngine", "simps")
         
     #-------------------Intra-molecular components-----------------------------
 
-    iintra_Q = Optimization.calc_iintra(Q, fe_Q, Ztot, inputVariables["QmaxIntegrate"],
-        inputVariables["maxQ"], elementList, elementPosition["element"],
-        elementPosition["x"], elementPosition["y"], elementPosition["z"], elementParameters)
-    iintradamp_Q = UtilityAnalysis.calc_iintradamp(iintra_Q, dampingFunction)
-    Qiintradamp_Q = Q*iintradamp_Q
-    rintra, Fintra_r = MainFunctions.calc_Fr(Q[Q<=inputVariables["QmaxIntegrate"]], 
-        Qiintradamp_Q[Q<=inputVariables["QmaxIntegrate"]])
+    iintra_Q, iintradamp_Q, rintra, Fintra_r = Optimization.check_intraComponent(Q, fe_Q,
+        Ztot, inputVariables["QmaxIntegrate"], inputVariables["maxQ"], elementList,
+        elementPosition["element"], elementPosition["x"], elementPosition["y"],
+        elementPosition["z"], elementParameters, inputVariables["dampingFactor"],
+        inputVariables["typeFunction"], inputVariables.get("iintraBinWidth"), FrEngine,
+        inputVariables.get("FintraEngine", "numerical"), inputVariables.get("intraCacheDir"))
     
     # ---------------------Geometrical correction------------------------------
 
@@ -120,10 +122,19 @@ if __name__ == "__main__":
 
     if inputVariables["mccFlag"].lower() == "y":
         print("Start matrix calculation or reading")
+        if "phiMatrixDenseThickness" in inputVariables:
+            thickness_sampling = Geometry.calc_thickness_sampling(
+                inputVariables["phiMatrixDenseThickness"],
+                inputVariables.get("phiMatrixThickness", 0.17))
+        else:
+            thickness_sampling = None
         thickness_sampling, phi_matrix = Geometry.check_phi_matrix(Q, inputVariables["ws1"],
             inputVariables["ws2"], inputVariables["r1"], 
             inputVariables["r2"], inputVariables["d"], inputVariables["phiMatrixCalcFlag"],
-            inputVariables["phiMatrixPath"])
+            inputVariables["phiMatrixPath"], inputVariables.get("phiMatrixCacheDir"),
+            thickness_sampling=thickness_sampling,
+            archivePath=inputVariables.get("phiArchivePath"),
+            wavelength=inputVariables.get("wavelength", 0.03738))
         print("End matrix calculation or reading")
     else:
         phi_matrix = 0.0
@@ -140,89 +151,155 @@ if __name__ == "__main__":
     
     # ------------------------Starting minimization----------------------------
 
+    numWorkers = int(inputVariables.get("numWorkers", 0))
+    if numWorkers > 0:
+        chi2Pool = Minimization.make_chi2Pool(numWorkers, Q, I_Q, Ibkg_Q, J_Q,
+            Iincoh_Q, fe_Q, inputVariables["minQ"], inputVariables["QmaxIntegrate"],
+            inputVariables["maxQ"], Ztot, Sinf, inputVariables["smoothingFactor"],
+            inputVariables["rmin"], dampingFunction, Fintra_r, inputVariables["iterations"],
+            inputVariables["mccFlag"], thickness_sampling, phi_matrix, FrEngine, context)
+    else:
+        chi2Pool = None
+
+    chi2CacheSize = int(inputVariables.get("chi2CacheSize", 10000))
+    if chi2CacheSize > 0:
+        chi2Cache = Cache.LRUCache(chi2CacheSize)
+    else:
+        chi2Cache = None
+
+    mccCache = Cache.LRUCache(100)
+
+    if inputVariables.get("plotChi2", "n").lower() == "y":
+        chi2Callback = Minimization.plot_chi2Scan
+    else:
+        chi2Callback = Minimization.print_chi2Scan
+
     scaleFactor = inputVariables["scaleFactor"]
     density0 = inputVariables["density"]
     
-    # ----------------------First scale minimization---------------------------
-    
-    scaleStep = 0.05
-
-    print("Start first scale minimization")
-    scaleFactor = Minimization.OptimizeScale(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q,
-        fe_Q, inputVariables["minQ"], inputVariables["QmaxIntegrate"], inputVariables["maxQ"],
-        Ztot, density0, scaleFactor, Sinf, inputVariables["smoothingFactor"],
-        inputVariables["rmin"], dampingFunction, Fintra_r, inputVariables["iterations"],
-        scaleStep, inputVariables["sth"], inputVariables["s0th"], inputVariables["mccFlag"],
-        thickness_sampling, phi_matrix)
-    print("End first scale minimization")
-    
-    # ----------------------First density minimization-------------------------
-    
-    densityStep = density0/50
-    densityStepEnd = density0/250
-    
-    print("Start first density minimization")
-    density = Minimization.OptimizeDensity(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q,
-        fe_Q, inputVariables["minQ"], inputVariables["QmaxIntegrate"], inputVariables["maxQ"],
-        Ztot, density0, scaleFactor, Sinf, inputVariables["smoothingFactor"],
-        inputVariables["rmin"], dampingFunction, Fintra_r, inputVariables["iterations"],
-        densityStep, inputVariables["sth"], inputVariables["s0th"], inputVariables["mccFlag"],
-        thickness_sampling, phi_matrix)
-    print("End first density minimization")
-
-    # --------------------Free parameters minimization-------------------------
-
-    # print("density0, density", density0, density)
-    numLoopIteration = 0
+    minimizationMode = inputVariables.get("minimizationMode", "grid").lower()
+    searchMode = inputVariables.get("searchMode", "grid")
+
+    if minimizationMode == "simplex":
+        # the simplex evaluates one point at a time, chi2Pool is not used
+        print("Start scale and density minimization")
+        scaleFactor, density, chi2, numEval = Minimization.OptimizeScaleDensity(Q,
+            I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, inputVariables["minQ"],
+            inputVariables["QmaxIntegrate"], inputVariables["maxQ"], Ztot, density0,
+            scaleFactor, Sinf, inputVariables["smoothingFactor"], inputVariables["rmin"],
+            dampingFunction, Fintra_r, inputVariables["iterations"], inputVariables["sth"],
+            inputVariables["s0th"], inputVariables["mccFlag"], thickness_sampling,
+            phi_matrix, FrEngine, cache=chi2Cache, mccCache=mccCache,
+            context=context)
+        print("End scale and density minimization")
+    else:
+        # ----------------------First scale minimization-----------------------
     
-    while 1:
-        if np.abs(density-density0) > density/25:
-            print("First")
-            scaleStep = 0.006
-            densityStep = density/10
-            WSamplestep=0.0008
-            WRefstep=0.0008
-        elif np.abs(density-density0) > density/75:
-            print("Second")
-            scaleStep = 0.0006
-            densityStep = density/100
-            WSamplestep=0.0002
-            WRefstep=0.0002
-        else:
-            print("Third")
-            scaleStep = 0.00006
-            densityStep = density/1000
-            WSamplestep=0.0001
-            WRefstep=0.0001
-        
-        print("Start scale minimization")
+        scaleStep = 0.05
+
+        print("Start first scale minimization")
         scaleFactor = Minimization.OptimizeScale(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q,
             fe_Q, inputVariables["minQ"], inputVariables["QmaxIntegrate"], inputVariables["maxQ"],
-            Ztot, density, scaleFactor, Sinf, inputVariables["smoothingFactor"],
+            Ztot, density0, scaleFactor, Sinf, inputVariables["smoothingFactor"],
             inputVariables["rmin"], dampingFunction, Fintra_r, inputVariables["iterations"],
             scaleStep, inputVariables["sth"], inputVariables["s0th"], inputVariables["mccFlag"],
-            thickness_sampling, phi_matrix)
-        print("End scale minimization")
-
-        density0=density
-
-        print("Start density minimization")
+            thickness_sampling, phi_matrix, FrEngine, chi2Pool, chi2Callback,
+            searchMode, cache=chi2Cache, mccCache=mccCache, context=context)
+        print("End first scale minimization")
+    
+        # ----------------------First density minimization---------------------
+    
+        densityStep = density0/50
+        densityStepEnd = density0/250
+    
+        print("Start first density minimization")
         density = Minimization.OptimizeDensity(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q,
             fe_Q, inputVariables["minQ"], inputVariables["QmaxIntegrate"], inputVariables["maxQ"],
             Ztot, density0, scaleFactor, Sinf, inputVariables["smoothingFactor"],
             inputVariables["rmin"], dampingFunction, Fintra_r, inputVariables["iterations"],
             densityStep, inputVariables["sth"], inputVariables["s0th"], inputVariables["mccFlag"],
-            thickness_sampling, phi_matrix)
-        print("End density minimization")
+            thickness_sampling, phi_matrix, FrEngine, chi2Pool, chi2Callback,
+            searchMode, cache=chi2Cache, mccCache=mccCache, context=context)
+        print("End first density minimization")
+
+        # --------------------Free parameters minimization---------------------
+
+        # print("density0, density", density0, density)
+        numLoopIteration = 0
+    
+        while 1:
+            if np.abs(density-density0) > density/25:
+                print("First")
+                scaleStep = 0.006
+                densityStep = density/10
+                WSamplestep=0.0008
+                WRefstep=0.0008
+            elif np.abs(density-density0) > density/75:
+                print("Second")
+                scaleStep = 0.0006
+                densityStep = density/100
+                WSamplestep=0.0002
+                WRefstep=0.0002
+            else:
+                print("Third")
+                scaleStep = 0.00006
+                densityStep = density/1000
+                WSamplestep=0.0001
+                WRefstep=0.0001
         
-        numLoopIteration += 1
-        print("numLoopIteration", numLoopIteration, scaleFactor, density)
-        if (np.abs(density-density0) > np.abs(density/2500)) and (numLoopIteration <= 30):
-           continue
-        else:
-            break
+            print("Start scale minimization")
+            scaleFactor = Minimization.OptimizeScale(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q,
+                fe_Q, inputVariables["minQ"], inputVariables["QmaxIntegrate"], inputVariables["maxQ"],
+                Ztot, density, scaleFactor, Sinf, inputVariables["smoothingFactor"],
+                inputVariables["rmin"], dampingFunction, Fintra_r, inputVariables["iterations"],
+                scaleStep, inputVariables["sth"], inputVariables["s0th"], inputVariables["mccFlag"],
+                thickness_sampling, phi_matrix, FrEngine, chi2Pool, chi2Callback,
+                searchMode, cache=chi2Cache, mccCache=mccCache, context=context)
+            print("End scale minimization")
+
+            density0=density
+
+            print("Start density minimization")
+            density = Minimization.OptimizeDensity(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q,
+                fe_Q, inputVariables["minQ"], inputVariables["QmaxIntegrate"], inputVariables["maxQ"],
+                Ztot, density0, scaleFactor, Sinf, inputVariables["smoothingFactor"],
+                inputVariables["rmin"], dampingFunction, Fintra_r, inputVariables["iterations"],
+                densityStep, inputVariables["sth"], inputVariables["s0th"], inputVariables["mccFlag"],
+                thickness_sampling, phi_matrix, FrEngine, chi2Pool, chi2Callback,
+                searchMode, cache=chi2Cache, mccCache=mccCache, context=context)
+            print("End density minimization")
+        
+            numLoopIteration += 1
+            print("numLoopIteration", numLoopIteration, scaleFactor, density)
+            if (np.abs(density-density0) > np.abs(density/2500)) and (numLoopIteration <= 30):
+               continue
+            else:
+                break
        
     print("final scale", scaleFactor, "final density", density)
+
+    if inputVariables["mccFlag"].lower() == "y" and \
+        inputVariables.get("thicknessMinimization", "n").lower() == "y":
+        print("Start thickness minimization")
+        sth, s0th, chi2, sthArray, s0thArray, chi2Surface = Minimization.OptimizeThickness2D(Q,
+            I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, inputVariables["maxQ"], inputVariables["minQ"],
+            inputVariables["QmaxIntegrate"], Ztot, density, scaleFactor, inputVariables["sth"],
+            inputVariables["s0th"], Sinf, inputVariables["smoothingFactor"], inputVariables["rmin"],
+            dampingFunction, Fintra_r, inputVariables["iterations"],
+            inputVariables.get("sthStep", 0.0002), inputVariables.get("s0thStep", 0.0002),
+            thickness_sampling, phi_matrix, FrEngine, chi2Pool, chi2Callback,
+            cache=chi2Cache, mccCache=mccCache, context=context)
+        print("End thickness minimization")
+
+    if chi2Cache is not None:
+        print("chi2 cache", chi2Cache.stats())
+    if chi2Pool is None:
+        # with a pool the workers keep their own MCC caches
+        print("MCC cache", mccCache.stats())
+
+    if chi2Pool is not None:
+        chi2Pool.close()
+        chi2Pool.join()
     
     Isample_Q = MainFunctions.calc_IsampleQ(I_Q, scaleFactor, Ibkg_Q)
     alpha = MainFunctions.calc_alpha(J_Q[Q<=inputVariables["QmaxIntegrate"]], Sinf, 
@@ -243,12 +320,13 @@ if __name__ == "__main__":
     
     Qi_Q = Q*i_Q
     r, F_r = MainFunctions.calc_Fr(Q[Q<=inputVariables["QmaxIntegrate"]], 
-        Qi_Q[Q<=inputVariables["QmaxIntegrate"]])
+        Qi_Q[Q<=inputVariables["QmaxIntegrate"]], FrEngine)
     Fopt_r, deltaFopt_r = Optimization.calc_optimize_Fr(inputVariables["iterations"], F_r,
                 Fintra_r, density, i_Q[Q<=inputVariables["QmaxIntegrate"]], Q[Q<=inputVariables["QmaxIntegrate"]],
-                Sinf, J_Q[Q<=inputVariables["QmaxIntegrate"]], r, inputVariables["rmin"], "n")
+                Sinf, J_Q[Q<=inputVariables["QmaxIntegrate"]], r, inputVariables["rmin"], "n", FrEngine)
     
-    Scorr_Q = MainFunctions.calc_SQCorr(Fopt_r, r, Q, Sinf)
+    Scorr_Q = MainFunctions.calc_SQCorr(Fopt_r, r, Q, Sinf,
+        inputVariables.get("SQCorrEngine", "dense"))
     
     Utility.plot_data(Q, SsmoothDamp_Q, "S_Q", "Q", "S_Q", "S(Q)", "y")
     Utility.plot_data(Q, Scorr_Q, "S_Q", "Q", "S_Q", "Scorr(Q)", "y")
@@ -0,0 +1,375 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015-2016 European Synchrotron Radiation Facility
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Module containing the caches used in LASDiA to avoid repeated calculations.
+
+The chi2 values are memoized in an LRU cache with keys made of the quantized
+free variables and of a hash of all the other inputs.
+The expensive arrays (e.g. the phi matrix) are stored in a cache directory as
+.npy files named after the hash of their inputs. A cache entry is the group of
+files with the same name before the first dot (the array and its sidecar
+files), the least recently used entries are removed when the directory is
+larger than its size limit.
+"""
+
+
+import glob
+import hashlib
+import mmap
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+
+def quantize(value, digits=10):
+    """Function to round a value to a fixed number of significant digits, so
+    that values differing only by floating point noise give the same key.
+
+    Parameters
+    ----------
+    value  : float
+             value to round
+    digits : int
+             number of significant digits
+
+    Returns
+    -------
+    value  : float
+             rounded value
+    """
+    
+    return float("%.*g" % (digits, value))
+
+
+def hash_values(*values):
+    """Function to calculate a hash of numpy arrays, numbers and strings.
+    The arrays are hashed with their content, shape and dtype.
+
+    Parameters
+    ----------
+    values : tuple
+             values to hash
+
+    Returns
+    -------
+    key    : string
+             hexadecimal digest
+    """
+    
+    digest = hashlib.sha1()
+    for value in values:
+        if isinstance(value, np.ndarray):
+            digest.update(str((value.shape, value.dtype.str)).encode())
+            digest.update(np.ascontiguousarray(value).tobytes())
+        else:
+            if isinstance(value, np.generic):
+                value = value.item()
+            digest.update(repr(value).encode())
+        digest.update(b"|")
+    
+    return digest.hexdigest()
+
+
+class LRUCache(object):
+    """Dictionary with a maximum size, when it is full the least recently used
+    entry is removed.
+    It counts the hits and the misses of get().
+    """
+    
+    def __init__(self, maxSize=10000):
+        """
+        Parameters
+        ----------
+        maxSize : int
+                  maximum number of entries
+        """
+        
+        self.maxSize = maxSize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def __contains__(self, key):
+        return key in self.data
+    
+    def get(self, key, default=None):
+        """Function to read an entry and mark it as recently used.
+        """
+        
+        if key in self.data:
+            self.data.move_to_end(key)
+            self.hits += 1
+            return self.data[key]
+        
+        self.misses += 1
+        return default
+    
+    def put(self, key, value):
+        """Function to add an entry, removing the oldest ones over maxSize.
+        """
+        
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxSize:
+            self.data.popitem(last=False)
+    
+    def clear(self):
+        """Function to remove all the entries and reset the statistics.
+        """
+        
+        self.data.clear()
+        self.hits = 0
+        self.misses = 0
+    
+    def stats(self):
+        """Function to return the cache statistics.
+
+        Returns
+        -------
+        stats : dictionary
+                hits, misses, hitRate and size
+        """
+        
+        lookups = self.hits + self.misses
+        hitRate = self.hits/lookups if lookups > 0 else 0.0
+        
+        return {"hits": self.hits, "misses": self.misses, "hitRate": hitRate,
+            "size": len(self.data)}
+
+
+def save_array(path, array):
+    """Function to save an array in a .npy file atomically, so a concurrent
+    reader never sees a partial file.
+
+    Parameters
+    ----------
+    path  : string
+            file path
+    array : numpy array
+            array to save
+    """
+    
+    dirName = os.path.dirname(path) or "."
+    fd, tmpPath = tempfile.mkstemp(dir=dirName, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, array)
+        os.replace(tmpPath, path)
+    except:
+        os.remove(tmpPath)
+        raise
+
+
+def load_array(path, mmap=True):
+    """Function to load a cached array and mark its entry as recently used.
+
+    Parameters
+    ----------
+    path  : string
+            file path
+    mmap  : bool
+            if True the array is memory-mapped read-only
+
+    Returns
+    -------
+    array : numpy array
+            cached array, None if the file does not exist
+    """
+    
+    if not os.path.isfile(path):
+        return None
+    
+    os.utime(path, None)
+    if mmap:
+        return np.load(path, mmap_mode="r")
+    
+    return np.load(path)
+
+
+def create_array(path, shape):
+    """Function to create a float64 .npy file memory-mapped for writing, so a
+    large array can be filled in chunks without holding it in memory.
+    The file is created with a temporary name, commit_array moves it on path.
+
+    Parameters
+    ----------
+    path    : string
+              final file path
+    shape   : tuple
+              array shape
+
+    Returns
+    -------
+    array   : numpy memmap
+              array to fill
+    tmpPath : string
+              temporary file path
+    """
+    
+    dirName = os.path.dirname(path) or "."
+    fd, tmpPath = tempfile.mkstemp(dir=dirName, suffix=".tmp")
+    os.close(fd)
+    array = np.lib.format.open_memmap(tmpPath, mode="w+", dtype=np.float64,
+        shape=shape)
+    
+    return (array, tmpPath)
+
+
+def commit_array(path, array, tmpPath):
+    """Function to complete the file of create_array and to memory-map it
+    read-only.
+
+    Parameters
+    ----------
+    path    : string
+              final file path
+    array   : numpy memmap
+              array from create_array
+    tmpPath : string
+              temporary file path from create_array
+
+    Returns
+    -------
+    array   : numpy memmap
+              read-only array of path
+    """
+    
+    array.flush()
+    del array
+    os.replace(tmpPath, path)
+    
+    return np.load(path, mmap_mode="r")
+
+
+def memmap_source(array):
+    """Function to describe where a C-contiguous memory-mapped array (or a
+    slice of it) is in its file, so another process can map the same pages
+    with open_memmapSource instead of receiving a copy of the data.
+
+    Parameters
+    ----------
+    array  : numpy array
+             array to describe
+
+    Returns
+    -------
+    source : tuple
+             (filename, offset, shape, dtype) of the array, None if it is not
+             memory-mapped from a file
+    """
+    
+    if (not isinstance(array, np.memmap) or array.filename is None or
+        not array.flags.c_contiguous):
+        return None
+    
+    # the memmap created on the file is the one whose base is the mmap, its
+    # data starts at its offset in the file
+    mapped = array
+    while isinstance(mapped, np.ndarray) and not isinstance(mapped.base, mmap.mmap):
+        mapped = mapped.base
+    if not isinstance(mapped, np.memmap):
+        return None
+    offset = mapped.offset + array.ctypes.data - mapped.ctypes.data
+    
+    return (array.filename, offset, array.shape, array.dtype.str)
+
+
+def open_memmapSource(source):
+    """Function to memory-map read-only the array described by memmap_source.
+
+    Parameters
+    ----------
+    source : tuple
+             (filename, offset, shape, dtype) from memmap_source
+
+    Returns
+    -------
+    array  : numpy memmap
+             read-only array
+    """
+    
+    filename, offset, shape, dtype = source
+    
+    return np.memmap(filename, dtype=np.dtype(dtype), mode="r", offset=offset,
+        shape=shape)
+
+
+def entry_name(path):
+    """Function to return the name of the cache entry of a file.
+    
+    Parameters
+    ----------
+    path : string
+           file path
+    
+    Returns
+    -------
+    name : string
+           file name before the first dot
+    """
+    
+    return os.path.basename(path).split(".")[0]
+
+
+def evict_files(cacheDir, maxBytes, keep=()):
+    """Function to remove the least recently used entries of a cache directory
+    until its size is below maxBytes.
+    The last use of an entry is the latest modification time of its files.
+
+    Parameters
+    ----------
+    cacheDir : string
+               cache directory
+    maxBytes : int
+               maximum size of the directory (bytes)
+    keep     : tuple
+               names of the entries which must not be removed
+    """
+    
+    entries = {}
+    for path in glob.glob(os.path.join(cacheDir, "*.npy")):
+        try:
+            fileStat = os.stat(path)
+        except OSError:
+            continue
+        name = entry_name(path)
+        size, lastUse, paths = entries.get(name, (0, 0.0, []))
+        entries[name] = (size+fileStat.st_size, max(lastUse, fileStat.st_mtime),
+            paths+[path])
+    
+    totalBytes = sum(entry[0] for entry in entries.values())
+    for name in sorted(entries, key=lambda name: entries[name][1]):
+        if totalBytes <= maxBytes:
+            break
+        if name in keep:
+            continue
+        for path in entries[name][2]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        totalBytes -= entries[name][0]
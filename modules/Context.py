@@ -0,0 +1,291 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015-2016 European Synchrotron Radiation Facility
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Module containing the sample context, the quantities of a dataset which do
+not depend on the free variables of the minimization (scale factor, density,
+thicknesses).
+
+The context is calculated once for each dataset and it is shared by all the
+chi2 evaluations, so the form factors, the Q ranges and the sin matrices of
+the F(r) transforms are not calculated again for each sample.
+"""
+
+
+import numpy as np
+from scipy import interpolate
+
+from modules import Cache
+from modules import MainFunctions
+from modules import UtilityAnalysis
+
+
+class SampleContext(object):
+    """Q-invariant quantities of a dataset.
+    The Q grid must be increasing, so the ranges of the analysis (Q<=QmaxIntegrate,
+    minQ<Q<=QmaxIntegrate, r<rmin, ...) are contiguous and they are stored as
+    slices: the arrays sliced with them are views, not copies.
+    With the "simps" engine the sin(rQ) matrix of the F(r) transform is
+    calculated here, for both engines the sin(Qr) matrix of the F(r)
+    optimization (Optimization.calc_iQi) too.
+    The key attribute is a hash of the quantities and settings of the
+    context, to use it in the keys of the chi2 cache.
+    """
+    
+    def __init__(self, Q, elementList, elementParameters, minQ, QmaxIntegrate,
+        maxQ, smoothingFactor, rmin, dampingFactor, typeFunction, iterations,
+        engine="simps"):
+        """
+        Parameters
+        ----------
+        Q                 : numpy array
+                            momentum transfer (nm^-1), increasing
+        elementList       : dictionary("element": multiplicity)
+                            chemical elements of the sample with their multiplicity
+        elementParameters : dictionary("element": parameters)
+                            chemical elements of the sample with their parameters
+        minQ              : float
+                            minimum Q value
+        QmaxIntegrate     : float
+                            maximum Q value for the intagrations
+        maxQ              : float
+                            maximum Q value
+        smoothingFactor   : float
+                            smoothing factor
+        rmin              : float
+                            r cut-off value (nm)
+        dampingFactor     : float
+                            damping factor
+        typeFunction      : string
+                            type of function to use for the damping
+        iterations        : int
+                            number of iterations of the F(r) optimization
+        engine            : string
+                            engine for the F(r) transform: "simps" or "fft"
+        """
+        
+        self.Q = np.asarray(Q, dtype=float)
+        self.minQ = minQ
+        self.QmaxIntegrate = QmaxIntegrate
+        self.maxQ = maxQ
+        self.smoothingFactor = smoothingFactor
+        self.rmin = rmin
+        self.iterations = iterations
+        self.engine = engine
+        
+        self.fe_Q, self.Ztot = MainFunctions.calc_eeff(elementList, self.Q,
+            elementParameters)
+        self.Iincoh_Q = MainFunctions.calc_Iincoh(elementList, self.Q,
+            elementParameters)
+        self.J_Q = MainFunctions.calc_JQ(self.Iincoh_Q, self.Ztot, self.fe_Q)
+        self.Sinf = MainFunctions.calc_Sinf(elementList, self.fe_Q, self.Q,
+            self.Ztot, elementParameters)
+        self.dampingFunction = UtilityAnalysis.calc_dampingFunction(self.Q,
+            dampingFactor, QmaxIntegrate, typeFunction)
+        
+        # Q<=QmaxIntegrate, minQ<Q<=QmaxIntegrate (calc_SQ),
+        # Q<minQ and Q>=QmaxIntegrate (calc_SQsmoothing)
+        numInt = np.searchsorted(self.Q, QmaxIntegrate, side="right")
+        self.intSlice = slice(0, numInt)
+        self.SQSlice = slice(np.searchsorted(self.Q, minQ, side="right"), numInt)
+        self.lowSlice = slice(0, np.searchsorted(self.Q, minQ, side="left"))
+        self.highSlice = slice(np.searchsorted(self.Q, QmaxIntegrate, side="left"),
+            self.Q.size)
+        
+        self.Q_int = self.Q[self.intSlice]
+        self.J_Qint = self.J_Q[self.intSlice]
+        self.fe_Qint = self.fe_Q[self.intSlice]
+        self.SQnorm = self.Ztot**2 * self.fe_Q[self.SQSlice]**2
+        
+        self.meanDeltaQ = np.mean(np.diff(self.Q_int))
+        self.r = MainFunctions.calc_r(self.Q_int)
+        self.simpsWeights = MainFunctions.get_simpsWeights(self.Q_int)
+        if engine.lower() == "fft":
+            self.sinrQ = None
+        else:
+            self.sinrQ = np.sin(np.outer(self.r, self.Q_int))
+        
+        self.rminSlice = slice(0, np.searchsorted(self.r, rmin, side="left"))
+        rInt = self.r[self.rminSlice]
+        self.meanDeltar = np.mean(np.diff(rInt))
+        self.sinQr = np.sin(np.outer(self.Q_int[1:], rInt))
+        
+        self.key = Cache.hash_values(self.Q, self.fe_Q, self.Ztot, self.Iincoh_Q,
+            self.J_Q, self.Sinf, self.dampingFunction, minQ, QmaxIntegrate, maxQ,
+            smoothingFactor, rmin, iterations, engine.lower())
+    
+    def check_arguments(self, Q, J_Q=None, Iincoh_Q=None, fe_Q=None, minQ=None,
+        QmaxIntegrate=None, maxQ=None, Ztot=None, Sinf=None, smoothingFactor=None,
+        rmin=None, dampingFunction=None, iterations=None, engine=None):
+        """Function to check that the arguments passed together with the
+        context describe the same dataset and settings of the context, the
+        arguments which are None are not checked.
+        It raises ValueError for the first argument which differs.
+
+        Parameters
+        ----------
+        Q, J_Q, ...  : numpy array, float, int or string
+                       arguments with the same name as the context attributes
+                       (calc_chi2Batch)
+        """
+        
+        arrays = (("Q", Q, self.Q), ("J_Q", J_Q, self.J_Q),
+            ("Iincoh_Q", Iincoh_Q, self.Iincoh_Q), ("fe_Q", fe_Q, self.fe_Q),
+            ("dampingFunction", dampingFunction, self.dampingFunction))
+        for name, value, contextValue in arrays:
+            if value is None or value is contextValue:
+                continue
+            if np.shape(value) != contextValue.shape or not np.array_equal(value,
+                contextValue):
+                raise ValueError(name + " is different from the one of the sample context")
+        
+        values = (("minQ", minQ, self.minQ), ("QmaxIntegrate", QmaxIntegrate,
+            self.QmaxIntegrate), ("maxQ", maxQ, self.maxQ), ("Ztot", Ztot, self.Ztot),
+            ("Sinf", Sinf, self.Sinf), ("smoothingFactor", smoothingFactor,
+            self.smoothingFactor), ("rmin", rmin, self.rmin),
+            ("iterations", iterations, self.iterations))
+        for name, value, contextValue in values:
+            if value is not None and value != contextValue:
+                raise ValueError(name + " " + str(value) +
+                    " is different from the one of the sample context " + str(contextValue))
+        
+        if engine is not None and engine.lower() != self.engine.lower():
+            raise ValueError("engine " + engine + " is different from the one of the sample context "
+                + self.engine)
+    
+    def calc_SQ(self, Icoh_Q):
+        """Function to calculate the structure factor S(Q), as
+        MainFunctions.calc_SQ.
+
+        Parameters
+        ----------
+        Icoh_Q : numpy array
+                 cohrent scattering intensity, it can be a 2D array with a
+                 row for each sample
+
+        Returns
+        -------
+        S_Q    : numpy array
+                 structure factor
+        """
+        
+        S_Q = np.zeros(Icoh_Q.shape)
+        S_Q[..., self.SQSlice] = Icoh_Q[..., self.SQSlice] / self.SQnorm
+        S_Q[..., self.intSlice.stop:] = self.Sinf
+        
+        return S_Q
+    
+    def calc_SQsmoothing(self, S_Q):
+        """Function to smooth S(Q), as UtilityAnalysis.calc_SQsmoothing.
+
+        Parameters
+        ----------
+        S_Q         : numpy array
+                      structure factor, it can be a 2D array with a row for
+                      each sample
+
+        Returns
+        -------
+        S_Qsmoothed : numpy array
+                      smoothed S(Q)
+        """
+        
+        S_Qsmoothed = np.zeros(S_Q.shape)
+        for idx in np.ndindex(S_Q.shape[:-1]):
+            smooth = interpolate.UnivariateSpline(self.Q, S_Q[idx], k=3,
+                s=self.smoothingFactor)
+            S_Qsmoothed[idx] = smooth(self.Q)
+        
+        S_Qsmoothed[..., self.lowSlice] = 0
+        S_Qsmoothed[..., self.highSlice] = self.Sinf
+        
+        return S_Qsmoothed
+    
+    def calc_Fr(self, Qi_Q):
+        """Function to calculate F(r) on the r grid of the context, as
+        MainFunctions.calc_Fr.
+
+        Parameters
+        ----------
+        Qi_Q : numpy array
+               Qi(Q) on Q_int, it can be a 2D array with a row for each sample
+
+        Returns
+        -------
+        F_r  : numpy array
+               F(r) distribution function
+        """
+        
+        if self.sinrQ is None:
+            return (2.0 / np.pi) * MainFunctions.calc_sinTransform(Qi_Q *
+                self.simpsWeights, self.Q_int[0], self.meanDeltaQ, 0.0, self.r[1],
+                self.r.size)
+        
+        return (2.0 / np.pi) * np.dot(Qi_Q * self.simpsWeights, self.sinrQ.T)
+    
+    def calc_iQi(self, i_Q, deltaF_r):
+        """Function to calculate the i-th iteration of i(Q) on Q_int[1:], as
+        Optimization.calc_iQi.
+
+        Parameters
+        ----------
+        i_Q      : numpy array
+                   i(Q) on Q_int[1:]
+        deltaF_r : numpy array
+                   difference between F(r) and its theoretical value
+
+        Returns
+        -------
+        i_Qi     : numpy array
+                   i-th iteration of i(Q)
+        """
+        
+        integral = np.dot(deltaF_r[..., self.rminSlice], self.sinQr.T) * self.meanDeltar
+        i_Qi = i_Q - (1/self.Q_int[1:] * (i_Q / (self.Sinf + self.J_Qint[1:]) + 1)) * integral
+        
+        return i_Qi
+
+
+def make_sampleContext(inputVariables, Q, elementList, elementParameters):
+    """Function to create the sample context from the input file variables.
+
+    Parameters
+    ----------
+    inputVariables    : dictionary
+                        input file variables (Utility.read_inputFile)
+    Q                 : numpy array
+                        momentum transfer (nm^-1)
+    elementList       : dictionary("element": multiplicity)
+                        chemical elements of the sample with their multiplicity
+    elementParameters : dictionary("element": parameters)
+                        chemical elements of the sample with their parameters
+
+    Returns
+    -------
+    context           : SampleContext
+                        sample context
+    """
+    
+    return SampleContext(Q, elementList, elementParameters, inputVariables["minQ"],
+        inputVariables["QmaxIntegrate"], inputVariables["maxQ"],
+        inputVariables["smoothingFactor"], inputVariables["rmin"],
+        inputVariables["dampingFactor"], inputVariables["typeFunction"],
+        inputVariables["iterations"], inputVariables.get("FrEngine", "simps"))
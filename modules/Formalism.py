@@ -49,7 +49,6 @@ import matplotlib.pyplot as plt
 
 from modules import MainFunctions
 from modules import Optimization
-from modules import Utility
 from modules import UtilityAnalysis
 
 
@@ -191,8 +190,11 @@ def calc_SFZ_Q(Q, Icoh_Q, aff_squared_mean, aff_mean_squared, minQ, QmaxIntegrat
     return S_Q
 
 
-def calc_iintraFZ(Q, QmaxIntegrate, maxQ, elementList, element, x, y, z, elementParameters, aff_mean_squared):
+def calc_iintraFZ(Q, QmaxIntegrate, maxQ, elementList, element, x, y, z, elementParameters, aff_mean_squared,
+    binWidth=None):
     """Function to calculate the intramolecular contribution of i(Q) (eq. 41).
+    The pair sum is calculated as in Optimization.calc_iintra, exact or with
+    distance bins of width binWidth.
 
     Parameters
     ----------
@@ -223,6 +225,9 @@ def calc_iintraFZ(Q, QmaxIntegrate, maxQ, elementList, element, x, y, z, element
                         parameters : list
                                      list of the parameters
                                      (Z, a1, b1, a2, b2, a3, b3, a4, b4, c, M, K, L)
+    binWidth          : float
+                        width of the distance bins (nm), if None the exact
+                        sum is calculated
 
     Returns
     -------
@@ -230,26 +235,16 @@ def calc_iintraFZ(Q, QmaxIntegrate, maxQ, elementList, element, x, y, z, element
                         intramolecular contribution of i(Q)
     """
 
-    iintra_Q = np.zeros(Q.size)
-    sinpq = np.zeros(Q.size)
-
-    for ielem in range(len(element)):
-        for jelem in range(len(element)):
-            if ielem != jelem:
-                # print(ielem, jelem)
-                # print(type(element[ielem]))
-                # print(element[ielem], elementList[element[ielem]], element[jelem], elementList[element[jelem]])
-                f_Qi = MainFunctions.calc_aff(element[ielem], Q, elementParameters)
-                f_Qj = MainFunctions.calc_aff(element[jelem], Q, elementParameters)
-                f_i = np.mean(elementList[element[ielem]] * f_Qi / 3)
-                f_j = np.mean(elementList[element[jelem]] * f_Qj / 3)
-                # f_i = np.mean(f_Qi)
-                # f_j = np.mean(f_Qj)
-                ff = f_i * f_j
-                d = Utility.calc_distMol(x[ielem], y[ielem], z[ielem], x[jelem], y[jelem], z[jelem])
-                if d != 0.0:
-                    iintra_Q += ff * np.sin(d*Q) / (d*Q)
-                    iintra_Q[Q==0.0] = ff
+    f = dict((elem, np.mean(elementList[elem] * MainFunctions.calc_aff(elem, Q,
+        elementParameters) / 3)) for elem in set(element))
+
+    if binWidth is None:
+        distances, pairWeights = Optimization.calc_atomPairs(x, y, z,
+            np.array([f[elem] for elem in element]))
+    else:
+        distances, pairWeights = Optimization.calc_atomPairsHistogram(element,
+            x, y, z, f, binWidth)
+    iintra_Q = Optimization.calc_iintraSum(Q, distances, pairWeights)
 
     iintra_Q[(Q>QmaxIntegrate) & (Q<=maxQ)] = 0.0
     iintra_Q /= np.mean(aff_mean_squared)
@@ -39,9 +39,16 @@ otherwise it is symbolized with just its name.
 """
 
 
+import glob
+import json
+import mmap
+import multiprocessing
+import os
+
 import numpy as np
-from scipy.integrate import simps
 
+from modules import Cache
+from modules import MainFunctions
 from modules import Utility
 from modules import UtilityAnalysis
 
@@ -106,14 +113,15 @@ def calc_phi_angle(ws1, ws2, r1, r2, d, two_theta, xth):
               curvature radius of second slit (cm)
     d       : float
               slit thickness (cm)
-    two_theta : float
+    two_theta : float or numpy array
               diffraction angle (rad)
-    xth     : float
-              i-th point position on x-axis (cm)
+    xth     : float or numpy array
+              i-th point position on x-axis (cm), two_theta and xth are
+              broadcast against each other
 
     Returns
     -------
-    phi     : float
+    phi     : float or numpy array
               dispersion angle (rad)
     """
 
@@ -125,15 +133,57 @@ def calc_phi_angle(ws1, ws2, r1, r2, d, two_theta, xth):
     beta1 = np.arctan( (r2+d) * np.sin(two_theta + gamma_2) / ((r2+d)*np.cos(two_theta + gamma_2) - xth ))
     beta2 = np.arctan( (r2+d) * np.sin(two_theta - gamma_2) / ((r2+d)*np.cos(two_theta - gamma_2) - xth ))
 
-    psi = min(alpha1, beta1) - max(alpha2, beta2)
-    phi = max(0, psi)
+    psi = np.where(beta1 < alpha1, beta1, alpha1) - np.where(beta2 > alpha2, beta2, alpha2)
+    phi = np.where(psi > 0, psi, 0.0)
 
     return phi
 
 
-def calc_phi_matrix(two_theta, ws1, ws2, r1, r2, d, num_point=1000, thickness=0.17):
+def calc_thickness_sampling(denseThickness, thickness=0.17, denseStep=0.17/999,
+    coarseStep=0.17/199):
+    """Function to calculate a non-uniform thickness sampling for the phi matrix,
+    dense from 0 to denseThickness (the sample) and coarse up to thickness
+    (the diamonds).
+    The transfer functions of a sample are integrated up to half its
+    thickness, so denseThickness equal to the thickest sample leaves a margin.
+
+    Parameters
+    ----------
+    denseThickness     : float
+                         thickness sampled with denseStep (cm)
+    thickness          : float
+                         object thickness (sample+DAC) (cm)
+    denseStep          : float
+                         thickness step in the sample region (cm), the default
+                         is the step of the uniform sampling with 1000 points
+    coarseStep         : float
+                         maximum thickness step in the diamond region (cm)
+
+    Returns
+    -------
+    thickness_sampling : numpy array
+                         array with the thickness values (cm)
+    """
+    
+    numDense = int(np.ceil(min(denseThickness, thickness)/denseStep))
+    denseSampling = np.linspace(0, numDense*denseStep, numDense+1)
+    
+    if denseSampling[-1] >= thickness:
+        return denseSampling
+    
+    numCoarse = int(np.ceil((thickness-denseSampling[-1])/coarseStep))
+    coarseSampling = np.linspace(denseSampling[-1], thickness, numCoarse+1)
+    
+    return np.concatenate((denseSampling, coarseSampling[1:]))
+
+
+def calc_phi_matrix(two_theta, ws1, ws2, r1, r2, d, num_point=1000, thickness=0.17,
+    thickness_sampling=None, out=None, chunkSize=32*1024**2):
     """Function to calculate the dispersion angle matrix.
     half_thick in cm
+    The matrix is calculated in blocks of thickness rows of about chunkSize
+    bytes, so the temporary arrays stay small and out can be a memory-mapped
+    file (Cache.create_array) larger than the memory.
 
     Parameters
     ----------
@@ -153,23 +203,37 @@ def calc_phi_matrix(two_theta, ws1, ws2, r1, r2, d, num_point=1000, thickness=0.
                          number of point for the thickness array
     thickness          : float
                          object thickness (sample or sample+DAC) (cm)
+    thickness_sampling : numpy array
+                         array with the thickness values (cm), if it is given
+                         num_point and thickness are not used, it can be
+                         non-uniform (calc_thickness_sampling)
+    out                : 2D numpy array
+                         array (thickness, two_theta) where the matrix is
+                         written, if None a new array is created
+    chunkSize          : int
+                         size of the row blocks (bytes)
 
     Returns
     -------
-    thickness_sampling : numpy array
-                         array with the thickness values (cm)
     phi_matrix         : 2D numpy array
                          dispersion angle matrix (rad)
     """
 
     # thickness_sampling = np.linspace(-thickness/2, thickness/2, num=num_point)
-    thickness_sampling = np.linspace(0, thickness, num=num_point)
-    phi_matrix = np.zeros((thickness_sampling.size, two_theta.size))
-
-    for i, val_sth in enumerate(thickness_sampling):
-        for j, val_2theta in enumerate(two_theta):
-            phi_matrix[i][j] = calc_phi_angle(ws1, ws2, r1, r2, d, two_theta[j], \
-            thickness_sampling[i])
+    if thickness_sampling is None:
+        thickness_sampling = np.linspace(0, thickness, num=num_point)
+    else:
+        thickness_sampling = np.asarray(thickness_sampling, dtype=float)
+    
+    if out is None:
+        phi_matrix = np.empty((thickness_sampling.size, two_theta.size))
+    else:
+        phi_matrix = out
+    
+    numRows = max(chunkSize // (8*two_theta.size), 1)
+    for start in range(0, thickness_sampling.size, numRows):
+        phi_matrix[start:start+numRows] = calc_phi_angle(ws1, ws2, r1, r2, d,
+            two_theta[np.newaxis, :], thickness_sampling[start:start+numRows, np.newaxis])
 
     return (phi_matrix)
 
@@ -177,6 +241,9 @@ def calc_phi_matrix(two_theta, ws1, ws2, r1, r2, d, num_point=1000, thickness=0.
 def calc_T_MCC(sample_thickness, thickness_sampling, phi_matrix, norm):
     """Function to calculate the MCC transfer function for the sample, the DAC 
         and sample+DAC (W. eq. 10, 11).
+    The phi matrix is integrated on thickness_sampling, which can be
+    non-uniform, with the Simpson's weights (simps with even="first") of
+    MainFunctions.get_simpsWeights.
 
     Parameters
     ----------
@@ -202,8 +269,10 @@ def calc_T_MCC(sample_thickness, thickness_sampling, phi_matrix, norm):
     # mask = (thickness_sampling >= -sample_thickness/2) & (thickness_sampling <= sample_thickness/2)
     mask = (thickness_sampling >= 0) & (thickness_sampling <= sample_thickness/2)
 
-    T_MCC_ALL = simps(phi_matrix, axis=0, even="first")
-    T_MCC_sample = simps(phi_matrix[mask], axis=0, even="first")
+    T_MCC_ALL = np.dot(MainFunctions.get_simpsWeights(thickness_sampling, "first"),
+        phi_matrix)
+    T_MCC_sample = np.dot(MainFunctions.get_simpsWeights(thickness_sampling[mask],
+        "first"), phi_matrix[mask])
     T_MCC_DAC = T_MCC_ALL - T_MCC_sample
 
     if norm.lower() == "y":
@@ -276,17 +345,33 @@ def calc_empty_cell_bkg(Q, Ibkg_Q, diamond_abs_corr_factor, Iincoh_Q, Ztot, fe_Q
     return Ibkg_Q
 
 
-def MCC_correction(sth, s0th, thickness_sampling, phi_matrix):
+def MCC_correction(sth, s0th, thickness_sampling, phi_matrix, table=None):
     """Function to calcultate all intensity geometrical corrections.
     
     Parameters
     ----------
+    sth                   : float
+                            sample thickness
+    s0th                  : float
+                            sample thickness for the reference spectra
+    thickness_sampling    : numpy array
+                            array with the thickness values for sample+DAC
+    phi_matrix            : 2D numpy array
+                            dispersion angle matrix for sample+DAC (rad)
+    table                 : MCCTable
+                            table of the same phi matrix, if it is given the
+                            transfer functions are read from it
     
     Returns
     -------
-    
+    T_MCC_sth             : numpy array
+                            MCC sample transfer function
+    T_MCC_corr_factor_bkg : numpy array
+                            background correction factor
     """
     
+    if table is not None:
+        return table.MCC_correction(sth, s0th)
     
     T_MCC_sth, T_MCC_DACsth, T_MCC_ALLsth = calc_T_MCC(sth, thickness_sampling,
         phi_matrix, "y")
@@ -300,8 +385,550 @@ def MCC_correction(sth, s0th, thickness_sampling, phi_matrix):
     return (T_MCC_sth, T_MCC_corr_factor_bkg)
 
 
-def check_phi_matrix(Q, ws1, ws2, r1, r2, d, phiMatrixCalcFlag, phiMatrixPath):
+class MCCTable(object):
+    """Table of the cumulative integrals of the phi matrix along the thickness
+    axis.
+    The row n-1 of the table is the Simpson integral (simps with even="first",
+    as in calc_T_MCC, also for a non-uniform thickness sampling) of the first
+    n rows of the phi matrix, so the MCC
+    transfer functions of any sample thickness are read from the table
+    instead of integrating the phi matrix again.
+    """
+    
+    def __init__(self, thickness_sampling, phi_matrix, interpolation=False,
+        chunkSize=32*1024**2):
+        """
+        Parameters
+        ----------
+        thickness_sampling : numpy array
+                             array with the thickness values for sample+DAC
+        phi_matrix         : 2D numpy array
+                             dispersion angle matrix for sample+DAC (rad)
+        interpolation      : bool
+                             if True the integral is linearly interpolated
+                             between the thickness points, otherwise it stops
+                             at the last point inside the sample as in
+                             calc_T_MCC
+        chunkSize          : int
+                             the table is calculated in blocks of 2theta
+                             columns of about chunkSize bytes, so a
+                             memory-mapped phi matrix is read once and the
+                             temporary arrays stay small
+        """
+        
+        thickness_sampling = np.asarray(thickness_sampling)
+        start = np.searchsorted(thickness_sampling, 0.0)
+        self.thickness_sampling = thickness_sampling[start:]
+        self.interpolation = interpolation
+        
+        phi_matrix = np.asarray(phi_matrix)[start:]
+        numRows = phi_matrix.shape[0]
+        
+        # Simpson rule for non-uniform steps h0, h1 as in scipy simps
+        h = np.diff(self.thickness_sampling)[:, np.newaxis]
+        h0 = h[0:numRows-2:2]
+        h1 = h[1:numRows-1:2]
+        
+        self.T_table = np.zeros(phi_matrix.shape)
+        numColumns = max(chunkSize // (8*numRows), 1)
+        for start in range(0, phi_matrix.shape[1], numColumns):
+            phi = np.array(phi_matrix[:, start:start+numColumns])
+            T_odd = np.zeros(((numRows+1)//2, phi.shape[1]))
+            T_odd[1:] = np.cumsum((h0+h1)/6.0 * (phi[0:-2:2]*(2-h1/h0) +
+                phi[1:-1:2]*(h0+h1)**2/(h0*h1) + phi[2::2]*(2-h0/h1)), axis=0)
+            
+            T_block = self.T_table[:, start:start+numColumns]
+            T_block[0::2] = T_odd
+            T_block[1::2] = T_odd[0:numRows//2] + 0.5*h[0::2]*(phi[0:-1:2] +
+                phi[1::2])
+    
+    def calc_T_MCC(self, sample_thickness, norm="y"):
+        """Function to calculate the MCC transfer functions for the sample,
+        the DAC and sample+DAC, as Geometry.calc_T_MCC.
+
+        Parameters
+        ----------
+        sample_thickness : float or numpy array
+                           sample thickness, for an array the transfer
+                           functions have a row for each thickness
+        norm             : string
+                           flag to normalize the MCC transfer function to
+                           start to 1
+
+        Returns
+        -------
+        T_MCC_sample     : numpy array
+                           MCC sample transfer function
+        T_MCC_DAC        : numpy array
+                           MCC DAC transfer function
+        T_MCC_ALL        : numpy array
+                           MCC sample+DAC transfer function
+        """
+        
+        halfThickness = np.asarray(sample_thickness, dtype=float)/2
+        
+        if self.interpolation:
+            rowIdx = np.interp(halfThickness, self.thickness_sampling,
+                np.arange(self.thickness_sampling.size))
+            lowIdx = np.minimum(np.floor(rowIdx).astype(int),
+                self.thickness_sampling.size-2)
+            weight = (rowIdx - lowIdx)[..., np.newaxis]
+            T_MCC_sample = (1-weight)*self.T_table[lowIdx] + \
+                weight*self.T_table[lowIdx+1]
+        else:
+            numPoints = np.searchsorted(self.thickness_sampling, halfThickness,
+                side="right")
+            T_MCC_sample = np.take(self.T_table, np.maximum(numPoints-1, 0), axis=0)
+            T_MCC_sample[numPoints==0] = 0.0
+        
+        T_MCC_ALL = np.broadcast_to(self.T_table[-1], T_MCC_sample.shape).copy()
+        T_MCC_DAC = T_MCC_ALL - T_MCC_sample
+        
+        if norm.lower() == "y":
+            T_MCC_sample /= T_MCC_sample[..., 0:1]
+            T_MCC_DAC /= T_MCC_DAC[..., 0:1]
+            T_MCC_ALL /= T_MCC_ALL[..., 0:1]
+        
+        return (T_MCC_sample, T_MCC_DAC, T_MCC_ALL)
+    
+    def MCC_correction(self, sth, s0th):
+        """Function to calculate the MCC correction factors, as
+        Geometry.MCC_correction.
+
+        Parameters
+        ----------
+        sth                   : float or numpy array
+                                sample thickness
+        s0th                  : float or numpy array
+                                sample thickness for the reference spectra,
+                                it is broadcast against sth
+
+        Returns
+        -------
+        T_MCC_sth             : numpy array
+                                MCC sample transfer function
+        T_MCC_corr_factor_bkg : numpy array
+                                background correction factor
+        """
+        
+        sth, s0th = np.broadcast_arrays(np.asarray(sth, dtype=float),
+            np.asarray(s0th, dtype=float))
+        T_MCC_sth, T_MCC_DACsth, T_MCC_ALLsth = self.calc_T_MCC(sth, "y")
+        T_MCC_samples0th, T_MCC_DACs0th, T_MCC_ALLs0th = self.calc_T_MCC(s0th, "y")
+        T_MCC_corr_factor_bkg = calc_T_DAC_MCC_bkg_corr(T_MCC_DACsth, T_MCC_DACs0th)
+        
+        return (T_MCC_sth, T_MCC_corr_factor_bkg)
+
+
+# MCC tables of the last phi matrices, see get_MCCTable
+MCCTableCache = Cache.LRUCache(4)
+
+
+def get_MCCTable(thickness_sampling, phi_matrix):
+    """Function to return the MCCTable of a phi matrix, building it only the
+    first time it is requested for these array objects.
+    The cache keeps a reference to the arrays, so their identity cannot be
+    reused by other arrays while the table is stored.
+
+    Parameters
+    ----------
+    thickness_sampling : numpy array
+                         array with the thickness values for sample+DAC
+    phi_matrix         : 2D numpy array
+                         dispersion angle matrix for sample+DAC (rad)
+
+    Returns
+    -------
+    table              : MCCTable
+                         table of the phi matrix
+    """
+    
+    key = (id(thickness_sampling), id(phi_matrix))
+    entry = MCCTableCache.get(key)
+    if entry is None:
+        entry = (MCCTable(thickness_sampling, phi_matrix), thickness_sampling,
+            phi_matrix)
+        MCCTableCache.put(key, entry)
+    
+    return entry[0]
+
+
+# keys of the last phi matrices, see get_phi_matrixKey
+phiKeyCache = Cache.LRUCache(4)
+
+
+def get_phi_matrixKey(phi_matrix):
+    """Function to return the content key of a phi matrix, calculating it
+    only the first time it is requested for this array object.
+    A matrix mapped whole from the phi matrix cache (see check_phi_matrix) is
+    identified by its file name, which is already the key of its inputs (see
+    phi_matrix_cacheName); the other matrices, views included, are hashed
+    once.
+
+    Parameters
+    ----------
+    phi_matrix : 2D numpy array
+                 dispersion angle matrix for sample+DAC (rad)
+
+    Returns
+    -------
+    phiKey     : string
+                 key of the phi matrix
+    """
+
+    key = id(phi_matrix)
+    entry = phiKeyCache.get(key)
+    if entry is None:
+        filename = getattr(phi_matrix, "filename", None)
+        name = ""
+        if filename is not None and isinstance(phi_matrix.base, mmap.mmap):
+            name = Cache.entry_name(filename)
+        if name.startswith("phi_") and len(name) == 37:
+            phiKey = name + str(np.shape(phi_matrix))
+        else:
+            phiKey = Cache.hash_values(phi_matrix)
+        entry = (phiKey, phi_matrix)
+        phiKeyCache.put(key, entry)
+
+    return entry[0]
+
+
+def phi_matrix_cacheName(two_theta, ws1, ws2, r1, r2, d, thickness_sampling):
+    """Function to calculate the cache file name of a phi matrix.
+    The name is made of a key of the geometry (Soller slits and thickness
+    sampling) and a key of the 2theta grid, which includes the wavelength.
+
+    Parameters
+    ----------
+    two_theta          : numpy array
+                         diffraction angle (rad)
+    ws1                : float
+                         width of the inner slit (cm)
+    ws2                : float
+                         width of the outer slit (cm)
+    r1                 : float
+                         curvature radius of first slit (cm)
+    r2                 : float
+                         curvature radius of second slit (cm)
+    d                  : float
+                         slit thickness (cm)
+    thickness_sampling : numpy array
+                         array with the thickness values (cm)
+
+    Returns
+    -------
+    name               : string
+                         cache file name without extension
+    """
+    
+    geometryKey = Cache.hash_values(float(ws1), float(ws2), float(r1), float(r2),
+        float(d), thickness_sampling)[0:16]
+    gridKey = Cache.hash_values(two_theta)[0:16]
+    
+    return "phi_" + geometryKey + "_" + gridKey
+
+
+def resample_phi_matrix(two_theta, phi_two_theta, phi_matrix):
+    """Function to interpolate linearly a phi matrix on a new 2theta grid.
+
+    Parameters
+    ----------
+    two_theta     : numpy array
+                    new diffraction angle grid (rad)
+    phi_two_theta : numpy array
+                    increasing diffraction angle grid of phi_matrix (rad)
+    phi_matrix    : 2D numpy array
+                    dispersion angle matrix (rad)
+
+    Returns
+    -------
+    phi_matrix    : 2D numpy array
+                    dispersion angle matrix on two_theta (rad)
+    """
+    
+    lowIdx = np.clip(np.searchsorted(phi_two_theta, two_theta) - 1, 0,
+        phi_two_theta.size-2)
+    weight = (two_theta - phi_two_theta[lowIdx]) / \
+        (phi_two_theta[lowIdx+1] - phi_two_theta[lowIdx])
+    
+    return (1-weight)*phi_matrix[:, lowIdx] + weight*phi_matrix[:, lowIdx+1]
+
+
+def calc_resample_error(phi_two_theta, phi_matrix):
+    """Function to estimate the relative error of resample_phi_matrix.
+    The odd columns of the matrix are interpolated from the even ones, so the
+    error is measured with twice the grid step; it is halved, which is the
+    scaling of the linear interpolation where phi has a kink (smooth regions
+    scale by 4).
+
+    Parameters
+    ----------
+    phi_two_theta : numpy array
+                    diffraction angle grid of phi_matrix (rad)
+    phi_matrix    : 2D numpy array
+                    dispersion angle matrix (rad)
+
+    Returns
+    -------
+    error         : float
+                    estimated maximum interpolation error divided by the
+                    maximum of phi
+    """
+    
+    evenColumns = phi_matrix[:, 0::2]
+    oddInterp = resample_phi_matrix(phi_two_theta[1:-1:2], phi_two_theta[0::2],
+        evenColumns)
+    phiMax = np.amax(np.abs(phi_matrix))
+    
+    if phiMax == 0:
+        return 0.0
+    
+    return np.amax(np.abs(oddInterp - phi_matrix[:, 1:-1:2])) / (2*phiMax)
+
+
+def find_phi_matrix(cacheDir, name, two_theta, maxError):
+    """Function to search the cache directory for a phi matrix with the same
+    geometry and thickness sampling of name, but on another 2theta grid, and
+    to resample it on two_theta.
+    The cached grid must cover two_theta and its estimated interpolation
+    error (calc_resample_error) must be lower than maxError.
+
+    Parameters
+    ----------
+    cacheDir  : string
+                phi matrix cache directory
+    name      : string
+                cache name of the phi matrix (phi_matrix_cacheName)
+    two_theta : numpy array
+                diffraction angle (rad)
+    maxError  : float
+                maximum relative interpolation error
+
+    Returns
+    -------
+    phi_matrix : 2D numpy array
+                 dispersion angle matrix on two_theta (rad), None if no
+                 cached matrix can be used
+    """
+    
+    geometryName = name.rsplit("_", 1)[0]
+    candidates = []
+    for path in glob.glob(os.path.join(cacheDir, geometryName + "_*.two_theta.npy")):
+        phi_two_theta = Cache.load_array(path, mmap=False)
+        if phi_two_theta is None or phi_two_theta.size < 3:
+            continue
+        if phi_two_theta[0] <= np.amin(two_theta) and phi_two_theta[-1] >= np.amax(two_theta):
+            step = (phi_two_theta[-1]-phi_two_theta[0]) / (phi_two_theta.size-1)
+            candidates.append((step, path, phi_two_theta))
+    
+    # finest grids first
+    for step, path, phi_two_theta in sorted(candidates, key=lambda c: c[0]):
+        phi_matrix = Cache.load_array(os.path.join(cacheDir,
+            Cache.entry_name(path) + ".npy"))
+        if phi_matrix is None or phi_matrix.shape[1] != phi_two_theta.size:
+            continue
+        error = calc_resample_error(phi_two_theta, phi_matrix)
+        if error <= maxError:
+            print("phi matrix resampled from", Cache.entry_name(path),
+                "estimated error", error)
+            return resample_phi_matrix(two_theta, phi_two_theta, phi_matrix)
+    
+    return None
+
+
+def calc_phi_archiveEntry(args):
+    """Function to calculate one phi matrix of an archive and to write it in
+    the archive file, it is the worker of calc_phi_archive.
+
+    Parameters
+    ----------
+    args : tuple
+           (path, index, two_theta, ws1, ws2, r1, r2, d, thickness_sampling)
+
+    Returns
+    -------
+    index : int
+            index of the phi matrix in the archive
+    """
+    
+    path, index, two_theta, ws1, ws2, r1, r2, d, thickness_sampling = args
+    
+    archive = np.load(path, mmap_mode="r+")
+    calc_phi_matrix(two_theta, ws1, ws2, r1, r2, d,
+        thickness_sampling=thickness_sampling, out=archive[index])
+    archive.flush()
+    del archive
+    
+    return index
+
+
+def calc_phi_archive(archivePath, models, wavelengths, Q, thickness_sampling=None,
+    numWorkers=None):
+    """Function to calculate the phi matrices of all the Soller slits models
+    and wavelengths in a single archive.
+    The matrices are calculated by a multiprocessing.Pool and written in the
+    3D array archivePath.npy (model x wavelength, thickness, Q), which is
+    memory-mapped by read_phi_archive; the Q grid and the thickness sampling
+    are saved in archivePath.Q.npy and archivePath.thickness.npy and the
+    index in archivePath.json, written at the end.
+
+    Parameters
+    ----------
+    archivePath        : string
+                         archive path without extension
+    models             : dictionary
+                         Soller slits models, (ws1, ws2, r1, r2, d) for each
+                         model name (Utility.read_MCC_models)
+    wavelengths        : list
+                         XRay beam wavelengths (nm)
+    Q                  : numpy array
+                         momentum transfer (nm^-1)
+    thickness_sampling : numpy array
+                         array with the thickness values (cm), if None 1000
+                         uniform values from 0 to 0.17 cm
+    numWorkers         : int
+                         number of processes, None for one for each CPU, 0 to
+                         calculate the matrices in this process
+
+    Returns
+    -------
+    entries            : list
+                         index of the archive, a dictionary with model,
+                         ws1, ws2, r1, r2, d and wavelength for each matrix
+    """
+    
+    if thickness_sampling is None:
+        thickness_sampling = np.linspace(0, 0.17, num=1000)
+    
+    entries = []
+    for model in sorted(models):
+        ws1, ws2, r1, r2, d = models[model]
+        for wavelength in wavelengths:
+            entries.append({"model": model, "ws1": ws1, "ws2": ws2, "r1": r1,
+                "r2": r2, "d": d, "wavelength": float(wavelength)})
+    
+    path = archivePath + ".npy"
+    archive = np.lib.format.open_memmap(path, mode="w+", dtype=np.float64,
+        shape=(len(entries), thickness_sampling.size, Q.size))
+    del archive
+    np.save(archivePath + ".Q.npy", Q)
+    np.save(archivePath + ".thickness.npy", thickness_sampling)
+    
+    tasks = [(path, index, UtilityAnalysis.Qto2theta(Q, entry["wavelength"]),
+        entry["ws1"], entry["ws2"], entry["r1"], entry["r2"], entry["d"],
+        thickness_sampling) for index, entry in enumerate(entries)]
+    
+    if numWorkers == 0:
+        for task in tasks:
+            calc_phi_archiveEntry(task)
+    else:
+        pool = multiprocessing.Pool(numWorkers)
+        try:
+            pool.map(calc_phi_archiveEntry, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    
+    with open(archivePath + ".json", "w") as indexFile:
+        json.dump({"entries": entries, "shape": [len(entries),
+            thickness_sampling.size, Q.size]}, indexFile, indent=1)
+    
+    return entries
+
+
+def read_phi_archive(archivePath, ws1, ws2, r1, r2, d, Q, wavelength=0.03738,
+    thickness_sampling=None, maxResampleError=5e-3):
+    """Function to read a phi matrix from an archive of calc_phi_archive.
+    If the archive Q grid is different from Q, the matrix is resampled as in
+    find_phi_matrix.
+
+    Parameters
+    ----------
+    archivePath        : string
+                         archive path without extension
+    ws1                : float
+                         width of the inner slit (cm)
+    ws2                : float
+                         width of the outer slit (cm)
+    r1                 : float
+                         curvature radius of first slit (cm)
+    r2                 : float
+                         curvature radius of second slit (cm)
+    d                  : float
+                         slit thickness (cm)
+    Q                  : numpy array
+                         momentum transfer (nm^-1)
+    wavelength         : float
+                         XRay beam wavelength (nm)
+    thickness_sampling : numpy array
+                         array with the thickness values (cm), if it is given
+                         the archive must have the same, otherwise any
+                         sampling is accepted
+    maxResampleError   : float
+                         maximum relative error to resample the matrix
+
+    Returns
+    -------
+    thickness_sampling : numpy array
+                         array with the thickness values (cm)
+    phi_matrix         : 2D numpy array
+                         dispersion angle matrix (rad), memory-mapped
+                         read-only when it is not resampled
+    
+    The function returns None if the archive has no phi matrix for these
+    parameters.
+    """
+    
+    try:
+        with open(archivePath + ".json") as indexFile:
+            entries = json.load(indexFile)["entries"]
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    
+    parameters = [ws1, ws2, r1, r2, d, wavelength]
+    for index, entry in enumerate(entries):
+        if np.allclose(parameters, [entry["ws1"], entry["ws2"], entry["r1"],
+            entry["r2"], entry["d"], entry["wavelength"]], rtol=1e-9, atol=0.0):
+            break
+    else:
+        return None
+    
+    archiveThickness = np.load(archivePath + ".thickness.npy")
+    if thickness_sampling is not None and not np.array_equal(thickness_sampling,
+        archiveThickness):
+        return None
+    
+    archiveQ = np.load(archivePath + ".Q.npy")
+    phi_matrix = np.load(archivePath + ".npy", mmap_mode="r")[index]
+    
+    if np.array_equal(Q, archiveQ):
+        return (archiveThickness, phi_matrix)
+    
+    two_theta = UtilityAnalysis.Qto2theta(Q, wavelength)
+    phi_two_theta = UtilityAnalysis.Qto2theta(archiveQ, wavelength)
+    if phi_two_theta[0] > np.amin(two_theta) or phi_two_theta[-1] < np.amax(two_theta):
+        return None
+    if calc_resample_error(phi_two_theta, phi_matrix) > maxResampleError:
+        return None
+    
+    return (archiveThickness, resample_phi_matrix(two_theta, phi_two_theta,
+        phi_matrix))
+
+
+def check_phi_matrix(Q, ws1, ws2, r1, r2, d, phiMatrixCalcFlag, phiMatrixPath,
+    cacheDir=None, cacheSize=2*1024**3, thickness_sampling=None,
+    maxResampleError=5e-3, archivePath=None, wavelength=0.03738):
     """Function to make or read from file the phi matrix.
+    If archivePath is given and the archive (calc_phi_archive) has the matrix
+    of this geometry and wavelength, it is read from there.
+    If cacheDir is given the matrix is read from the cache directory when it
+    was already calculated for the same geometry and Q grid; for another Q
+    grid a cached matrix of the same geometry is resampled when it is
+    accurate enough (find_phi_matrix), otherwise the matrix is calculated.
+    New matrices are added to the cache; phiMatrixCalcFlag and phiMatrixPath
+    are not used.
+    A matrix read from phiMatrixPath must have a row for each thickness value
+    and a column for each Q value, otherwise ValueError is raised.
 
     Parameters
     ----------
@@ -321,22 +948,85 @@ def check_phi_matrix(Q, ws1, ws2, r1, r2, d, phiMatrixCalcFlag, phiMatrixPath):
                         flag for the phi matrix calculation
     phiMatrixPath     : string
                         phi matrix path
+    cacheDir          : string
+                        phi matrix cache directory
+    cacheSize         : int
+                        maximum size of the cache directory (bytes)
+    thickness_sampling : numpy array
+                        array with the thickness values (cm), e.g. from
+                        calc_thickness_sampling, if None 1000 uniform values
+                        from 0 to 0.17 cm
+    maxResampleError  : float
+                        maximum relative error to resample a cached phi
+                        matrix, 0 to always calculate it
+    archivePath       : string
+                        phi matrix archive path without extension
+    wavelength        : float
+                        XRay beam wavelength (nm)
 
     Returns
     -------
-    phi_matrix        : 2D numpy array
-                        dispersion angle matrix for sample+DAC (rad)                     
+    thickness_sampling : numpy array
+                         array with the thickness values (cm)
+    phi_matrix         : 2D numpy array
+                         dispersion angle matrix for sample+DAC (rad),
+                         memory-mapped read-only, so the processes using the
+                         same file share its pages
     """
     
-    two_theta = UtilityAnalysis.Qto2theta(Q)
+    if archivePath is not None:
+        archiveMatrix = read_phi_archive(archivePath, ws1, ws2, r1, r2, d, Q,
+            wavelength, thickness_sampling, maxResampleError)
+        if archiveMatrix is not None:
+            return archiveMatrix
+    
+    two_theta = UtilityAnalysis.Qto2theta(Q, wavelength)
+    if thickness_sampling is None:
+        thickness_sampling = np.linspace(0, 0.17, num=1000)
+    
+    if cacheDir is not None:
+        name = phi_matrix_cacheName(two_theta, ws1, ws2, r1, r2, d,
+            thickness_sampling)
+        path = os.path.join(cacheDir, name + ".npy")
+        
+        phi_matrix = Cache.load_array(path)
+        if phi_matrix is None:
+            os.makedirs(cacheDir, exist_ok=True)
+            if maxResampleError > 0:
+                phi_matrix = find_phi_matrix(cacheDir, name, two_theta,
+                    maxResampleError)
+            Cache.save_array(os.path.join(cacheDir, name + ".two_theta.npy"),
+                two_theta)
+            Cache.save_array(os.path.join(cacheDir, name + ".thickness.npy"),
+                thickness_sampling)
+            if phi_matrix is not None:
+                Cache.save_array(path, phi_matrix)
+                phi_matrix = Cache.load_array(path)
+            else:
+                phi_matrix, tmpPath = Cache.create_array(path,
+                    (thickness_sampling.size, two_theta.size))
+                calc_phi_matrix(two_theta, ws1, ws2, r1, r2, d,
+                    thickness_sampling=thickness_sampling, out=phi_matrix)
+                phi_matrix = Cache.commit_array(path, phi_matrix, tmpPath)
+            Cache.evict_files(cacheDir, cacheSize, (name,))
+        
+        return (thickness_sampling, phi_matrix)
     
     if phiMatrixCalcFlag.lower() == "y": 
-        phi_matrix = calc_phi_matrix(two_theta, ws1, ws2, r1, r2, d)
-        np.save(phiMatrixPath, phi_matrix)
+        phi_matrix, tmpPath = Cache.create_array(phiMatrixPath,
+            (thickness_sampling.size, two_theta.size))
+        calc_phi_matrix(two_theta, ws1, ws2, r1, r2, d,
+            thickness_sampling=thickness_sampling, out=phi_matrix)
+        phi_matrix = Cache.commit_array(phiMatrixPath, phi_matrix, tmpPath)
     else:
-        phi_matrix = np.load(phiMatrixPath)
+        phi_matrix = np.load(phiMatrixPath, mmap_mode="r")
+        if phi_matrix.shape != (thickness_sampling.size, two_theta.size):
+            raise ValueError("the phi matrix in " + phiMatrixPath + " has shape " +
+                str(phi_matrix.shape) + " instead of " +
+                str((thickness_sampling.size, two_theta.size)) +
+                " (thickness values, Q values), calculate it again with " +
+                "phiMatrixCalcFlag = y")
     
-    thickness_sampling = np.linspace(0, 0.17, num=1000)
     return (thickness_sampling, phi_matrix)
 
 
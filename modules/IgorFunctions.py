@@ -45,6 +45,7 @@ from scipy import fftpack
 import math
 import matplotlib.pyplot as plt
 
+from modules import Cache
 # from modules import Formalism
 # from modules import Geometry
 # from modules import IgorFunctions
@@ -127,121 +128,249 @@ def calc_SQ(Q, Subt, alpha, fe_Q, J_Q, Ztot, Sinf, QmaxIntegrate):
     return S_Q
 
 
-def absorption(Q):
+# Absorption coefficient fit of the seat elements (muFunc coefficients) and
+# seat composition (c), the first element is the diamond
+SeatAbs_c = np.array([0,0.997566,0.0,0.0,0.00107,0.000126,0.00044,
+    4.6E-05,2E-05,7.1E-05,4.9E-05,6.6E-05,0.000335,3.2E-06,
+    2.9E-05,3.4E-05,1.5E-05,0.0,1.9E-06,1.7E-05,9.4E-05,5E-06,1.2E-05,0])
+
+SeatAbs_x0 = np.array([2.3518,1.0,1.0,10.32,10.32,10.32,10.32,
+    10.32,10.32,10.32,10.32,10.32,10.32,10.32,10.32,10.32,10.32,
+    10.5744,16.1851,18.0876,13.477,15.1361,15.9401,1.0])
+
+SeatAbs_y0 = np.array([0.16609,0.016509,0.0360423,0.0,0.0,0.0,
+    0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,9.7903,
+    -4.87898,0.0,3.76538,-5.24716,0.0360423])
+
+SeatAbs_A1 = np.array([0.40924,0.0,0.0,3.14791,11.8267,14.8745,
+    14.8745,50.7179,53.929,63.2412,82.8997,92.8759,102.418,103.483,
+    115.173,126.886,132.891,118.909,74.5406,53.752,105.304,96.6244,
+    89.9649,0.0])
+
+SeatAbs_A2 = np.array([5.8379,0.0,0.0,1.68147,6.01518,7.54942,
+    7.54942,32.0789,34.5927,36.0429,42.4638,43.5787,51.3385,
+    63.0198,75.1925,68.467,79.5591,91.9556,24.7572,44.489,
+    69.6294,58.604,62.8023,0.0])
+
+SeatAbs_t1 = np.array([16.73,1.0,1.0,2.55004,2.67334,2.69543,
+    2.69543,2.73906,2.72493,2.80362,2.9916,3.11676,3.0976,2.94736,
+    2.86549,3.16199,3.08399,2.83517,6.64092,4.76416,3.87274,10.048,
+    4.58574,1.0])
+
+SeatAbs_t2 = np.array([4.6014,1.0,1.0,8.26453,8.92972,9.0562,9.0562,
+    9.00571,9.07263,9.55472,9.97426,10.4699,10.3523,9.72451,9.59644,
+    10.3455,10.0967,9.55927,4.76267,20.1567,13.2047,3.39669,18.6351,
+    1.0])
+
+# Absorption corrections already calculated, see AbsorptionModel.absorption
+absorptionCache = Cache.LRUCache(16)
+
+
+class AbsorptionModel(object):
+    """Absorption correction of the diamond and of the seat with Igor formula.
+    The corrections are kept in absorptionCache, keyed by the model
+    parameters and the Q grid, so they are calculated once for each Q grid.
+    """
+    
+    def __init__(self, Lambda=0.03778, energy=33.1952, xD=0.0, eD=0.17,
+        BRad=1.2, eDAC=1.25, Gasket=0.00525, InnerAperature=0.31,
+        OuterAperature=1.639, DACAperature=1.639, rhoD=3.5155, rhoB=2.34,
+        alphaDAC=0.8, seatComposition=None, muB=0.0):
+        """
+        Parameters
+        ----------
+        Lambda          : float
+                          XRay beam wavelength (nm)
+        energy          : float
+                          XRay beam energy (keV) for the absorption
+                          coefficients
+        xD              : float
+                          sample position (cm)
+        eD              : float
+                          diamond thickness (cm)
+        BRad            : float
+                          seat radius (cm)
+        eDAC            : float
+                          DAC thickness (cm)
+        Gasket          : float
+                          gasket thickness (cm)
+        InnerAperature  : float
+                          inner seat aperture (cm)
+        OuterAperature  : float
+                          outer seat aperture (cm)
+        DACAperature    : float
+                          DAC aperture (cm)
+        rhoD            : float
+                          diamond density (g/cm^3)
+        rhoB            : float
+                          seat density (g/cm^3)
+        alphaDAC        : float
+                          DAC absorption coefficient (cm^-1)
+        seatComposition : numpy array
+                          mass fraction of the SeatAbs elements in the seat,
+                          if None SeatAbs_c
+        muB             : float
+                          seat mass absorption coefficient (cm^2/g), if 0 it
+                          is calculated from seatComposition
+        """
+        
+        self.Lambda = Lambda
+        self.energy = energy
+        self.xD = xD
+        self.eD = eD
+        self.BRad = BRad
+        self.eDAC = eDAC
+        self.Gasket = Gasket
+        self.InnerAperature = InnerAperature
+        self.OuterAperature = OuterAperature
+        self.DACAperature = DACAperature
+        self.rhoD = rhoD
+        self.rhoB = rhoB
+        self.alphaDAC = alphaDAC
+        
+        if seatComposition is None:
+            seatComposition = SeatAbs_c
+        self.seatComposition = np.asarray(seatComposition, dtype=float)
+        
+        mu = muFunc(SeatAbs_y0, SeatAbs_x0, SeatAbs_A1, SeatAbs_t1, SeatAbs_A2,
+            SeatAbs_t2, energy)
+        self.muD = mu[0]
+        if muB == 0.0:
+            muB = np.sum(self.seatComposition * mu)
+        self.muB = muB
+        
+        self.key = Cache.hash_values(Lambda, energy, xD, eD, BRad, eDAC, Gasket,
+            InnerAperature, OuterAperature, DACAperature, rhoD, rhoB, alphaDAC,
+            self.seatComposition, muB)
+    
+    def absorption(self, Q):
+        """Function to return the absorption correction, it is calculated with
+        calc_absorption only the first time for a Q grid.
+
+        Parameters
+        ----------
+        Q          : numpy array
+                     momentum transfer (nm^-1)
+
+        Returns
+        -------
+        AbsRefCalc : numpy array
+                     absorption correction factor
+        """
+        
+        key = (self.key, Cache.hash_values(Q))
+        AbsRefCalc = absorptionCache.get(key)
+        if AbsRefCalc is None:
+            AbsRefCalc = self.calc_absorption(Q)
+            absorptionCache.put(key, AbsRefCalc)
+        
+        return AbsRefCalc.copy()
+    
+    def calc_absorption(self, Q):
+        """Function to calculate the absorption correction.
+
+        Parameters
+        ----------
+        Q          : numpy array
+                     momentum transfer (nm^-1)
+
+        Returns
+        -------
+        AbsRefCalc : numpy array
+                     absorption correction factor
+        """
+        
+        xD = self.xD
+        Lambda = self.Lambda
+        eD = self.eD
+        BRad = self.BRad
+        eDAC = self.eDAC
+        muD = self.muD
+        muB = self.muB
+        rhoD = self.rhoD
+        rhoB = self.rhoB
+        alphaDAC = self.alphaDAC
+        
+        yA=self.InnerAperature/2
+        xA=eD-xD
+        Theta1=np.arctan(yA/xA)
+        Q1=4*np.pi/Lambda*np.sin(Theta1/2)
+        yB=self.OuterAperature/2
+        xB=(BRad**2-yB**2)**0.5-xD
+        Theta2=np.arctan(yB/xB)
+        Q2=4*np.pi/Lambda*np.sin(Theta2/2)
+        yG=self.DACAperature/2
+        xG=(BRad**2-yG**2)**0.5-xD
+        ThetaDAC=np.arctan(yG/xG)
+        QDAC=4*np.pi/Lambda*np.sin(ThetaDAC/2)
+        yH=self.Gasket/2
+        xH=-xD
+        if xH==0.0:
+            ThetaGasket=np.pi/2
+        elif xH<0.0:
+            ThetaGasket=np.arctan(yH/xH)+np.pi
+        else:
+            ThetaGasket=np.arctan(yH/xH)
+        QGasket=4*np.pi/Lambda*np.sin(ThetaGasket/2)
+        m=(yB-yA)/(xB-xA)
+        
+        Theta=2*np.arcsin(Lambda*Q/(4*np.pi))
+        dOI=xA/np.cos(Theta)
+        dOJ=((yA-m*xA)/(np.tan(Theta)-m))/np.cos(Theta)
+        dOF=(BRad**2-xD**2*np.sin(Theta))**0.5-xD*np.cos(Theta)
+        dOG=(eDAC-xD)/np.cos(Theta)
+        
+        AbsRefCalc = np.zeros(len(Q))
+        
+        if (Theta1<=Theta2):
+            AbsRefCalc[Q<=Q1] = np.exp(-muD*rhoD*dOI[Q<=Q1])
+            AbsRefCalc[(Q>Q1) & (Q<=Q2)] += np.exp(-(muD*rhoD*dOI[(Q>Q1) & (Q<=Q2)]
+                +muB*rhoB*(dOJ[(Q>Q1) & (Q<=Q2)]-dOI[(Q>Q1) & (Q<=Q2)])))
+            AbsRefCalc[(Q>Q2) & (Q<=QDAC)] += np.exp(-(muD*rhoD*dOI[(Q>Q2) & (Q<=QDAC)]
+                +muB*rhoB*(dOF[(Q>Q2) & (Q<=QDAC)]-dOI[(Q>Q2) & (Q<=QDAC)])))
+            AbsRefCalc[Q>QDAC] += np.exp(-(muD*rhoD*dOI[Q>QDAC]+muB*rhoB*(dOF[Q>QDAC]
+                -dOI[Q>QDAC])+alphaDAC*(dOG[Q>QDAC]-dOF[Q>QDAC])))
+            AbsRefCalc[Q<QGasket]*=1
+        else:
+            AbsRefCalc[Q<=Q2] = np.exp(-muD*rhoD*dOI[Q<=Q2])
+            AbsRefCalc[(Q>Q2) & (Q<=Q1)] += np.exp(-(muD*rhoD*dOI[(Q>Q2) & (Q<=Q1)]
+                +muB*rhoB*(dOF[(Q>Q2) & (Q<=Q1)]-dOJ[(Q>Q2) & (Q<=Q1)])))
+            AbsRefCalc[(Q>Q1) & (Q<=QDAC)] += np.exp(-(muD*rhoD*dOI[(Q>Q1) & (Q<=QDAC)]
+                +muB*rhoB*(dOF[(Q>Q1) & (Q<=QDAC)]-dOI[(Q>Q1) & (Q<=QDAC)])))
+            AbsRefCalc[Q>QDAC] += np.exp(-(muD*rhoD*dOI[Q>QDAC]
+                +muB*rhoB*(dOF[Q>QDAC]-dOI[Q>QDAC])+alphaDAC*(dOG[Q>QDAC]-dOF[Q>QDAC])))
+            AbsRefCalc[Q<QGasket]*=1
+        
+        return AbsRefCalc
+
+
+def absorption(Q, model=None):
     """Function to calculate the absorption correction with Igor formula.
+    The correction is cached (AbsorptionModel.absorption).
+    
+    Parameters
+    ----------
+    Q          : numpy array
+                 momentum transfer (nm^-1)
+    model      : AbsorptionModel
+                 absorption model, if None the default DAC geometry
+    
+    Returns
+    -------
+    AbsRefCalc : numpy array
+                 absorption correction factor
     """
     
-    xD=0.0
-    Lambda=0.03778
-    eD=0.17
-    BRad=1.2
-    eDAC=1.25
-    Gasket=0.00525
-    InnerAperature=0.31
-    OuterAperature=1.639
-    DACAperature=1.639
-    muB=0.0
-    
-    SeatAbs_c = np.array([0,0.997566,0.0,0.0,0.00107,0.000126,0.00044,
-        4.6E-05,2E-05,7.1E-05,4.9E-05,6.6E-05,0.000335,3.2E-06,
-        2.9E-05,3.4E-05,1.5E-05,0.0,1.9E-06,1.7E-05,9.4E-05,5E-06,1.2E-05,0])
-
-    SeatAbs_x0 = np.array([2.3518,1.0,1.0,10.32,10.32,10.32,10.32,
-        10.32,10.32,10.32,10.32,10.32,10.32,10.32,10.32,10.32,10.32,
-        10.5744,16.1851,18.0876,13.477,15.1361,15.9401,1.0])
-
-    SeatAbs_y0 = np.array([0.16609,0.016509,0.0360423,0.0,0.0,0.0,
-        0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,9.7903,
-        -4.87898,0.0,3.76538,-5.24716,0.0360423])
-    
-    SeatAbs_A1 = np.array([0.40924,0.0,0.0,3.14791,11.8267,14.8745,
-        14.8745,50.7179,53.929,63.2412,82.8997,92.8759,102.418,103.483,
-        115.173,126.886,132.891,118.909,74.5406,53.752,105.304,96.6244,
-        89.9649,0.0])
-
-    SeatAbs_A2 = np.array([5.8379,0.0,0.0,1.68147,6.01518,7.54942,
-        7.54942,32.0789,34.5927,36.0429,42.4638,43.5787,51.3385,
-        63.0198,75.1925,68.467,79.5591,91.9556,24.7572,44.489,
-        69.6294,58.604,62.8023,0.0])
-
-    SeatAbs_t1 = np.array([16.73,1.0,1.0,2.55004,2.67334,2.69543,
-        2.69543,2.73906,2.72493,2.80362,2.9916,3.11676,3.0976,2.94736,
-        2.86549,3.16199,3.08399,2.83517,6.64092,4.76416,3.87274,10.048,
-        4.58574,1.0])
-
-    SeatAbs_t2 = np.array([4.6014,1.0,1.0,8.26453,8.92972,9.0562,9.0562,
-        9.00571,9.07263,9.55472,9.97426,10.4699,10.3523,9.72451,9.59644,
-        10.3455,10.0967,9.55927,4.76267,20.1567,13.2047,3.39669,18.6351,
-        1.0])
-
-    # muB=0.0230077
-    if muB==0.0:
-        for i in range(len(SeatAbs_y0)):
-            muB += SeatAbs_c[i] * muFunc(SeatAbs_y0[i],SeatAbs_x0[i],SeatAbs_A1[i],
-                SeatAbs_t1[i],SeatAbs_A2[i],SeatAbs_t2[i])
-    
-    
-    yA=InnerAperature/2
-    xA=eD-xD
-    Theta1=np.arctan(yA/xA)
-    Q1=4*np.pi/Lambda*np.sin(Theta1/2)
-    yB=OuterAperature/2
-    xB=(BRad**2-yB**2)**0.5-xD
-    Theta2=np.arctan(yB/xB)
-    Q2=4*np.pi/Lambda*np.sin(Theta2/2)
-    yG=DACAperature/2
-    xG=(BRad**2-yG**2)**0.5-xD
-    ThetaDAC=np.arctan(yG/xG)
-    QDAC=4*np.pi/Lambda*np.sin(ThetaDAC/2)
-    yH=Gasket/2
-    xH=-xD
-    if xH==0.0:
-        ThetaGasket=np.pi/2
-    elif xH<0.0:
-        ThetaGasket=np.arctan(yH/xH)+np.pi
-    else:
-        ThetaGasket=np.arctan(yH/xH)
-    QGasket=4*np.pi/Lambda*np.sin(ThetaGasket/2)
-    m=(yB-yA)/(xB-xA)
-    rhoD=3.5155
-    muD=muFunc(SeatAbs_y0[0],SeatAbs_x0[0],SeatAbs_A1[0],SeatAbs_t1[0],SeatAbs_A2[0],SeatAbs_t2[0])
-    rhoB=2.34
-    alphaDAC=0.8
-    
-    Theta=2*np.arcsin(Lambda*Q/(4*np.pi))
-    dOI=xA/np.cos(Theta)
-    dOJ=((yA-m*xA)/(np.tan(Theta)-m))/np.cos(Theta)
-    dOF=(BRad**2-xD**2*np.sin(Theta))**0.5-xD*np.cos(Theta)
-    dOG=(eDAC-xD)/np.cos(Theta)
-    
-    AbsRefCalc = np.zeros(len(Q))
-    
-    if (Theta1<=Theta2):
-        AbsRefCalc[Q<=Q1] = np.exp(-muD*rhoD*dOI[Q<=Q1])
-        AbsRefCalc[(Q>Q1) & (Q<=Q2)] += np.exp(-(muD*rhoD*dOI[(Q>Q1) & (Q<=Q2)]
-            +muB*rhoB*(dOJ[(Q>Q1) & (Q<=Q2)]-dOI[(Q>Q1) & (Q<=Q2)])))
-        AbsRefCalc[(Q>Q2) & (Q<=QDAC)] += np.exp(-(muD*rhoD*dOI[(Q>Q2) & (Q<=QDAC)]
-            +muB*rhoB*(dOF[(Q>Q2) & (Q<=QDAC)]-dOI[(Q>Q2) & (Q<=QDAC)])))
-        AbsRefCalc[Q>QDAC] += np.exp(-(muD*rhoD*dOI[Q>QDAC]+muB*rhoB*(dOF[Q>QDAC]
-            -dOI[Q>QDAC])+alphaDAC*(dOG[Q>QDAC]-dOF[Q>QDAC])))
-        AbsRefCalc[Q<QGasket]*=1
-    else:
-        AbsRefCalc[Q<=Q2] = np.exp(-muD*rhoD*dOI[Q<=Q2])
-        AbsRefCalc[(Q>Q2) & (Q<=Q1)] += np.exp(-(muD*rhoD*dOI[(Q>Q2) & (Q<=Q1)]
-            +muB*rhoB*(dOF[(Q>Q2) & (Q<=Q1)]-dOJ[(Q>Q2) & (Q<=Q1)])))
-        AbsRefCalc[(Q>Q1) & (Q<=QDAC)] += np.exp(-(muD*rhoD*dOI[(Q>Q1) & (Q<=QDAC)]
-            +muB*rhoB*(dOF[(Q>Q1) & (Q<=QDAC)]-dOI[(Q>Q1) & (Q<=QDAC)])))
-        AbsRefCalc[Q>QDAC] += np.exp(-(muD*rhoD*dOI[Q>QDAC]
-            +muB*rhoB*(dOF[Q>QDAC]-dOI[Q>QDAC])+alphaDAC*(dOG[Q>QDAC]-dOF[Q>QDAC])))
-        AbsRefCalc[Q<QGasket]*=1
+    if model is None:
+        model = AbsorptionModel()
     
-    return AbsRefCalc
+    return model.absorption(Q)
 
 
-def muFunc(y0,x0,A1,t1,A2,t2):
-    """absorption coefficient function"""
+def muFunc(y0,x0,A1,t1,A2,t2,x=33.1952):
+    """absorption coefficient function, the coefficients can be arrays
+    x is the x-ray energy (kev)"""
     
-    x = 33.1952 #x-ray energy (kev)
     mu = y0 + A1*np.exp(-(x-x0)/t1) + A2*np.exp(-(x-x0)/t2) 
     return mu
 
@@ -46,8 +46,12 @@ from modules import UtilityAnalysis
 def Kaplow_method(Q, I_Q, Ibkg_Q, J_Q, fe_Q, Iincoh_Q,
     Sinf, Ztot, scaleFactor, density, Fintra_r, r,
     minQ, QmaxIntegrate, maxQ, smoothFactor, dampFactor, iteration,
-    rmin):
+    rmin, context=None):
     """Function to apply the Kaplow method.
+    With a context (Context.SampleContext) its precomputed arrays, Q ranges
+    and settings are used, only I_Q, Ibkg_Q, scaleFactor, density and
+    Fintra_r (on context.r) are read from the arguments; the other arguments
+    which are not None must be the same of the context.
 
     Parameters
     ----------
@@ -77,6 +81,8 @@ def Kaplow_method(Q, I_Q, Ibkg_Q, J_Q, fe_Q, Iincoh_Q,
                     intramolecular contribution of F(r)
     r             : numpy array
                     atomic distance (nm)
+    context       : Context.SampleContext
+                    context of the dataset
 
     Returns
     -------
@@ -88,6 +94,33 @@ def Kaplow_method(Q, I_Q, Ibkg_Q, J_Q, fe_Q, Iincoh_Q,
                     optimized F(r)
     """
 
+    if context is not None:
+        context.check_arguments(Q, J_Q, Iincoh_Q, fe_Q, minQ, QmaxIntegrate, maxQ,
+            Ztot, Sinf, smoothFactor, rmin, iterations=iteration)
+        intSlice = context.intSlice
+        Isample_Q = MainFunctions.calc_IsampleQ(I_Q, scaleFactor, Ibkg_Q)
+        alpha = MainFunctions.calc_alpha(context.J_Qint, context.Sinf,
+            context.Q_int, Isample_Q[intSlice], context.fe_Qint, context.Ztot,
+            density)
+        Icoh_Q = MainFunctions.calc_Icoh(alpha, Isample_Q, context.Iincoh_Q)
+
+        S_Q = context.calc_SQ(Icoh_Q)
+        Ssmooth_Q = context.calc_SQsmoothing(S_Q)
+        SsmoothDamp_Q = UtilityAnalysis.calc_SQdamp(Ssmooth_Q, context.Sinf,
+            context.dampingFunction)
+
+        i_Q = MainFunctions.calc_iQ(SsmoothDamp_Q, context.Sinf)[intSlice]
+        F_r = context.calc_Fr(context.Q_int*i_Q)
+
+        Fopt_r, deltaFopt_r = Optimization.calc_optimize_Fr(context.iterations,
+            F_r, Fintra_r, density, i_Q, context.Q_int, context.Sinf,
+            context.J_Qint, context.r, context.rmin, "n", context.engine, context)
+
+        rInt = context.r[context.rminSlice]
+        chi2 = simps(deltaFopt_r[context.rminSlice]**2, rInt)
+
+        return (chi2, SsmoothDamp_Q, F_r, Fopt_r)
+
     Isample_Q = MainFunctions.calc_IsampleQ(I_Q, scaleFactor, Ibkg_Q)
     alpha = MainFunctions.calc_alpha(J_Q[Q<=QmaxIntegrate], Sinf,
         Q[Q<=QmaxIntegrate], Isample_Q[Q<=QmaxIntegrate],
@@ -39,12 +39,87 @@ otherwise it is symbolized with just its name.
 
 import numpy as np
 from scipy import fftpack
-from scipy.integrate import simps
+from scipy import interpolate
 import math
 
+from modules import Cache
 from modules import Utility
 from modules import UtilityAnalysis
 
+# Atomic form factors already calculated, see calc_affTable
+affCache = Cache.LRUCache(64)
+
+# Simpson's weights already calculated, see get_simpsWeights
+weightsCache = Cache.LRUCache(64)
+
+
+def make_parameterTable(elements, elementParameters):
+    """Function to make the array of the parameters of a list of elements.
+    
+    Parameters
+    ----------
+    elements          : list
+                        chemical elements
+    elementParameters : dictionary("element": parameters)
+                        chemical elements of the sample with their parameters
+                        element    : string
+                                     chemical element
+                        parameters : list
+                                     list of the parameters
+                                     (Z, a1, b1, a2, b2, a3, b3, a4, b4, c, M, K, L)
+    
+    Returns
+    -------
+    parameterTable    : 2D numpy array
+                        parameters of the elements (elements x 13), a row for
+                        each element
+    """
+    
+    return np.array([elementParameters[element][0:13] for element in elements],
+        dtype=float)
+
+
+def calc_affTable(elements, Q, elementParameters):
+    """Function to calculate the Atomic Form Factors of a list of elements in
+    one vectorized call (see calc_aff).
+    The form factors are kept in affCache, keyed by the elements, their
+    parameters and the Q grid, so they are calculated once for each Q grid.
+    
+    Parameters
+    ----------
+    elements          : list
+                        chemical elements
+    Q                 : numpy array
+                        momentum transfer (nm^-1)
+    elementParameters : dictionary("element": parameters)
+                        chemical elements of the sample with their parameters
+    
+    Returns
+    -------
+    affTable          : 2D numpy array
+                        atomic form factors (elements x Q), a row for each
+                        element, read-only
+    """
+    
+    elements = tuple(elements)
+    parameterTable = make_parameterTable(elements, elementParameters)
+    key = Cache.hash_values(elements, parameterTable, Q)
+    affTable = affCache.get(key)
+    if affTable is None:
+        a = parameterTable[:, 1:9:2, np.newaxis]
+        b = parameterTable[:, 2:9:2, np.newaxis]
+        s2 = (np.asarray(Q)/(4*10*np.pi))**2
+        
+        affTable = np.zeros((len(elements), np.size(Q)))
+        for i in range(4):
+            affTable += a[:, i] * np.exp(-b[:, i] * s2)
+        affTable += parameterTable[:, 9, np.newaxis]
+        
+        affTable.flags.writeable = False
+        affCache.put(key, affTable)
+    
+    return affTable
+
 
 def calc_aff(element, Q, elementParameters):
     """Function to calculate the Atomic Form Factor.
@@ -74,24 +149,7 @@ def calc_aff(element, Q, elementParameters):
                        atomic form factor
     """
     
-    for elementDict, paramList in elementParameters.items():
-        if elementDict == element:
-            a1 = paramList[1]
-            b1 = paramList[2]
-            a2 = paramList[3]
-            b2 = paramList[4]
-            a3 = paramList[5]
-            b3 = paramList[6]
-            a4 = paramList[7]
-            b4 = paramList[8]
-            c = paramList[9]
-    
-    f1_Q = a1 * np.exp(-b1 * (Q/(4*10*np.pi))**2)
-    f2_Q = a2 * np.exp(-b2 * (Q/(4*10*np.pi))**2)
-    f3_Q = a3 * np.exp(-b3 * (Q/(4*10*np.pi))**2)
-    f4_Q = a4 * np.exp(-b4 * (Q/(4*10*np.pi))**2)
-    
-    f_Q = f1_Q + f2_Q + f3_Q + f4_Q + c
+    f_Q = np.array(calc_affTable([element], Q, elementParameters)[0])
     
     return f_Q
 
@@ -125,14 +183,14 @@ def calc_eeff(elementList, Q, elementParameters):
                         total Z number
     """
     
+    affTable = calc_affTable(elementList.keys(), Q, elementParameters)
+    
     fe_Q = np.zeros(Q.size)
     Ztot = 0
     
-    for element, multiplicity in elementList.items():
-        for elementDict, paramList in elementParameters.items():
-            if elementDict == element:
-                Ztot += multiplicity * paramList[0]
-        fe_Q += multiplicity * calc_aff(element, Q, elementParameters)
+    for i, (element, multiplicity) in enumerate(elementList.items()):
+        Ztot += multiplicity * elementParameters[element][0]
+        fe_Q += multiplicity * affTable[i]
     
     fe_Q /= Ztot
     
@@ -174,18 +232,13 @@ def calc_Iincoh(elementList, Q, elementParameters):
                        incoherent scattering intensity
     """
     
+    affTable = calc_affTable(elementList.keys(), Q, elementParameters)
+    
     Iincoh_Q = np.zeros(Q.size)
     
-    for element, multiplicity in elementList.items():
-        aff = calc_aff(element, Q, elementParameters)
-        
-        for elementDict, paramList in elementParameters.items():
-            if elementDict == element:
-                Z = paramList[0]
-                M = paramList[10]
-                K = paramList[11]
-                L = paramList[12]
-                break
+    for i, (element, multiplicity) in enumerate(elementList.items()):
+        aff = affTable[i]
+        Z, M, K, L = (elementParameters[element][j] for j in (0, 10, 11, 12))
         
         if Z >= 37:
             Iincoh_Q += multiplicity * (Z*(1 - M/(1+K*Q)**L))
@@ -284,10 +337,12 @@ def calc_Sinf(elementList, fe_Q, Q, Ztot, elementParameters):
                         value of S(Q) for Q->inf
     """
     
+    affTable = calc_affTable(elementList.keys(), Q, elementParameters)
+    
     sum_Kp2 = 0
 
-    for element, multiplicity in elementList.items():
-        sum_Kp2 += multiplicity * calc_Kp(fe_Q, element, Q, elementParameters)**2
+    for i, multiplicity in enumerate(elementList.values()):
+        sum_Kp2 += multiplicity * np.mean(affTable[i]/fe_Q)**2
 
     Sinf = sum_Kp2 / Ztot**2
 
@@ -319,6 +374,9 @@ def calc_IsampleQ(I_Q, scaleFactor, Ibkg_Q):
 
 def calc_alpha(J_Q, Sinf, Q, Isample_Q, fe_Q, Ztot, density):
     """Function to calculate the normalization factor alpha (eq. 34).
+    The integrals are dot products with the Simpson's weights of Q
+    (get_simpsWeights), so for a 2D Isample_Q (samples x Q) all the samples
+    are integrated with one matrix-vector product.
     
     Parameters
     ----------
@@ -343,8 +401,9 @@ def calc_alpha(J_Q, Sinf, Q, Isample_Q, fe_Q, Ztot, density):
                 normalization factor
     """
     
-    Integral1 = simps((J_Q + Sinf) * Q**2, Q)
-    Integral2 = simps((Isample_Q/fe_Q**2) * Q**2, Q)
+    weights = get_simpsWeights(Q)
+    Integral1 = np.dot((J_Q + Sinf) * Q**2, weights)
+    Integral2 = np.dot((Isample_Q/fe_Q**2) * Q**2, weights)
     alpha = Ztot**2 * (((-2*np.pi**2*density) + Integral1) / Integral2)
     
     return alpha
@@ -401,10 +460,10 @@ def calc_SQ(Icoh_Q, Ztot, fe_Q, Sinf, Q, minQ, QmaxIntegrate, maxQ):
                     structure factor
     """
     
-    S_Q = np.zeros(Q.size)
-    S_Q[(Q > minQ) & (Q <= QmaxIntegrate)] = Icoh_Q[(Q > minQ) & (Q <= QmaxIntegrate)] \
+    S_Q = np.zeros(Icoh_Q.shape)
+    S_Q[..., (Q > minQ) & (Q <= QmaxIntegrate)] = Icoh_Q[..., (Q > minQ) & (Q <= QmaxIntegrate)] \
         / (Ztot**2 * fe_Q[(Q > minQ) & (Q <= QmaxIntegrate)]**2)
-    S_Q[Q > QmaxIntegrate] = Sinf
+    S_Q[..., Q > QmaxIntegrate] = Sinf
     
     return S_Q
 
@@ -474,61 +533,280 @@ def calc_r(Q):
     return r[mask]
 
 
-def calc_Fr(Q, Qi_Q):
+def calc_simpsWeights(numPoints, dx):
+    """Function to calculate the weights of the Simpson's rule on an evenly
+    spaced grid.
+    The weights reproduce scipy.integrate.simps with its default even="avg":
+    with an even number of points the result is the average of the two rules
+    with the trapezoidal correction on the first and on the last interval.
+    
+    Parameters
+    ----------
+    numPoints : int
+                number of points of the grid
+    dx        : float
+                grid step
+    
+    Returns
+    -------
+    weights   : numpy array
+                Simpson's weights, simps(f_x, x) == np.sum(weights*f_x)
+    """
+    
+    def simpsOdd(num):
+        w = np.zeros(num)
+        if num >= 3:
+            w[0:-1:2] += 1.0
+            w[1::2] += 4.0
+            w[2::2] += 1.0
+        return w / 3.0
+    
+    if numPoints % 2 == 1:
+        weights = simpsOdd(numPoints)
+    else:
+        first = np.zeros(numPoints)
+        first[:-1] = simpsOdd(numPoints-1)
+        first[-2:] += 0.5
+        last = np.zeros(numPoints)
+        last[1:] = simpsOdd(numPoints-1)
+        last[:2] += 0.5
+        weights = (first + last) / 2.0
+    
+    return weights * dx
+
+
+def calc_simpsWeightsGrid(x, even="avg"):
+    """Function to calculate the weights of the Simpson's rule on the grid x,
+    also non-uniform, as scipy.integrate.simps(f_x, x, even=even).
+    With an even number of points "first" uses the trapezoidal rule on the
+    last interval, "last" on the first one, and "avg" averages the two.
+    
+    Parameters
+    ----------
+    x       : numpy array
+              grid
+    even    : string
+              rule for an even number of points: "avg", "first" or "last"
+    
+    Returns
+    -------
+    weights : numpy array
+              Simpson's weights, simps(f_x, x, even=even) == np.dot(f_x, weights)
+    """
+    
+    def simpsOdd(x):
+        w = np.zeros(x.size)
+        if x.size >= 3:
+            h = np.diff(x)
+            h0 = h[0::2]
+            h1 = h[1::2]
+            hsum = h0 + h1
+            w[0:-1:2] += hsum/6.0 * (2 - h1/h0)
+            w[1::2] += hsum/6.0 * hsum*hsum/(h0*h1)
+            w[2::2] += hsum/6.0 * (2 - h0/h1)
+        return w
+    
+    x = np.asarray(x, dtype=float)
+    if x.size % 2 == 1:
+        return simpsOdd(x)
+    
+    first = np.zeros(x.size)
+    first[:-1] = simpsOdd(x[:-1])
+    first[-2:] += 0.5*(x[-1] - x[-2])
+    if even == "first":
+        return first
+    
+    last = np.zeros(x.size)
+    last[1:] = simpsOdd(x[1:])
+    last[:2] += 0.5*(x[1] - x[0])
+    if even == "last":
+        return last
+    
+    return (first + last) / 2.0
+
+
+def get_simpsWeights(x, even="avg"):
+    """Function to return the Simpson's weights of the grid x
+    (calc_simpsWeightsGrid).
+    The weights are kept in weightsCache, keyed by the grid and even, so they
+    are calculated once for each grid.
+    
+    Parameters
+    ----------
+    x       : numpy array
+              grid
+    even    : string
+              rule for an even number of points: "avg", "first" or "last"
+    
+    Returns
+    -------
+    weights : numpy array
+              Simpson's weights, read-only
+    """
+    
+    key = (even, Cache.hash_values(np.asarray(x, dtype=float)))
+    weights = weightsCache.get(key)
+    if weights is None:
+        weights = calc_simpsWeightsGrid(x, even)
+        weights.flags.writeable = False
+        weightsCache.put(key, weights)
+    
+    return weights
+
+
+def calc_sinTransform(f_x, x0, dx, y0, dy, numPoints):
+    """Function to calculate the sine sum
+    f_y[k] = sum_j f_x[j] * sin((y0 + k*dy) * (x0 + j*dx))
+    with the chirp-z (Bluestein) algorithm.
+    The sum is rewritten as a convolution evaluated with the FFT, so the cost is
+    O(N log N) instead of the O(N^2) of the dense sin(outer(y, x)) matrix.
+    The grids do not need to be commensurate, as it is required by the DST.
+    
+    Parameters
+    ----------
+    f_x       : numpy array
+                function to transform, the transform acts on the last axis
+    x0        : float
+                first point of the evenly spaced x grid
+    dx        : float
+                x grid step
+    y0        : float
+                first point of the evenly spaced y grid
+    dy        : float
+                y grid step
+    numPoints : int
+                number of points of the y grid
+    
+    Returns
+    -------
+    f_y       : numpy array
+                sine transform of f_x on the y grid
+    """
+    
+    N = f_x.shape[-1]
+    M = numPoints
+    beta = dx * dy
+    
+    j = np.arange(N)
+    k = np.arange(M)
+    m = np.arange(-(N-1), M)
+    
+    L = 2**int(math.ceil(math.log(N+M-1)/math.log(2)))
+    
+    a_x = f_x * np.exp(1j * (y0*dx*j + beta*j**2/2))
+    chirp = np.exp(-1j * beta*m**2/2)
+    conv = fftpack.ifft(fftpack.fft(a_x, L) * fftpack.fft(chirp, L))[..., N-1:N-1+M]
+    
+    f_y = np.imag(np.exp(1j * (x0*y0 + x0*dy*k + beta*k**2/2)) * conv)
+    
+    return f_y
+
+
+def calc_Fr(Q, Qi_Q, engine="simps"):
     """Function to calculate F(r) (eq. 20) with the FFT.
+    The "simps" engine multiplies the dense sin(rQ) matrix by Qi(Q) times the
+    Simpson's weights of Q (get_simpsWeights).
+    The "fft" engine evaluates the same Simpson's sum with the chirp-z FFT
+    (calc_sinTransform) in O(N log N): the Simpson's weights carry the endpoint
+    correction, so the two engines differ only for rounding errors (below 1e-13
+    relative to the maximum of |F(r)|, 2e-14 with 10000 Q points, see
+    LASDiABenchmark.bench_Fr).
+    The "fft" engine requires an evenly spaced Q grid.
+    Qi_Q can be a 2D array (samples x Q), in this case F(r) is calculated for
+    each row.
 
     Parameters
     ----------
-    Q    : numpy array
-           momentum transfer (nm^-1)
-    Qi_Q : numpy array
-           Qi(Q)
+    Q      : numpy array
+             momentum transfer (nm^-1)
+    Qi_Q   : numpy array
+             Qi(Q)
+    engine : string
+             engine for the sine transform: "simps" or "fft"
     
     Returns
     -------
-    r    : numpy array
-           atomic distance (nm)
-    F_r  : numpy array
-           F(r) distribution function
+    r      : numpy array
+             atomic distance (nm)
+    F_r    : numpy array
+             F(r) distribution function
     """
 
     meanDeltaQ = np.mean(np.diff(Q))
     r = fftpack.fftfreq(Q.size, meanDeltaQ)
     mask = np.where(r>=0)
     
-    rQ = np.outer(r[mask], Q)
-    sinrQ = np.sin(rQ)
-    
-    F_r = (2.0 / np.pi) * simps(Qi_Q * sinrQ, Q)
+    if engine.lower() == "fft":
+        weights = calc_simpsWeights(Q.size, meanDeltaQ)
+        F_r = (2.0 / np.pi) * calc_sinTransform(Qi_Q * weights, Q[0],
+            meanDeltaQ, 0.0, r[1], r[mask].size)
+    else:
+        weights = get_simpsWeights(Q)
+        sinrQ = np.sin(np.outer(r[mask], Q))
+        F_r = (2.0 / np.pi) * np.dot(Qi_Q * weights, sinrQ.T)
     
     return (r[mask], F_r)
     
-def calc_SQCorr(F_r, r, Q, Sinf):
+def calc_SQCorr(F_r, r, Q, Sinf, engine="dense", oversampling=8):
     """Function to calculate S(Q) Corr from F(r) optimal.
+    The "dense" engine sums the sin(Qr) matrix directly on the Q grid.
+    The "fft" engine calculates the same sum with the DST on a zero-padded
+    version of the native r grid, then it interpolates the result onto the Q
+    grid with a cubic spline, so also Q grids not commensurate with r are
+    supported. The native Q grid has oversampling times the points of the r
+    grid: the interpolation error decreases as oversampling^-4 and with the
+    default value it is below 2e-6 relative to the maximum of |Qi(Q)| (see
+    LASDiABenchmark.bench_SQCorr).
+    The "fft" engine requires an evenly spaced r grid starting from 0, as the
+    one returned by calc_Fr.
 
     Parameters
     ----------
-    F_r  : numpy array
-           F(r)
-    r    : numpy array
-           atomic distance (nm)
-    Q    : numpy array
-           momentum transfer (nm^-1)
-    Sinf : float
-           value of S(Q) for Q->inf
+    F_r          : numpy array
+                   F(r)
+    r            : numpy array
+                   atomic distance (nm)
+    Q            : numpy array
+                   momentum transfer (nm^-1)
+    Sinf         : float
+                   value of S(Q) for Q->inf
+    engine       : string
+                   engine for the back-transform: "fft" or "dense" (any other
+                   value, as "simps", selects the dense sum)
+    oversampling : int
+                   ratio between the number of points of the native Q grid
+                   and of the r grid for the "fft" engine
 
     Returns
     -------
-    S_Q  : numpy array
-           corrected structure factor
+    S_Q          : numpy array
+                   corrected structure factor
     """
 
     # Qi_Q =  simps(F_r * (np.array(np.sin(np.mat(r).T *  np.mat(Q)))).T, r)
     Deltar = np.diff(r)
     meanDeltar = np.mean(Deltar)
-    Qr = np.outer(Q, r)
-    sinQr = np.sin(Qr)
-    Qi_Q = np.sum(sinQr * F_r, axis=1) * meanDeltar
+    
+    if engine.lower() == "fft":
+        numPoints = 2**int(math.ceil(math.log(oversampling*r.size)/math.log(2)))
+        F_rPad = np.zeros(numPoints-1)
+        F_rPad[:r.size-1] = F_r[1:]
+        # native grid from 0 to pi/Deltar, where the sum vanishes
+        nativeQ = np.arange(numPoints+1) * np.pi / (numPoints*meanDeltar)
+        nativeQi_Q = np.zeros(numPoints+1)
+        nativeQi_Q[1:-1] = fftpack.dst(F_rPad, type=1) / 2 * meanDeltar
+        # the sum is odd and 2pi/Deltar periodic in Q
+        period = 2 * np.pi / meanDeltar
+        foldQ = np.mod(Q, period)
+        sign = np.where(foldQ > period/2, -1.0, 1.0)
+        foldQ = np.where(foldQ > period/2, period - foldQ, foldQ)
+        Qi_Q = sign * interpolate.InterpolatedUnivariateSpline(nativeQ,
+            nativeQi_Q, k=3)(foldQ)
+    else:
+        Qr = np.outer(Q, r)
+        sinQr = np.sin(Qr)
+        Qi_Q = np.sum(sinQr * F_r, axis=1) * meanDeltar
+    
     S_Q = Qi_Q / Q + Sinf
     S_Q[0] = 0.0
 
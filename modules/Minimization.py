@@ -37,7 +37,9 @@ otherwise it is just the name.
 
 import numpy as np
 import matplotlib.pyplot as plt
+import multiprocessing
 
+from modules import Cache
 from modules import Geometry
 from modules import IgorFunctions
 from modules import KaplowMethod
@@ -46,6 +48,7 @@ from modules import Optimization
 from modules import UtilityAnalysis
 import time
 from scipy.integrate import simps
+from scipy import optimize
 
 
 def chi2Fit(variableArray, chi2Array):
@@ -94,9 +97,732 @@ def chi2Fit(variableArray, chi2Array):
     return (xFit, yFit, absXMin, absYMin)
 
 
+def calc_chi2Batch(scaleArray, densityArray, Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q,
+    minQ, QmaxIntegrate, maxQ, Ztot, Sinf, smoothingFactor, rmin, dampingFunction,
+    Fintra_r, iterations, engine="simps", context=None):
+    """Function to calculate the chi2 values for a set of (scale factor, density)
+    samples in one vectorized pass.
+    All the samples are processed together as 2D arrays (samples x Q), only the
+    smoothing spline is fitted sample by sample.
+    With a context the chi2 values are calculated by calc_chi2Context, the
+    arguments from Q to engine, except I_Q, Ibkg_Q and Fintra_r, must be the
+    same of the context (SampleContext.check_arguments raises ValueError
+    otherwise).
+
+    Parameters
+    ----------
+    scaleArray         : numpy array
+                         scale factor values
+    densityArray       : numpy array
+                         average atomic density values, scaleArray and
+                         densityArray are broadcast against each other
+    Q                  : numpy array
+                         momentum transfer (nm^-1)
+    I_Q                : numpy array
+                         measured scattering intensity, it can be a 2D array
+                         with a row for each sample
+    Ibkg_Q             : numpy array
+                         background scattering intensity, it can be a 2D array
+                         with a row for each sample
+    J_Q                : numpy array
+                         J(Q)
+    Iincoh_Q           : numpy array
+                         incoherent scattering intensity
+    fe_Q               : numpy array
+                         effective electric form factor
+    minQ               : float
+                         minimum Q value
+    QmaxIntegrate      : float
+                         maximum Q value for the intagrations
+    maxQ               : float
+                         maximum Q value
+    Ztot               : int
+                         total Z number
+    Sinf               : float
+                         value of S(Q) for Q->inf
+    smoothingFactor    : float
+                         smoothing factor
+    rmin               : float
+                         r cut-off value (nm)
+    dampingFunction    : numpy array
+                         damping function
+    Fintra_r           : numpy array
+                         intramolecular contribution of F(r)
+    iterations         : int
+                         number of iterations
+    engine             : string
+                         engine for the F(r) transform: "simps" or "fft"
+    context            : Context.SampleContext
+                         context of the dataset
+
+    Returns
+    -------
+    chi2Array          : numpy array
+                         chi2 values
+    """
+    
+    if context is not None:
+        context.check_arguments(Q, J_Q, Iincoh_Q, fe_Q, minQ, QmaxIntegrate, maxQ,
+            Ztot, Sinf, smoothingFactor, rmin, dampingFunction, iterations, engine)
+        return calc_chi2Context(scaleArray, densityArray, I_Q, Ibkg_Q, Fintra_r,
+            context)
+    
+    scaleArray, densityArray = np.broadcast_arrays(np.atleast_1d(scaleArray),
+        np.atleast_1d(densityArray))
+    maskInt = Q<=QmaxIntegrate
+    
+    Isample_Q = MainFunctions.calc_IsampleQ(I_Q, scaleArray[:, np.newaxis], Ibkg_Q)
+    alpha = MainFunctions.calc_alpha(J_Q[maskInt], Sinf, Q[maskInt],
+        Isample_Q[:, maskInt], fe_Q[maskInt], Ztot, densityArray)
+    Icoh_Q = MainFunctions.calc_Icoh(alpha[:, np.newaxis], Isample_Q, Iincoh_Q)
+    
+    S_Q = MainFunctions.calc_SQ(Icoh_Q, Ztot, fe_Q, Sinf, Q, minQ,
+        QmaxIntegrate, maxQ)
+    
+    Ssmooth_Q = np.zeros(S_Q.shape)
+    for i in range(scaleArray.size):
+        Ssmooth_Q[i] = UtilityAnalysis.calc_SQsmoothing(Q, S_Q[i], Sinf,
+            smoothingFactor, minQ, QmaxIntegrate, maxQ)
+    
+    SsmoothDamp_Q = UtilityAnalysis.calc_SQdamp(Ssmooth_Q, Sinf,
+        dampingFunction)
+    
+    i_Q = MainFunctions.calc_iQ(SsmoothDamp_Q, Sinf)
+    
+    Qi_Q = Q*i_Q
+    r, F_r = MainFunctions.calc_Fr(Q[maskInt], Qi_Q[:, maskInt], engine)
+    
+    Fopt_r, deltaFopt_r = Optimization.calc_optimize_Fr(iterations, F_r,
+        Fintra_r, densityArray[:, np.newaxis], i_Q[:, maskInt], Q[maskInt],
+        Sinf, J_Q[maskInt], r, rmin, "n", engine)
+    
+    deltaFopt_r[:, r>=rmin] = 0.0 # Igor version
+    chi2Array = np.mean(deltaFopt_r**2, axis=1) # Igor version
+    
+    return chi2Array
+
+
+def calc_chi2Context(scaleArray, densityArray, I_Q, Ibkg_Q, Fintra_r, context):
+    """Function to calculate the chi2 values of a set of (scale factor, density)
+    samples as calc_chi2Batch, with the Q-invariant quantities of the dataset
+    precomputed in a context: the Q ranges are slices (views instead of masked
+    copies) and the F(r) transforms use the sin matrices of the context.
+
+    Parameters
+    ----------
+    scaleArray   : numpy array
+                   scale factor values
+    densityArray : numpy array
+                   average atomic density values
+    I_Q          : numpy array
+                   measured scattering intensity, it can be a 2D array with a
+                   row for each sample
+    Ibkg_Q       : numpy array
+                   background scattering intensity, it can be a 2D array with
+                   a row for each sample
+    Fintra_r     : numpy array
+                   intramolecular contribution of F(r) on context.r
+    context      : Context.SampleContext
+                   context of the dataset
+
+    Returns
+    -------
+    chi2Array    : numpy array
+                   chi2 values
+    """
+    
+    scaleArray, densityArray = np.broadcast_arrays(np.atleast_1d(scaleArray),
+        np.atleast_1d(densityArray))
+    intSlice = context.intSlice
+    
+    Isample_Q = MainFunctions.calc_IsampleQ(I_Q, scaleArray[:, np.newaxis], Ibkg_Q)
+    alpha = MainFunctions.calc_alpha(context.J_Qint, context.Sinf, context.Q_int,
+        Isample_Q[:, intSlice], context.fe_Qint, context.Ztot, densityArray)
+    Icoh_Q = MainFunctions.calc_Icoh(alpha[:, np.newaxis], Isample_Q,
+        context.Iincoh_Q)
+    
+    S_Q = context.calc_SQ(Icoh_Q)
+    Ssmooth_Q = context.calc_SQsmoothing(S_Q)
+    SsmoothDamp_Q = UtilityAnalysis.calc_SQdamp(Ssmooth_Q, context.Sinf,
+        context.dampingFunction)
+    
+    i_Q = MainFunctions.calc_iQ(SsmoothDamp_Q, context.Sinf)[:, intSlice]
+    F_r = context.calc_Fr(context.Q_int*i_Q)
+    
+    Fopt_r, deltaFopt_r = Optimization.calc_optimize_Fr(context.iterations, F_r,
+        Fintra_r, densityArray[:, np.newaxis], i_Q, context.Q_int, context.Sinf,
+        context.J_Qint, context.r, context.rmin, "n", context.engine, context)
+    
+    deltaFopt_r[:, context.rminSlice.stop:] = 0.0 # Igor version
+    chi2Array = np.mean(deltaFopt_r**2, axis=1) # Igor version
+    
+    return chi2Array
+
+
+def calc_chi2Samples(scaleArray, densityArray, sthArray, s0thArray, Q, I_Q,
+    Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ, QmaxIntegrate, maxQ, Ztot, Sinf,
+    smoothingFactor, rmin, dampingFunction, Fintra_r, iterations, mccFlag,
+    thickness_sampling, phi_matrix, engine="simps", mccCache=None,
+    mccTable=None, context=None):
+    """Function to calculate the chi2 values for a set of (scale factor, density,
+    sample thickness, reference thickness) samples.
+    The MCC correction is applied to the raw intensities once for each distinct
+    (sth, s0th) pair, then all the samples go through calc_chi2Batch.
+
+    Parameters
+    ----------
+    scaleArray         : numpy array
+                         scale factor values
+    densityArray       : numpy array
+                         average atomic density values
+    sthArray           : numpy array
+                         sample thickness values
+    s0thArray          : numpy array
+                         reference sample thickness values, the four sample
+                         arrays are broadcast against each other
+    Q                  : numpy array
+                         momentum transfer (nm^-1)
+    I_Q                : numpy array
+                         measured scattering intensity, without MCC correction
+    Ibkg_Q             : numpy array
+                         background scattering intensity, without MCC correction
+    J_Q                : numpy array
+                         J(Q)
+    Iincoh_Q           : numpy array
+                         incoherent scattering intensity
+    fe_Q               : numpy array
+                         effective electric form factor
+    minQ               : float
+                         minimum Q value
+    QmaxIntegrate      : float
+                         maximum Q value for the intagrations
+    maxQ               : float
+                         maximum Q value
+    Ztot               : int
+                         total Z number
+    Sinf               : float
+                         value of S(Q) for Q->inf
+    smoothingFactor    : float
+                         smoothing factor
+    rmin               : float
+                         r cut-off value (nm)
+    dampingFunction    : numpy array
+                         damping function
+    Fintra_r           : numpy array
+                         intramolecular contribution of F(r)
+    iterations         : int
+                         number of iterations
+    mccFlag            : string
+                         flag for the MCC correction ("y" or "n")
+    thickness_sampling : numpy array
+                         sample thickness sampling of the phi matrix
+    phi_matrix         : 2D numpy array
+                         phi matrix
+    engine             : string
+                         engine for the F(r) transform: "simps" or "fft"
+    mccCache           : Cache.LRUCache
+                         cache of the MCC corrected intensities, keyed by
+                         (sth, s0th, id(phi_matrix), id(I_Q), id(Ibkg_Q)), each
+                         entry keeps a reference to these arrays
+    mccTable           : Geometry.MCCTable
+                         table of phi_matrix, if it is given all the missing
+                         corrections are read from it in one call
+    context            : Context.SampleContext
+                         context of the dataset (calc_chi2Batch)
+
+    Returns
+    -------
+    chi2Array          : numpy array
+                         chi2 values
+    """
+    
+    scaleArray, densityArray, sthArray, s0thArray = np.broadcast_arrays(
+        np.atleast_1d(scaleArray), np.atleast_1d(densityArray),
+        np.atleast_1d(sthArray), np.atleast_1d(s0thArray))
+    
+    if mccFlag.lower() == "y":
+        if mccCache is None:
+            mccCache = Cache.LRUCache(scaleArray.size)
+        
+        corrected = {}
+        missing = []
+        for thickness in set(zip(sthArray, s0thArray)):
+            entry = mccCache.get(thickness + (id(phi_matrix), id(I_Q), id(Ibkg_Q)))
+            if entry is None:
+                missing.append(thickness)
+            else:
+                corrected[thickness] = entry
+        
+        if missing:
+            if mccTable is not None:
+                T_MCC_sth, T_MCC_corr_factor_bkg = mccTable.MCC_correction(
+                    [thickness[0] for thickness in missing],
+                    [thickness[1] for thickness in missing])
+            else:
+                T_MCC_sth, T_MCC_corr_factor_bkg = zip(*[Geometry.MCC_correction(
+                    thickness[0], thickness[1], thickness_sampling, phi_matrix)
+                    for thickness in missing])
+            
+            for i, thickness in enumerate(missing):
+                entry = (I_Q / T_MCC_sth[i],
+                    Ibkg_Q * T_MCC_corr_factor_bkg[i] / T_MCC_sth[i],
+                    phi_matrix, I_Q, Ibkg_Q)
+                mccCache.put(thickness + (id(phi_matrix), id(I_Q), id(Ibkg_Q)), entry)
+                corrected[thickness] = entry
+        
+        I_Q = np.array([corrected[thickness][0] for thickness in
+            zip(sthArray, s0thArray)])
+        Ibkg_Q = np.array([corrected[thickness][1] for thickness in
+            zip(sthArray, s0thArray)])
+    
+    chi2Array = calc_chi2Batch(scaleArray, densityArray, Q, I_Q, Ibkg_Q, J_Q,
+        Iincoh_Q, fe_Q, minQ, QmaxIntegrate, maxQ, Ztot, Sinf, smoothingFactor,
+        rmin, dampingFunction, Fintra_r, iterations, engine, context)
+    
+    return chi2Array
+
+
+# Read-only inputs of the chi2 worker processes, filled by init_chi2Worker
+chi2WorkerData = {}
+
+
+def init_chi2Worker(data):
+    """Function to initialize a chi2 worker process.
+    It is called once per worker, so the large input arrays are transferred
+    only when the pool starts; the MCC table is built here for the same reason
+    and each worker keeps its own cache of MCC corrected intensities.
+
+    Parameters
+    ----------
+    data : dictionary
+           calc_chi2Samples arguments shared by all the samples
+    """
+    
+    chi2WorkerData.clear()
+    chi2WorkerData.update(data)
+    if data.get("phiMemmap", False):
+        chi2WorkerData["phi_matrix"] = Cache.open_memmapSource(data["phi_matrix"])
+        del chi2WorkerData["phiMemmap"]
+    if data["mccFlag"].lower() == "y":
+        chi2WorkerData["mccTable"] = Geometry.MCCTable(data["thickness_sampling"],
+            chi2WorkerData["phi_matrix"])
+        chi2WorkerData["mccCache"] = Cache.LRUCache(100)
+
+
+def calc_chi2Worker(samples):
+    """Function to calculate the chi2 values of a chunk of samples inside a
+    worker process.
+
+    Parameters
+    ----------
+    samples   : tuple
+                (scaleArray, densityArray, sthArray, s0thArray) of the chunk
+
+    Returns
+    -------
+    chi2Array : numpy array
+                chi2 values of the chunk
+    """
+    
+    scaleArray, densityArray, sthArray, s0thArray = samples
+    
+    return calc_chi2Samples(scaleArray, densityArray, sthArray, s0thArray,
+        **chi2WorkerData)
+
+
+def make_chi2Pool(numWorkers, Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ,
+    QmaxIntegrate, maxQ, Ztot, Sinf, smoothingFactor, rmin, dampingFunction,
+    Fintra_r, iterations, mccFlag, thickness_sampling, phi_matrix, engine="simps",
+    context=None):
+    """Function to create the worker pool for the chi2 evaluations.
+    The arguments after numWorkers are the calc_chi2Samples ones which do not
+    change during the minimization, they are sent to each worker only once.
+    I_Q and Ibkg_Q must be without MCC correction, the workers apply it for
+    each sample.
+    A memory-mapped phi matrix is not copied to the workers, they map the
+    same file (Cache.memmap_source), so they share its pages.
+    The pool has to be closed by the caller (pool.close(), pool.join()).
+
+    Parameters
+    ----------
+    numWorkers : int
+                 number of worker processes, None for one for each CPU
+    
+    Returns
+    -------
+    pool       : multiprocessing.Pool
+                 worker pool, its number of workers is pool.numWorkers
+    """
+    
+    data = {"Q": Q, "I_Q": I_Q, "Ibkg_Q": Ibkg_Q, "J_Q": J_Q,
+        "Iincoh_Q": Iincoh_Q, "fe_Q": fe_Q, "minQ": minQ,
+        "QmaxIntegrate": QmaxIntegrate, "maxQ": maxQ, "Ztot": Ztot,
+        "Sinf": Sinf, "smoothingFactor": smoothingFactor, "rmin": rmin,
+        "dampingFunction": dampingFunction, "Fintra_r": Fintra_r,
+        "iterations": iterations, "mccFlag": mccFlag,
+        "thickness_sampling": thickness_sampling, "phi_matrix": phi_matrix,
+        "engine": engine, "context": context}
+    
+    phiSource = Cache.memmap_source(phi_matrix)
+    if phiSource is not None:
+        data["phi_matrix"] = phiSource
+        data["phiMemmap"] = True
+    
+    if numWorkers is None:
+        numWorkers = multiprocessing.cpu_count()
+    
+    pool = multiprocessing.Pool(numWorkers, init_chi2Worker, (data,))
+    pool.numWorkers = numWorkers
+    
+    return pool
+
+
+def calc_chi2Pool(pool, scaleArray, densityArray, sthArray, s0thArray):
+    """Function to calculate the chi2 values of a set of samples with a worker
+    pool created by make_chi2Pool.
+    The samples are split in contiguous chunks, one for each worker.
+
+    Parameters
+    ----------
+    pool         : multiprocessing.Pool
+                   worker pool
+    scaleArray   : numpy array
+                   scale factor values
+    densityArray : numpy array
+                   average atomic density values
+    sthArray     : numpy array
+                   sample thickness values
+    s0thArray    : numpy array
+                   reference sample thickness values
+
+    Returns
+    -------
+    chi2Array    : numpy array
+                   chi2 values
+    """
+    
+    samples = np.broadcast_arrays(np.atleast_1d(scaleArray),
+        np.atleast_1d(densityArray), np.atleast_1d(sthArray),
+        np.atleast_1d(s0thArray))
+    
+    numChunks = min(samples[0].size, pool.numWorkers)
+    chunks = np.array_split(np.arange(samples[0].size), numChunks)
+    tasks = [tuple(np.copy(sample[idx]) for sample in samples) for idx in chunks]
+    
+    chi2Array = np.concatenate(pool.map(calc_chi2Worker, tasks))
+    
+    return chi2Array
+
+
+def calc_chi2Cached(cache, settingsKey, chi2Function, scaleArray, densityArray,
+    sthArray, s0thArray):
+    """Function to calculate the chi2 values of a set of samples using the
+    values already stored in an LRU cache.
+    Only the samples missing in the cache are passed to chi2Function, their
+    chi2 values are then added to the cache.
+
+    Parameters
+    ----------
+    cache        : Cache.LRUCache
+                   chi2 cache
+    settingsKey  : string
+                   hash of all the inputs which are not sample variables
+    chi2Function : function
+                   function(scaleArray, densityArray, sthArray, s0thArray)
+                   returning the chi2 array
+    scaleArray   : numpy array
+                   scale factor values
+    densityArray : numpy array
+                   average atomic density values
+    sthArray     : numpy array
+                   sample thickness values
+    s0thArray    : numpy array
+                   reference sample thickness values
+
+    Returns
+    -------
+    chi2Array    : numpy array
+                   chi2 values
+    """
+    
+    samples = np.broadcast_arrays(np.atleast_1d(scaleArray),
+        np.atleast_1d(densityArray), np.atleast_1d(sthArray),
+        np.atleast_1d(s0thArray))
+    
+    keys = []
+    chi2Array = np.zeros(samples[0].size)
+    missing = []
+    for i in range(samples[0].size):
+        key = tuple(Cache.quantize(sample[i]) for sample in samples) + (settingsKey,)
+        keys.append(key)
+        chi2 = cache.get(key)
+        if chi2 is None:
+            missing.append(i)
+        else:
+            chi2Array[i] = chi2
+    
+    if missing:
+        missing = np.array(missing)
+        chi2Array[missing] = chi2Function(*[sample[missing] for sample in samples])
+        for i in missing:
+            cache.put(keys[i], chi2Array[i])
+    
+    return chi2Array
+
+
+def make_chi2Function(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ, QmaxIntegrate,
+    maxQ, Ztot, Sinf, smoothingFactor, rmin, dampingFunction, Fintra_r,
+    iterations, mccFlag, thickness_sampling, phi_matrix, engine="simps",
+    pool=None, cache=None, mccCache=None, context=None):
+    """Function to create the chi2 function used by the optimizers.
+    The returned function calculates the samples with calc_chi2Samples, or with
+    the worker pool if it is given, and memoizes the values in cache if it is
+    given. The MCC corrections are read from the MCCTable of phi_matrix
+    (Geometry.get_MCCTable), and the corrected intensities are kept in
+    mccCache for the next calls.
+
+    Parameters
+    ----------
+    The calc_chi2Samples arguments which do not change between the samples, I_Q
+    and Ibkg_Q without MCC correction, and
+    pool         : multiprocessing.Pool
+                   worker pool from make_chi2Pool, created with the same
+                   arguments
+    cache        : Cache.LRUCache
+                   chi2 cache
+    mccCache     : Cache.LRUCache
+                   cache of the MCC corrected intensities (calc_chi2Samples)
+    context      : Context.SampleContext
+                   context of the dataset (calc_chi2Batch)
+
+    Returns
+    -------
+    chi2Function : function
+                   function(scaleArray, densityArray, sthArray, s0thArray)
+                   returning the chi2 array
+    """
+    
+    if context is not None:
+        context.check_arguments(Q, J_Q, Iincoh_Q, fe_Q, minQ, QmaxIntegrate, maxQ,
+            Ztot, Sinf, smoothingFactor, rmin, dampingFunction, iterations, engine)
+    
+    if pool is None and mccFlag.lower() == "y":
+        mccTable = Geometry.get_MCCTable(thickness_sampling, phi_matrix)
+    else:
+        mccTable = None
+    
+    def calc_chi2(scaleArray, densityArray, sthArray, s0thArray):
+        if pool is not None:
+            return calc_chi2Pool(pool, scaleArray, densityArray, sthArray, s0thArray)
+        return calc_chi2Samples(scaleArray, densityArray, sthArray, s0thArray, Q,
+            I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ, QmaxIntegrate, maxQ, Ztot,
+            Sinf, smoothingFactor, rmin, dampingFunction, Fintra_r, iterations,
+            mccFlag, thickness_sampling, phi_matrix, engine, mccCache, mccTable,
+            context)
+    
+    if cache is None:
+        return calc_chi2
+    
+    settingsKey = Cache.hash_values(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ,
+        QmaxIntegrate, maxQ, Ztot, Sinf, smoothingFactor, rmin, dampingFunction,
+        Fintra_r, iterations, mccFlag.lower(), thickness_sampling,
+        Geometry.get_phi_matrixKey(phi_matrix), engine, context.key if context is not None else None)
+    
+    def calc_chi2Memo(scaleArray, densityArray, sthArray, s0thArray):
+        return calc_chi2Cached(cache, settingsKey, calc_chi2, scaleArray,
+            densityArray, sthArray, s0thArray)
+    
+    return calc_chi2Memo
+
+
+def plot_chi2Scan(label, variableArray, chi2Array, fit):
+    """Optimizer callback to plot the chi2 scans without blocking.
+    Each variable has its own figure, redrawn at every call.
+
+    Parameters
+    ----------
+    label         : string
+                    name of the optimized variable
+    variableArray : numpy array
+                    array with variable values
+    chi2Array     : numpy array
+                    array with chi2 values
+    fit           : tuple
+                    (xFit, yFit) of the final chi2 fit, None during the scans
+    """
+    
+    plt.figure("chi2 " + label)
+    plt.clf()
+    plt.scatter(variableArray, chi2Array)
+    if fit is not None:
+        plt.plot(fit[0], fit[1])
+    plt.xlabel(label)
+    plt.ylabel("chi2")
+    plt.grid(True)
+    plt.pause(0.001)
+
+
+def print_chi2Scan(label, variableArray, chi2Array, fit):
+    """Optimizer callback to log the chi2 scans on the standard output.
+
+    Parameters
+    ----------
+    label         : string
+                    name of the optimized variable
+    variableArray : numpy array
+                    array with variable values
+    chi2Array     : numpy array
+                    array with chi2 values
+    fit           : tuple
+                    (xFit, yFit) of the final chi2 fit, None during the scans
+    """
+    
+    if fit is None:
+        minIdx = np.argmin(chi2Array)
+        print(label, "scan", variableArray[0], variableArray[-1], "min chi2",
+            chi2Array[minIdx], "at", variableArray[minIdx])
+    else:
+        xFit, yFit = fit
+        minIdx = np.argmin(yFit)
+        print(label, "fit min chi2", yFit[minIdx], "at", xFit[minIdx])
+
+
+def lineSearch(chi2Function, value, step, maxEval=50, tol=1e-4, lowLimit=0.0,
+    label="", callback=None):
+    """Function to find the chi2 minimum along one variable with a bracketing
+    search followed by a golden section search.
+    The first three points (value-step, value, value+step) are evaluated
+    together, then the bracket is expanded downhill by the golden ratio until
+    chi2 rises again. The final value comes from the cubic fit of
+    IgorFunctions.chi2Fit on the points inside the last bracket.
+
+    Parameters
+    ----------
+    chi2Function : function
+                   function returning the chi2 array of a variable array
+    value        : float
+                   variable starting value
+    step         : float
+                   initial step
+    maxEval      : int
+                   maximum number of chi2 evaluations
+    tol          : float
+                   relative width of the final bracket
+    lowLimit     : float
+                   the variable is kept above this value, None for no limit
+    label        : string
+                   name of the variable for the callback
+    callback     : function
+                   called as in OptimizeScale
+
+    Returns
+    -------
+    value        : float
+                   variable value at the chi2 minimum, the best evaluated
+                   value if no minimum was bracketed
+    chi2         : float
+                   lowest evaluated chi2 value
+    numEval      : int
+                   number of chi2 evaluations
+    found        : bool
+                   False if no minimum was bracketed within maxEval
+                   evaluations
+    """
+    
+    goldenRatio = (1.0+np.sqrt(5.0))/2
+    goldenSection = 2.0-goldenRatio
+    
+    valueList = []
+    chi2List = []
+    
+    def evaluate(varArray):
+        chi2Array = np.asarray(chi2Function(np.asarray(varArray)), dtype=float)
+        chi2Array[np.isnan(chi2Array)] = np.inf
+        valueList.extend(varArray)
+        chi2List.extend(chi2Array)
+        return chi2Array
+    
+    def evaluated():
+        idx = np.argsort(valueList)
+        return (np.array(valueList)[idx], np.array(chi2List)[idx])
+    
+    # ------------------------------Bracketing----------------------------------
+    
+    a, b, c = value-step, value, value+step
+    if lowLimit is not None and a <= lowLimit:
+        a = (lowLimit+b)/2
+    fa, fb, fc = evaluate([a, b, c])
+    
+    if fa < fc:
+        a, c = c, a
+        fa, fc = fc, fa
+    
+    while fc < fb:
+        if len(valueList) >= maxEval:
+            varArray, chi2Array = evaluated()
+            if callback is not None:
+                callback(label, varArray, chi2Array, None)
+            bestIdx = np.argmin(chi2Array)
+            return (varArray[bestIdx], chi2Array[bestIdx], len(valueList), False)
+        
+        new = c + goldenRatio*(c-b)
+        if lowLimit is not None and new <= lowLimit:
+            new = (lowLimit+c)/2
+        fnew = evaluate([new])[0]
+        a, b, c = b, c, new
+        fa, fb, fc = fb, fc, fnew
+    
+    if callback is not None:
+        varArray, chi2Array = evaluated()
+        callback(label, varArray, chi2Array, None)
+    
+    # ---------------------------Golden section---------------------------------
+    
+    low, high = min(a, c), max(a, c)
+    while (high-low > tol*abs(b)) and (len(valueList) < maxEval):
+        if high-b > b-low:
+            new = b + goldenSection*(high-b)
+        else:
+            new = b - goldenSection*(b-low)
+        fnew = evaluate([new])[0]
+        
+        if fnew < fb:
+            if new > b:
+                low = b
+            else:
+                high = b
+            b, fb = new, fnew
+        else:
+            if new > b:
+                high = new
+            else:
+                low = new
+    
+    # ------------------------chi2 curve fit------------------------------------
+    
+    varArray, chi2Array = evaluated()
+    mask = (varArray >= low) & (varArray <= high) & np.isfinite(chi2Array)
+    if np.count_nonzero(mask) < 4:
+        nearIdx = np.argsort(np.abs(varArray-b))[0:5]
+        mask = np.zeros(varArray.size, dtype=bool)
+        mask[nearIdx] = True
+    
+    xFit, yFit, value, _ = IgorFunctions.chi2Fit(b, varArray[mask],
+        chi2Array[mask])
+    if not (low <= value <= high):
+        value = b
+    
+    if callback is not None:
+        callback(label, varArray, chi2Array, (xFit, yFit))
+    
+    return (value, fb, len(valueList), True)
+
+
 def OptimizeScale(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ, QmaxIntegrate, maxQ,
     Ztot, density, scaleFactor, Sinf, smoothingFactor, rmin, dampingFunction,
-    Fintra_r, iterations, scaleStep, sth, s0th, mccFlag, thickness_sampling, phi_matrix):
+    Fintra_r, iterations, scaleStep, sth, s0th, mccFlag, thickness_sampling, phi_matrix,
+    engine="simps", pool=None, callback=None, searchMode="grid", maxEval=50,
+    cache=None, mccCache=None, context=None):
     """Function for the scale factor optimization.
 
     Q                  : numpy array
@@ -139,27 +865,47 @@ def OptimizeScale(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ, QmaxIntegrate, maxQ
     sth
     s0th
     MCC_flag
+    engine             : string
+                         engine for the F(r) transform: "simps" or "fft"
+    pool               : multiprocessing.Pool
+                         worker pool from make_chi2Pool, if None the samples
+                         are calculated in this process
+    callback           : function
+                         called as callback(label, variableArray, chi2Array, fit)
+                         after each scan with fit=None and at the end with
+                         fit=(xFit, yFit), e.g. plot_chi2Scan or print_chi2Scan
+    searchMode         : string
+                         "grid" for the 23 points scan with range shifting,
+                         "bracket" for the bracketing line search (lineSearch)
+    maxEval            : int
+                         maximum number of chi2 evaluations in "bracket" mode
+    cache              : Cache.LRUCache
+                         chi2 cache shared between the calls, if None the
+                         chi2 values are not memoized
+    mccCache           : Cache.LRUCache
+                         cache of the MCC corrected intensities shared between
+                         the calls
+    context            : Context.SampleContext
+                         context of the dataset, if given its precomputed
+                         arrays and settings are used (calc_chi2Context)
     """
     
-    numSample = 23
+    chi2Function = make_chi2Function(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ,
+        QmaxIntegrate, maxQ, Ztot, Sinf, smoothingFactor, rmin, dampingFunction,
+        Fintra_r, iterations, mccFlag, thickness_sampling, phi_matrix, engine, pool,
+        cache, mccCache, context)
     
-    if mccFlag.lower() == "y":
-        T_MCC_sth, T_MCC_corr_factor_bkg = Geometry.MCC_correction(sth, s0th,
-            thickness_sampling, phi_matrix)
-
-        # print(thickness_sampling)
-        # plt.contour(phi_matrix)
-        # plt.show()
-
-        # x = np.linspace(0, len(T_MCC_sth), len(T_MCC_sth), endpoint=True)
-        # _, T_MCC_sth = UtilityAnalysis.rebinning(x, T_MCC_sth, np.amin(T_MCC_sth),
-        #     np.amax(T_MCC_sth), len(I_Q))
-
-        # plt.plot(T_MCC_sth)
-        # plt.show()
-
-        I_Q = I_Q /T_MCC_sth
-        Ibkg_Q  = Ibkg_Q * T_MCC_corr_factor_bkg / (T_MCC_sth)
+    if searchMode.lower() == "bracket":
+        def scaleChi2(scaleArray):
+            return chi2Function(scaleArray, density, sth, s0th)
+        
+        scaleFactor, chi2, numEval, found = lineSearch(scaleChi2, scaleFactor,
+            scaleStep, maxEval, label="scale", callback=callback)
+        if not found:
+            print("no scale factor minimum found in", numEval, "evaluations")
+        print("final scale factor", scaleFactor)
+        
+        return scaleFactor
     
     flag=0
     # Loop for the range shifting
@@ -167,53 +913,15 @@ def OptimizeScale(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ, QmaxIntegrate, maxQ
         # print(type(scaleFactor))
         # print(type(scaleStep))
         scaleArray = UtilityAnalysis.makeArrayLoop(scaleFactor, scaleStep)
-        chi2Array = np.zeros(numSample)
         flag+=1
         print("iter flag ", flag)
 
-        for i in range(numSample):
-            print("sample ", i, scaleArray[i])
-            # ------------------Kaplow method for scale--------------------
-
-            Isample_Q = MainFunctions.calc_IsampleQ(I_Q, scaleArray[i], Ibkg_Q)
-            alpha = MainFunctions.calc_alpha(J_Q[Q<=QmaxIntegrate], Sinf, 
-                Q[Q<=QmaxIntegrate], Isample_Q[Q<=QmaxIntegrate], 
-                fe_Q[Q<=QmaxIntegrate], Ztot, density)
-            Icoh_Q = MainFunctions.calc_Icoh(alpha, Isample_Q, Iincoh_Q)
-
-            S_Q = MainFunctions.calc_SQ(Icoh_Q, Ztot, fe_Q, Sinf, Q, minQ, 
-                QmaxIntegrate, maxQ)
-            
-            Ssmooth_Q = UtilityAnalysis.calc_SQsmoothing(Q, S_Q, Sinf, 
-                smoothingFactor, minQ, QmaxIntegrate, maxQ)
-            
-            SsmoothDamp_Q = UtilityAnalysis.calc_SQdamp(Ssmooth_Q, Sinf,
-                dampingFunction)
-            
-            i_Q = MainFunctions.calc_iQ(SsmoothDamp_Q, Sinf)
-            
-            Qi_Q = Q*i_Q
-            r, F_r = MainFunctions.calc_Fr(Q[Q<=QmaxIntegrate], 
-                Qi_Q[Q<=QmaxIntegrate])
-
-            Fopt_r, deltaFopt_r = Optimization.calc_optimize_Fr(iterations, F_r,
-                Fintra_r, density, i_Q[Q<=QmaxIntegrate], Q[Q<=QmaxIntegrate],
-                Sinf, J_Q[Q<=QmaxIntegrate], r, rmin, "n")
-            
-            deltaFopt_r[np.where(r>=rmin)] = 0.0 # Igor version
-            chi2Array[i] = np.mean(deltaFopt_r**2) # Igor version
-            # Fth_r = Fintra_r - 4*np.pi*r*density
-            # plt.plot(r, Fth_r)
-            # plt.show()
-            # print(Fth_r)
-            # print(Fintra_r)
-            # chi2Array[i] = simps(deltaFopt_r[np.where((r>0)&(r<rmin))]**2)
+        chi2Array = chi2Function(scaleArray, density, sth, s0th)
 
         # --------------------Range shifting selection --------------------
         
-        plt.scatter(scaleArray, chi2Array)
-        plt.grid(True)
-        plt.show()
+        if callback is not None:
+            callback("scale", scaleArray, chi2Array, None)
 
         maxLimit = 10**5
         if np.amax(chi2Array) >= maxLimit:
@@ -237,10 +945,8 @@ def OptimizeScale(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ, QmaxIntegrate, maxQ
     
     print("final scale factor", scaleFactor)
 
-    plt.scatter(scaleArray, chi2Array)
-    plt.plot(xFit, yFit)
-    plt.grid(True)
-    plt.show()
+    if callback is not None:
+        callback("scale", scaleArray, chi2Array, (xFit, yFit))
     
     return scaleFactor
 
@@ -248,7 +954,9 @@ def OptimizeScale(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ, QmaxIntegrate, maxQ
 def OptimizeDensity(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ, QmaxIntegrate, maxQ,
     Ztot, density, scaleFactor, Sinf, smoothingFactor, rmin, dampingFunction,
     Fintra_r, iterations, densityStep,
-    sth, s0th, mccFlag, thickness_sampling, phi_matrix):
+    sth, s0th, mccFlag, thickness_sampling, phi_matrix, engine="simps", pool=None,
+    callback=None, searchMode="grid", maxEval=50, cache=None, mccCache=None,
+    context=None):
     """Function for the density optimization.
 
     Q                  : numpy array
@@ -293,16 +1001,47 @@ def OptimizeDensity(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ, QmaxIntegrate, ma
     thickness_sampling : float
     phi_matrix
     MCC_flag
+    engine             : string
+                         engine for the F(r) transform: "simps" or "fft"
+    pool               : multiprocessing.Pool
+                         worker pool from make_chi2Pool, if None the samples
+                         are calculated in this process
+    callback           : function
+                         called as callback(label, variableArray, chi2Array, fit)
+                         after each scan with fit=None and at the end with
+                         fit=(xFit, yFit), e.g. plot_chi2Scan or print_chi2Scan
+    searchMode         : string
+                         "grid" for the 23 points scan with range shifting,
+                         "bracket" for the bracketing line search (lineSearch)
+    maxEval            : int
+                         maximum number of chi2 evaluations in "bracket" mode
+    cache              : Cache.LRUCache
+                         chi2 cache shared between the calls, if None the
+                         chi2 values are not memoized
+    mccCache           : Cache.LRUCache
+                         cache of the MCC corrected intensities shared between
+                         the calls
+    context            : Context.SampleContext
+                         context of the dataset, if given its precomputed
+                         arrays and settings are used (calc_chi2Context)
     """
 
-    numSample = 23
-
-    if mccFlag.lower() == "y":
-        T_MCC_sth, T_MCC_corr_factor_bkg = Geometry.MCC_correction(sth, s0th,
-            thickness_sampling, phi_matrix)
+    chi2Function = make_chi2Function(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ,
+        QmaxIntegrate, maxQ, Ztot, Sinf, smoothingFactor, rmin, dampingFunction,
+        Fintra_r, iterations, mccFlag, thickness_sampling, phi_matrix, engine, pool,
+        cache, mccCache, context)
+    
+    if searchMode.lower() == "bracket":
+        def densityChi2(densityArray):
+            return chi2Function(scaleFactor, densityArray, sth, s0th)
         
-        I_Q = I_Q /T_MCC_sth
-        Ibkg_Q  = Ibkg_Q * T_MCC_corr_factor_bkg / (T_MCC_sth)
+        density, chi2, numEval, found = lineSearch(densityChi2, density,
+            densityStep, maxEval, label="density", callback=callback)
+        if not found:
+            print("no density minimum found in", numEval, "evaluations")
+        print("final density", density)
+        
+        return density
     
     flag =0
     # Loop for the range shifting
@@ -311,45 +1050,8 @@ def OptimizeDensity(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ, QmaxIntegrate, ma
         print("iter flag ", flag)
 
         densityArray = UtilityAnalysis.makeArrayLoop(density, densityStep)
-        chi2Array = np.zeros(numSample)
-        
-        for i in range(numSample):
-            print("sample ", i, densityArray[i])
+        chi2Array = chi2Function(scaleFactor, densityArray, sth, s0th)
 
-            # ------------------Kaplow method for scale--------------------
-
-            Isample_Q = MainFunctions.calc_IsampleQ(I_Q, scaleFactor, Ibkg_Q)
-            alpha = MainFunctions.calc_alpha(J_Q[Q<=QmaxIntegrate], Sinf, 
-                Q[Q<=QmaxIntegrate], Isample_Q[Q<=QmaxIntegrate], 
-                fe_Q[Q<=QmaxIntegrate], Ztot, densityArray[i])
-            Icoh_Q = MainFunctions.calc_Icoh(alpha, Isample_Q, Iincoh_Q)
-
-            S_Q = MainFunctions.calc_SQ(Icoh_Q, Ztot, fe_Q, Sinf, Q, minQ, 
-                QmaxIntegrate, maxQ)
-
-            Ssmooth_Q = UtilityAnalysis.calc_SQsmoothing(Q, S_Q, Sinf, 
-                smoothingFactor, minQ, QmaxIntegrate, maxQ)
-
-            SsmoothDamp_Q = UtilityAnalysis.calc_SQdamp(Ssmooth_Q, Sinf,
-                dampingFunction)
-
-            i_Q = MainFunctions.calc_iQ(SsmoothDamp_Q, Sinf)
-            
-            Qi_Q = Q*i_Q
-            r, F_r = MainFunctions.calc_Fr(Q[Q<=QmaxIntegrate], 
-                Qi_Q[Q<=QmaxIntegrate])
-
-            # r, F_r = MainFunctions.calc_Fr(Q[Q<=QmaxIntegrate], 
-            #     Qi_Q[Q<=QmaxIntegrate])
-
-            
-            Fopt_r, deltaFopt_r = Optimization.calc_optimize_Fr(iterations, F_r,
-                Fintra_r, densityArray[i], i_Q[Q<=QmaxIntegrate], Q[Q<=QmaxIntegrate],
-                Sinf, J_Q[Q<=QmaxIntegrate], r, rmin, "n")
-            
-            deltaFopt_r[np.where(r>=rmin)] = 0.0
-            chi2Array[i] = np.mean(deltaFopt_r**2)
-            
         # --------------------Range shifting selection --------------------
         
         # densityIdx = np.argmin(chi2Array)
@@ -357,9 +1059,8 @@ def OptimizeDensity(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ, QmaxIntegrate, ma
         
         # nearIdx, nearEl = UtilityAnalysis.find_nearest(densityArray, density)
         
-        plt.scatter(densityArray, chi2Array)
-        plt.grid(True)
-        plt.show()
+        if callback is not None:
+            callback("density", densityArray, chi2Array, None)
 
         maxLimit = 10**5
         if np.amax(chi2Array) >= maxLimit:
@@ -386,20 +1087,169 @@ def OptimizeDensity(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ, QmaxIntegrate, ma
     
     print("final density", density)
 
-    plt.scatter(densityArray, chi2Array)
-    plt.plot(xFit, yFit)
-    plt.grid(True)
-    plt.show()
+    if callback is not None:
+        callback("density", densityArray, chi2Array, (xFit, yFit))
 
     return density
 
 
+def OptimizeScaleDensity(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ, QmaxIntegrate,
+    maxQ, Ztot, density, scaleFactor, Sinf, smoothingFactor, rmin, dampingFunction,
+    Fintra_r, iterations, sth, s0th, mccFlag, thickness_sampling, phi_matrix,
+    engine="simps", maxEval=200, xtol=1e-4, ftol=1e-6, cache=None, mccCache=None,
+    context=None):
+    """Function for the joint optimization of scale factor and density with the
+    Nelder-Mead simplex method (scipy.optimize.fmin).
+    It replaces the alternated OptimizeScale/OptimizeDensity loop: the two
+    variables are normalized to their initial values, so the first simplex
+    moves both of them by 5%.
+    fmin asks for one chi2 value at a time, so the evaluations are calculated
+    in this process and a chi2 pool (make_chi2Pool) would not speed them up.
+
+    Parameters
+    ----------
+    Q                  : numpy array
+                         momentum transfer (nm^-1)
+    I_Q                : numpy array
+                         measured scattering intensity without MCC correction
+    Ibkg_Q             : numpy array
+                         background scattering intensity without MCC
+                         correction
+    J_Q                : numpy array
+                         J(Q)
+    Iincoh_Q           : numpy array
+                         incoherent scattering intensity
+    fe_Q               : numpy array
+                         effective electric form factor
+    minQ               : float
+                         minimum Q value
+    QmaxIntegrate      : float
+                         maximum Q value for the intagrations
+    maxQ               : float
+                         maximum Q value
+    Ztot               : int
+                         total Z number
+    density            : float
+                         average atomic density initial value
+    scaleFactor        : float
+                         scale factor initial value
+    Sinf               : float
+                         value of S(Q) for Q->inf
+    smoothingFactor    : float
+                         smoothing factor
+    rmin               : float
+                         r cut-off value (nm)
+    dampingFunction    : numpy array
+                         damping function
+    Fintra_r           : numpy array
+                         intramolecular contribution of F(r)
+    iterations         : int
+                         number of iterations
+    sth                : float
+                         sample thickness
+    s0th               : float
+                         reference sample thickness
+    mccFlag            : string
+                         flag for the MCC correction ("y" or "n")
+    thickness_sampling : numpy array
+                         sample thickness sampling of the phi matrix
+    phi_matrix         : 2D numpy array
+                         phi matrix
+    engine             : string
+                         engine for the F(r) transform: "simps" or "fft"
+    maxEval            : int
+                         maximum number of chi2 evaluations
+    xtol               : float
+                         relative tolerance on scale factor and density
+    ftol               : float
+                         absolute tolerance on chi2
+    cache              : Cache.LRUCache
+                         chi2 cache shared between the calls, if None the
+                         chi2 values are not memoized
+    mccCache           : Cache.LRUCache
+                         cache of the MCC corrected intensities shared between
+                         the calls
+    context            : Context.SampleContext
+                         context of the dataset, if given its precomputed
+                         arrays and settings are used (calc_chi2Context)
+
+    Returns
+    -------
+    scaleFactor        : float
+                         optimized scale factor
+    density            : float
+                         optimized average atomic density
+    chi2               : float
+                         chi2 value at the minimum
+    numEval            : int
+                         number of chi2 evaluations
+    """
+    
+    chi2Function = make_chi2Function(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ,
+        QmaxIntegrate, maxQ, Ztot, Sinf, smoothingFactor, rmin, dampingFunction,
+        Fintra_r, iterations, mccFlag, thickness_sampling, phi_matrix, engine, None,
+        cache, mccCache, context)
+    
+    scaleFactor0 = scaleFactor
+    density0 = density
+    
+    def scaleDensityChi2(x):
+        return chi2Function(x[0]*scaleFactor0, x[1]*density0, sth, s0th)[0]
+    
+    xOpt, chi2, numIter, numEval, warnFlag = optimize.fmin(scaleDensityChi2,
+        np.array([1.0, 1.0]), xtol=xtol, ftol=ftol, maxfun=maxEval,
+        full_output=True, disp=False)
+    
+    if warnFlag != 0:
+        print("scale and density optimization stopped after", numEval,
+            "evaluations without convergence")
+    
+    scaleFactor = xOpt[0]*scaleFactor0
+    density = xOpt[1]*density0
+    
+    print("final scale factor", scaleFactor, "final density", density,
+        "chi2 evaluations", numEval)
+    
+    return (scaleFactor, density, chi2, numEval)
+
+
 def OptimizeThickness(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, maxQ, minQ, QmaxIntegrate,
     Ztot, density, scaleFactor, sth, s0th, Sinf, smoothingFactor, rmin, dampingFunction,
-    Fintra_r, iterations, sthStep, ws1, ws2, r1, r2, d, phi_matrix_flag):
+    Fintra_r, iterations, sthStep, thickness_sampling, phi_matrix, engine="simps",
+    pool=None, callback=None, cache=None, mccCache=None, context=None):
     """Function for the thickness optimization.
+    The MCC correction is applied to I_Q and Ibkg_Q for each sample, so they
+    must be passed without it.
+
+    thickness_sampling : numpy array
+                         sample thickness sampling of the phi matrix
+    phi_matrix         : 2D numpy array
+                         phi matrix
+    engine             : string
+                         engine for the F(r) transform: "simps" or "fft"
+    pool               : multiprocessing.Pool
+                         worker pool from make_chi2Pool, if None the samples
+                         are calculated in this process
+    callback           : function
+                         called as callback(label, variableArray, chi2Array, fit)
+                         after each scan with fit=None and at the end with
+                         fit=(xFit, yFit), e.g. plot_chi2Scan or print_chi2Scan
+    cache              : Cache.LRUCache
+                         chi2 cache shared between the calls, if None the
+                         chi2 values are not memoized
+    mccCache           : Cache.LRUCache
+                         cache of the MCC corrected intensities shared between
+                         the calls
+    context            : Context.SampleContext
+                         context of the dataset, if given its precomputed
+                         arrays and settings are used (calc_chi2Context)
     """
     
+    chi2Function = make_chi2Function(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ,
+        QmaxIntegrate, maxQ, Ztot, Sinf, smoothingFactor, rmin, dampingFunction,
+        Fintra_r, iterations, "y", thickness_sampling, phi_matrix, engine, pool,
+        cache, mccCache, context)
+    
     Flag = 0
     NoPeak = 0
     sth = max(sth-sthStep*11, 0.0)
@@ -409,45 +1259,10 @@ def OptimizeThickness(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, maxQ, minQ, QmaxInteg
     # Loop for the range shifting
     while 1:
         sthArray = IgorFunctions.makeArrayLoop(sth, sthStep)
-        chi2Array = np.zeros(numSample)
+        chi2Array = chi2Function(scaleFactor, density, sthArray, s0th)
         
-        for i in range(numSample):
-
-            # ------------------Kaplow method for scale--------------------
-            
-            T_MCC_sth, T_MCC_corr_factor_bkg = Geometry.MCCCorrection(sthArray[i],
-                s0th, thickness_sampling, phi_matrix)
-    
-            I_Q = I_Q /T_MCC_sth
-            Ibkg_Q  = Ibkg_Q * T_MCC_corr_factor_bkg / (T_MCC_sth)
-            
-            Isample_Q = MainFunctions.calc_IsampleQ(I_Q, scaleFactor, Ibkg_Q)
-            alpha = MainFunctions.calc_alpha(J_Q[Q<=QmaxIntegrate], Sinf, 
-                Q[Q<=QmaxIntegrate], Isample_Q[Q<=QmaxIntegrate], 
-                fe_Q[Q<=QmaxIntegrate], Ztot, density)
-            Icoh_Q = MainFunctions.calc_Icoh(alpha, Isample_Q, Iincoh_Q)
-
-            S_Q = MainFunctions.calc_SQ(Icoh_Q, Ztot, fe_Q, Sinf, Q, minQ, 
-                QmaxIntegrate, maxQ)
-            
-            Ssmooth_Q = UtilityAnalysis.calc_SQsmoothing(Q, S_Q, Sinf, 
-                smoothingFactor, minQ, QmaxIntegrate, maxQ)
-            
-            SsmoothDamp_Q = UtilityAnalysis.calc_SQdamp(Ssmooth_Q, Sinf,
-                dampingFunction)
-            
-            i_Q = MainFunctions.calc_iQ(SsmoothDamp_Q, Sinf)
-            
-            Qi_Q = Q*i_Q
-            r, F_r = MainFunctions.calc_Fr(Q[Q<=QmaxIntegrate], 
-                Qi_Q[Q<=QmaxIntegrate])
-
-            Fopt_r, deltaFopt_r = Optimization.calc_optimize_Fr(iterations, F_r,
-                Fintra_r, density, i_Q[Q<=QmaxIntegrate], Q[Q<=QmaxIntegrate],
-                Sinf, J_Q[Q<=QmaxIntegrate], r, rmin, "n")
-            
-            deltaFopt_r[np.where(r>=rmin)] = 0.0
-            chi2Array[i] = np.mean(deltaFopt_r**2)
+        if callback is not None:
+            callback("sth", sthArray, chi2Array, None)
 
         # --------------------Range shifting selection --------------------
         
@@ -485,15 +1300,49 @@ def OptimizeThickness(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, maxQ, minQ, QmaxInteg
     
     print("final sample thickness", sth)
     
+    if callback is not None:
+        callback("sth", sthArray, chi2Array, (xFit, yFit))
+    
     return sth
 
 
 def OptimizeThicknessRef(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, maxQ, minQ, QmaxIntegrate,
     Ztot, density, scaleFactor, sth, s0th, Sinf, smoothingFactor, rmin, dampingFunction,
-    Fintra_r, iterations, s0thStep, ws1, ws2, r1, r2, d, phi_matrix_flag):
-    """Function for the thickness optimization.
+    Fintra_r, iterations, s0thStep, thickness_sampling, phi_matrix, engine="simps",
+    pool=None, callback=None, cache=None, mccCache=None, context=None):
+    """Function for the reference thickness optimization.
+    The MCC correction is applied to I_Q and Ibkg_Q for each sample, so they
+    must be passed without it.
+
+    thickness_sampling : numpy array
+                         sample thickness sampling of the phi matrix
+    phi_matrix         : 2D numpy array
+                         phi matrix
+    engine             : string
+                         engine for the F(r) transform: "simps" or "fft"
+    pool               : multiprocessing.Pool
+                         worker pool from make_chi2Pool, if None the samples
+                         are calculated in this process
+    callback           : function
+                         called as callback(label, variableArray, chi2Array, fit)
+                         after each scan with fit=None and at the end with
+                         fit=(xFit, yFit), e.g. plot_chi2Scan or print_chi2Scan
+    cache              : Cache.LRUCache
+                         chi2 cache shared between the calls, if None the
+                         chi2 values are not memoized
+    mccCache           : Cache.LRUCache
+                         cache of the MCC corrected intensities shared between
+                         the calls
+    context            : Context.SampleContext
+                         context of the dataset, if given its precomputed
+                         arrays and settings are used (calc_chi2Context)
     """
     
+    chi2Function = make_chi2Function(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ,
+        QmaxIntegrate, maxQ, Ztot, Sinf, smoothingFactor, rmin, dampingFunction,
+        Fintra_r, iterations, "y", thickness_sampling, phi_matrix, engine, pool,
+        cache, mccCache, context)
+    
     Flag = 0
     NoPeak = 0
     s0th = max(s0th-s0thStep*11, 0.0)
@@ -503,45 +1352,10 @@ def OptimizeThicknessRef(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, maxQ, minQ, QmaxIn
     # Loop for the range shifting
     while 1:
         s0thArray = IgorFunctions.makeArrayLoop(s0th, s0thStep)
-        chi2Array = np.zeros(numSample)
+        chi2Array = chi2Function(scaleFactor, density, sth, s0thArray)
         
-        for i in range(numSample):
-
-            # ------------------Kaplow method for scale--------------------
-            
-            T_MCC_sth, T_MCC_corr_factor_bkg = Geometry.MCCCorrection(sth,
-                s0thArray[i], thickness_sampling, phi_matrix)
-    
-            I_Q = I_Q /T_MCC_sth
-            Ibkg_Q  = Ibkg_Q * T_MCC_corr_factor_bkg / (T_MCC_sth)
-            
-            Isample_Q = MainFunctions.calc_IsampleQ(I_Q, scaleFactor, Ibkg_Q)
-            alpha = MainFunctions.calc_alpha(J_Q[Q<=QmaxIntegrate], Sinf, 
-                Q[Q<=QmaxIntegrate], Isample_Q[Q<=QmaxIntegrate], 
-                fe_Q[Q<=QmaxIntegrate], Ztot, density)
-            Icoh_Q = MainFunctions.calc_Icoh(alpha, Isample_Q, Iincoh_Q)
-
-            S_Q = MainFunctions.calc_SQ(Icoh_Q, Ztot, fe_Q, Sinf, Q, minQ, 
-                QmaxIntegrate, maxQ)
-            
-            Ssmooth_Q = UtilityAnalysis.calc_SQsmoothing(Q, S_Q, Sinf, 
-                smoothingFactor, minQ, QmaxIntegrate, maxQ)
-            
-            SsmoothDamp_Q = UtilityAnalysis.calc_SQdamp(Ssmooth_Q, Sinf,
-                dampingFunction)
-            
-            i_Q = MainFunctions.calc_iQ(SsmoothDamp_Q, Sinf)
-            
-            Qi_Q = Q*i_Q
-            r, F_r = MainFunctions.calc_Fr(Q[Q<=QmaxIntegrate], 
-                Qi_Q[Q<=QmaxIntegrate])
-
-            Fopt_r, deltaFopt_r = Optimization.calc_optimize_Fr(iterations, F_r,
-                Fintra_r, density, i_Q[Q<=QmaxIntegrate], Q[Q<=QmaxIntegrate],
-                Sinf, J_Q[Q<=QmaxIntegrate], r, rmin, "n")
-            
-            deltaFopt_r[np.where(r>=rmin)] = 0.0
-            chi2Array[i] = np.mean(deltaFopt_r**2)
+        if callback is not None:
+            callback("s0th", s0thArray, chi2Array, None)
 
         # --------------------Range shifting selection --------------------
         
@@ -578,9 +1392,209 @@ def OptimizeThicknessRef(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, maxQ, minQ, QmaxIn
     
     print("final sample thickness ref", s0th)
     
+    if callback is not None:
+        callback("s0th", s0thArray, chi2Array, (xFit, yFit))
+    
     return s0th
 
 
+def calc_chi2Surface(chi2Function, scaleFactor, density, sthArray, s0thArray):
+    """Function to calculate the chi2 on the whole sth x s0th grid in one call
+    of chi2Function, so the MCC corrections of all the pairs are read from the
+    table together and all the samples go through the same batch.
+
+    Parameters
+    ----------
+    chi2Function : function
+                   function from make_chi2Function with mccFlag="y"
+    scaleFactor  : float
+                   scale factor
+    density      : float
+                   average atomic density
+    sthArray     : numpy array
+                   sample thickness values
+    s0thArray    : numpy array
+                   reference thickness values
+
+    Returns
+    -------
+    chi2Surface  : 2D numpy array
+                   chi2 values, chi2Surface[i, j] is for sthArray[i] and
+                   s0thArray[j]
+    """
+    
+    sthGrid, s0thGrid = np.meshgrid(sthArray, s0thArray, indexing="ij")
+    chi2Array = chi2Function(scaleFactor, density, sthGrid.ravel(), s0thGrid.ravel())
+    
+    return np.reshape(chi2Array, sthGrid.shape)
+
+
+def fit_chi2Surface(sthArray, s0thArray, chi2Surface):
+    """Function to refine the minimum of a chi2 surface with a quadratic fit on
+    the 3x3 neighbourhood of the grid minimum.
+    If the fitted surface has no minimum inside the neighbourhood, i.e. within
+    one grid step of the grid minimum on each side, the grid minimum is
+    returned.
+
+    Parameters
+    ----------
+    sthArray    : numpy array
+                  sample thickness values
+    s0thArray   : numpy array
+                  reference thickness values
+    chi2Surface : 2D numpy array
+                  chi2 values from calc_chi2Surface
+
+    Returns
+    -------
+    sth         : float
+                  sample thickness of the minimum
+    s0th        : float
+                  reference thickness of the minimum
+    chi2        : float
+                  chi2 of the minimum
+    """
+    
+    i, j = np.unravel_index(np.argmin(chi2Surface), chi2Surface.shape)
+    sth = sthArray[i]
+    s0th = s0thArray[j]
+    chi2 = chi2Surface[i, j]
+    
+    iSlice = slice(max(i-1, 0), i+2)
+    jSlice = slice(max(j-1, 0), j+2)
+    x, y = np.meshgrid(sthArray[iSlice]-sth, s0thArray[jSlice]-s0th, indexing="ij")
+    x = x.ravel()
+    y = y.ravel()
+    z = chi2Surface[iSlice, jSlice].ravel()
+    
+    if z.size < 6:
+        return (sth, s0th, chi2)
+    
+    # chi2 = c0 + c1*x + c2*y + c3*x^2 + c4*x*y + c5*y^2
+    A = np.column_stack((np.ones_like(x), x, y, x**2, x*y, y**2))
+    coeffs = np.linalg.lstsq(A, z, rcond=-1)[0]
+    hessian = np.array([[2*coeffs[3], coeffs[4]], [coeffs[4], 2*coeffs[5]]])
+    
+    if np.linalg.det(hessian) <= 0 or hessian[0, 0] <= 0:
+        return (sth, s0th, chi2)
+    
+    dx, dy = np.linalg.solve(hessian, -coeffs[1:3])
+    # the minimum must be within one grid step of the grid minimum
+    if not (x.min() <= dx <= x.max()) or not (y.min() <= dy <= y.max()) or \
+        sth+dx < 0 or s0th+dy < 0:
+        return (sth, s0th, chi2)
+    
+    chi2Fit = coeffs[0] + coeffs[1]*dx + coeffs[2]*dy + coeffs[3]*dx**2 + \
+        coeffs[4]*dx*dy + coeffs[5]*dy**2
+    
+    return (sth+dx, s0th+dy, chi2Fit)
+
+
+def OptimizeThickness2D(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, maxQ, minQ, QmaxIntegrate,
+    Ztot, density, scaleFactor, sth, s0th, Sinf, smoothingFactor, rmin, dampingFunction,
+    Fintra_r, iterations, sthStep, s0thStep, thickness_sampling, phi_matrix,
+    engine="simps", pool=None, callback=None, cache=None, mccCache=None,
+    numSample=11, maxLoop=5, context=None):
+    """Function to optimize the sample and the reference thickness together.
+    The chi2 is calculated on a numSample x numSample grid centred on
+    (sth, s0th); the grid is moved while its minimum is on the border (at most
+    maxLoop times) and then the minimum is refined with fit_chi2Surface.
+    The refined point is kept only if its chi2, calculated again, is lower than
+    the grid minimum.
+    The MCC correction is applied to I_Q and Ibkg_Q for each sample, so they
+    must be passed without it.
+
+    Parameters
+    ----------
+    sth                : float
+                         starting sample thickness
+    s0th               : float
+                         starting reference thickness
+    sthStep            : float
+                         grid step for sth
+    s0thStep           : float
+                         grid step for s0th
+    thickness_sampling : numpy array
+                         sample thickness sampling of the phi matrix
+    phi_matrix         : 2D numpy array
+                         phi matrix
+    engine             : string
+                         engine for the F(r) transform: "simps" or "fft"
+    pool               : multiprocessing.Pool
+                         worker pool from make_chi2Pool, if None the samples
+                         are calculated in this process
+    callback           : function
+                         called as callback(label, variableArray, chi2Array, None)
+                         with the sth and s0th profiles through the grid
+                         minimum after each scan, e.g. print_chi2Scan
+    cache              : Cache.LRUCache
+                         chi2 cache shared between the calls, if None the
+                         chi2 values are not memoized
+    mccCache           : Cache.LRUCache
+                         cache of the MCC corrected intensities shared between
+                         the calls
+    context            : Context.SampleContext
+                         context of the dataset, if given its precomputed
+                         arrays and settings are used (calc_chi2Context)
+    numSample          : int
+                         number of grid points for each thickness
+    maxLoop            : int
+                         maximum number of grid shifts
+    
+    Returns
+    -------
+    sth                : float
+                         optimized sample thickness
+    s0th               : float
+                         optimized reference thickness
+    chi2               : float
+                         chi2 of the optimized thicknesses
+    sthArray           : numpy array
+                         sample thickness values of the last grid
+    s0thArray          : numpy array
+                         reference thickness values of the last grid
+    chi2Surface        : 2D numpy array
+                         chi2 values of the last grid
+    """
+    
+    chi2Function = make_chi2Function(Q, I_Q, Ibkg_Q, J_Q, Iincoh_Q, fe_Q, minQ,
+        QmaxIntegrate, maxQ, Ztot, Sinf, smoothingFactor, rmin, dampingFunction,
+        Fintra_r, iterations, "y", thickness_sampling, phi_matrix, engine, pool,
+        cache, mccCache, context)
+    
+    for numLoop in range(maxLoop+1):
+        sthArray = max(sth-sthStep*(numSample//2), 0.0) + sthStep*np.arange(numSample)
+        s0thArray = max(s0th-s0thStep*(numSample//2), 0.0) + s0thStep*np.arange(numSample)
+        chi2Surface = calc_chi2Surface(chi2Function, scaleFactor, density,
+            sthArray, s0thArray)
+        
+        i, j = np.unravel_index(np.argmin(chi2Surface), chi2Surface.shape)
+        sth = sthArray[i]
+        s0th = s0thArray[j]
+        
+        if callback is not None:
+            callback("sth", sthArray, chi2Surface[:, j], None)
+            callback("s0th", s0thArray, chi2Surface[i, :], None)
+        
+        onBorder = (i == numSample-1 or (i == 0 and sthArray[0] > 0.0) or
+            j == numSample-1 or (j == 0 and s0thArray[0] > 0.0))
+        if not onBorder:
+            break
+    else:
+        print("thickness minimum on the border of the grid")
+    
+    chi2 = chi2Surface[i, j]
+    sthFit, s0thFit, chi2Fit = fit_chi2Surface(sthArray, s0thArray, chi2Surface)
+    if sthFit != sth or s0thFit != s0th:
+        chi2Fit = chi2Function(scaleFactor, density, sthFit, s0thFit)[0]
+        if chi2Fit < chi2:
+            sth, s0th, chi2 = sthFit, s0thFit, chi2Fit
+    
+    print("final sample thickness", sth, "final sample thickness ref", s0th)
+    
+    return (sth, s0th, chi2, sthArray, s0thArray, chi2Surface)
+
+
 def chi2_minimization(scaleFactor, Q, I_Q, Ibkg_Q, J_Q, fe_Q, Iincoh_Q, Sinf, Ztot,
     density, Fintra_r, r, minQ, QmaxIntegrate, maxQ, smoothFactor, dampFactor, iteration, rmin):
     """Function to calculate the whole loop for the chi2 minimization.
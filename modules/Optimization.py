@@ -38,15 +38,172 @@ otherwise it is symbolized with just its name.
 
 import matplotlib.pyplot as plt
 import numpy as np
+import os
 import time
+from scipy import special
 
+from modules import Cache
 from modules import MainFunctions
 from modules import Utility
 from modules import UtilityAnalysis
 
 
-def calc_iintra(Q, fe_Q, Ztot, QmaxIntegrate, maxQ, elementList, element, x, y, z, elementParameters):
+def calc_atomPairs(x, y, z, atomWeight, digits=10):
+    """Function to calculate the distances of all the atom pairs of a molecule
+    at once, grouping the pairs with the same distance (e.g. the two C-O pairs
+    of CO2).
+    The ordered pairs (i, j) and (j, i) are both counted, as in the double
+    loop over the atoms, and the pairs with zero distance are discarded.
+
+    Parameters
+    ----------
+    x, y, z     : float array
+                  atomic coordinate in the xyz_file (nm)
+    atomWeight  : numpy array
+                  weight of each atom (e.g. its Kp)
+    digits      : int
+                  number of decimal digits (nm) to consider two distances
+                  equal
+
+    Returns
+    -------
+    distances   : numpy array
+                  distinct distances between the atoms (nm)
+    pairWeights : numpy array
+                  sum of atomWeight[i]*atomWeight[j] of the ordered pairs with
+                  each distance
+    """
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    z = np.asarray(z, dtype=float)
+    atomWeight = np.asarray(atomWeight, dtype=float)
+
+    i, j = np.triu_indices(x.size, 1)
+    d = Utility.calc_distMol(x[i], y[i], z[i], x[j], y[j], z[j])
+    mask = d != 0.0
+    d = d[mask]
+    w = 2 * atomWeight[i[mask]] * atomWeight[j[mask]]
+
+    _, groupIdx, groupSize = np.unique(np.round(d, digits), return_inverse=True,
+        return_counts=True)
+    distances = np.bincount(groupIdx, weights=d) / groupSize
+    pairWeights = np.bincount(groupIdx, weights=w)
+
+    return (distances, pairWeights)
+
+
+def calc_atomPairsHistogram(element, x, y, z, elementWeight, binWidth,
+    chunkSize=32*1024**2):
+    """Function to calculate the histogram of the atom pair distances of a
+    large molecule or cluster, for each element pair type.
+    Each bin is represented by the mean distance of its pairs, so in the
+    Debye sum (calc_iintraSum) the first order error cancels and, as
+    |d^2/dd^2 sin(dQ)/(dQ)| <= Q^2/3, the error of the histogram sum is
+    bounded by:
+        |error(Q)| <= (Q*binWidth)^2/6 * sum(|pairWeights|)
+    i.e. a relative error (Q*binWidth)^2/6 of the Q=0 value (e.g. 1.7e-5 for
+    Q=100 nm^-1 and binWidth=1e-4 nm).
+    The distances are calculated in blocks of atoms of about chunkSize bytes,
+    so memory does not grow as N^2.
+
+    Parameters
+    ----------
+    element       : string array
+                    array with the elements in the xyz_file
+    x, y, z       : float array
+                    atomic coordinate in the xyz_file (nm)
+    elementWeight : dictionary("element": weight)
+                    weight of the atoms of each element (e.g. Kp)
+    binWidth      : float
+                    width of the distance bins (nm)
+    chunkSize     : int
+                    size of the blocks of distances (bytes)
+
+    Returns
+    -------
+    distances     : numpy array
+                    mean distance of each non-empty bin (nm)
+    pairWeights   : numpy array
+                    sum of the weight products of the ordered pairs in each
+                    bin
+    """
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    z = np.asarray(z, dtype=float)
+    numAtoms = x.size
+
+    types = sorted(set(element))
+    numTypes = len(types)
+    atomType = np.array([types.index(elem) for elem in element])
+
+    maxDist = np.sqrt(np.ptp(x)**2 + np.ptp(y)**2 + np.ptp(z)**2)
+    numBins = int(maxDist/binWidth) + 1
+    counts = np.zeros(numTypes*numTypes*numBins)
+    sumDist = np.zeros(numTypes*numTypes*numBins)
+
+    numRows = max(chunkSize // (8*max(numAtoms, 1)), 1)
+    for start in range(0, numAtoms, numRows):
+        i = np.arange(start, min(start+numRows, numAtoms))[:, np.newaxis]
+        j = np.arange(numAtoms)[np.newaxis, :]
+        mask = j > i
+        d = Utility.calc_distMol(x[i], y[i], z[i], x[j], y[j], z[j])
+        mask &= d != 0.0
+        typeI = np.broadcast_to(atomType[i], mask.shape)[mask]
+        typeJ = np.broadcast_to(atomType[j], mask.shape)[mask]
+        d = d[mask]
+        pairType = np.minimum(typeI, typeJ)*numTypes + np.maximum(typeI, typeJ)
+        binIdx = pairType*numBins + (d/binWidth).astype(int)
+        counts += np.bincount(binIdx, minlength=counts.size)
+        sumDist += np.bincount(binIdx, weights=d, minlength=counts.size)
+
+    filled = np.nonzero(counts)[0]
+    distances = sumDist[filled] / counts[filled]
+    pairType = filled // numBins
+    weightI = np.array([elementWeight[types[t]] for t in pairType // numTypes])
+    weightJ = np.array([elementWeight[types[t]] for t in pairType % numTypes])
+    pairWeights = 2 * counts[filled] * weightI * weightJ
+
+    return (distances, pairWeights)
+
+
+def calc_iintraSum(Q, distances, pairWeights, chunkSize=32*1024**2):
+    """Function to calculate the Debye sum of the atom pairs:
+    sum(pairWeights * sin(d*Q)/(d*Q)), with the limit pairWeights for Q=0.
+    The pairs are summed in blocks of about chunkSize bytes.
+
+    Parameters
+    ----------
+    Q           : numpy array
+                  momentum transfer (nm^-1)
+    distances   : numpy array
+                  distances between the atoms (nm)
+    pairWeights : numpy array
+                  weight of each distance
+
+    Returns
+    -------
+    iintra_Q    : numpy array
+                  Debye sum
+    """
+
+    iintra_Q = np.zeros(Q.size)
+    numRows = max(chunkSize // (8*Q.size), 1)
+    for start in range(0, distances.size, numRows):
+        iintra_Q += np.dot(pairWeights[start:start+numRows],
+            np.sinc(np.outer(distances[start:start+numRows], Q/np.pi)))
+
+    return iintra_Q
+
+
+def calc_iintra(Q, fe_Q, Ztot, QmaxIntegrate, maxQ, elementList, element, x, y, z, elementParameters,
+    binWidth=None):
     """Function to calculate the intramolecular contribution of i(Q) (eq. 41).
+    Kp is calculated once for each element and the pairs with the same
+    distance are summed together (calc_atomPairs, calc_iintraSum); with
+    binWidth the pair distances are binned (calc_atomPairsHistogram, see its
+    error bound), for large clusters.
 
     Parameters
     ----------
@@ -77,6 +234,9 @@ def calc_iintra(Q, fe_Q, Ztot, QmaxIntegrate, maxQ, elementList, element, x, y,
                         parameters : list
                                      list of the parameters
                                      (Z, a1, b1, a2, b2, a3, b3, a4, b4, c, M, K, L)
+    binWidth          : float
+                        width of the distance bins (nm), if None the exact
+                        sum is calculated
 
     Returns
     -------
@@ -84,19 +244,15 @@ def calc_iintra(Q, fe_Q, Ztot, QmaxIntegrate, maxQ, elementList, element, x, y,
                         intramolecular contribution of i(Q)
     """
 
-    iintra_Q = np.zeros(Q.size)
-    sinpq = np.zeros(Q.size)
-
-    for ielem in range(len(element)):
-        for jelem in range(len(element)):
-            if ielem != jelem:
-                Kpi = MainFunctions.calc_Kp(fe_Q, element[ielem], Q, elementParameters)
-                Kpj = MainFunctions.calc_Kp(fe_Q, element[jelem], Q, elementParameters)
-                KK = Kpi * Kpj
-                d = Utility.calc_distMol(x[ielem], y[ielem], z[ielem], x[jelem], y[jelem], z[jelem])
-                if d != 0.0:
-                    iintra_Q += KK * np.sin(d*Q) / (d*Q)
-                    iintra_Q[Q==0.0] = KK
+    Kp = dict((elem, MainFunctions.calc_Kp(fe_Q, elem, Q, elementParameters))
+        for elem in set(element))
+    if binWidth is None:
+        atomKp = np.array([Kp[elem] for elem in element])
+        distances, pairWeights = calc_atomPairs(x, y, z, atomKp)
+    else:
+        distances, pairWeights = calc_atomPairsHistogram(element, x, y, z, Kp,
+            binWidth)
+    iintra_Q = calc_iintraSum(Q, distances, pairWeights)
 
     iintra_Q[(Q>QmaxIntegrate) & (Q<=maxQ)] = 0.0
     iintra_Q /= Ztot**2
@@ -105,6 +261,228 @@ def calc_iintra(Q, fe_Q, Ztot, QmaxIntegrate, maxQ, elementList, element, x, y,
     return iintra_Q
 
 
+def calc_cosGaussIntegral(k, a, Q0, Q1):
+    """Function to calculate the integral of cos(k*Q)*exp(-a*Q^2) between Q0
+    and Q1 in closed form.
+    For a > 0 it is written with the Faddeeva function w (scipy.special.wofz),
+    which stays bounded in the upper half plane:
+        int = sqrt(pi)/(2*sqrt(a)) * Re[P(Q0) - P(Q1)]
+        P(Q) = exp(-a*Q^2 + i*k*Q) * w(k/(2*sqrt(a)) + i*sqrt(a)*Q)
+    for a = 0 it is (sin(k*Q1) - sin(k*Q0))/k.
+
+    Parameters
+    ----------
+    k      : numpy array
+             frequencies (nm)
+    a      : float
+             Gaussian exponent (nm^2)
+    Q0, Q1 : float
+             integration limits (nm^-1)
+
+    Returns
+    -------
+    integral : numpy array
+               integral for each k
+    """
+
+    k = np.asarray(k, dtype=float)
+
+    if a == 0.0:
+        integral = np.full(k.shape, float(Q1 - Q0))
+        nonZero = k != 0.0
+        integral[nonZero] = (np.sin(k[nonZero]*Q1) - np.sin(k[nonZero]*Q0)) / k[nonZero]
+        return integral
+
+    sqrtA = np.sqrt(a)
+    P0 = np.exp(-a*Q0**2 + 1j*k*Q0) * special.wofz(k/(2*sqrtA) + 1j*sqrtA*Q0)
+    P1 = np.exp(-a*Q1**2 + 1j*k*Q1) * special.wofz(k/(2*sqrtA) + 1j*sqrtA*Q1)
+
+    return np.sqrt(np.pi)/(2*sqrtA) * np.real(P0 - P1)
+
+
+def calc_Fintra(r, Q, fe_Q, Ztot, QmaxIntegrate, element, x, y, z, elementParameters,
+    dampingFactor, typeFunction="Exponential", minQ=None, binWidth=None,
+    chunkSize=32*1024**2):
+    """Function to calculate the intramolecular F(r) of a rigid molecule in
+    closed form, on any r grid.
+    It is the transform (eq. 20) of Q*iintra(Q)*dampingFunction(Q) between
+    minQ and QmaxIntegrate, with iintra(Q) of calc_iintra: for each distance
+    d of the molecule
+        Q*sin(d*Q)/(d*Q)*sin(r*Q) = (cos((r-d)*Q) - cos((r+d)*Q))/(2*d)
+    and the integrals with the exponential damping are calculated by
+    calc_cosGaussIntegral, so no Q grid and no numerical transform are used.
+    The closed form exists only for the "Exponential" damping, for the other
+    functions F(r) is calculated with the Simpson's rule on the Q grid.
+
+    Parameters
+    ----------
+    r                 : numpy array
+                        atomic distance (nm)
+    Q                 : numpy array
+                        momentum transfer (nm^-1), used for Kp
+    fe_Q              : numpy array
+                        effective electric form factor
+    Ztot              : int
+                        total Z number
+    QmaxIntegrate     : float
+                        maximum Q value for the integrations
+    element           : string array
+                        array with the elements in the xyz_file
+    x, y, z           : float array
+                        atomic coordinate in the xyz_file (nm)
+    elementParameters : dictionary("element": parameters)
+                        chemical elements of the sample with their parameters
+    dampingFactor     : float
+                        damping factor (UtilityAnalysis.calc_dampingFunction)
+    typeFunction      : string
+                        type of function to use for the damping
+    minQ              : float
+                        lower integration limit, if None Q[0]
+    binWidth          : float
+                        width of the distance bins (nm), if None the exact
+                        distances are used (see calc_iintra)
+    chunkSize         : int
+                        size of the blocks of distances (bytes)
+
+    Returns
+    -------
+    Fintra_r          : numpy array
+                        intramolecular contribution of F(r)
+    """
+
+    Kp = dict((elem, MainFunctions.calc_Kp(fe_Q, elem, Q, elementParameters))
+        for elem in set(element))
+    if binWidth is None:
+        atomKp = np.array([Kp[elem] for elem in element])
+        distances, pairWeights = calc_atomPairs(x, y, z, atomKp)
+    else:
+        distances, pairWeights = calc_atomPairsHistogram(element, x, y, z, Kp,
+            binWidth)
+
+    if minQ is None:
+        minQ = Q[0]
+
+    if typeFunction != "Exponential":
+        print("no closed form for the", typeFunction, "damping, Fintra(r) is integrated on Q")
+        mask = (Q>=minQ) & (Q<=QmaxIntegrate)
+        dampingFunction = UtilityAnalysis.calc_dampingFunction(Q[mask],
+            dampingFactor, QmaxIntegrate, typeFunction)
+        Qiintra_Q = Q[mask] * calc_iintraSum(Q[mask], distances, pairWeights) * \
+            dampingFunction / Ztot**2
+        return (2.0 / np.pi) * np.dot(np.sin(np.outer(r, Q[mask])), Qiintra_Q *
+            MainFunctions.get_simpsWeights(Q[mask]))
+
+    exponentFactor = dampingFactor / QmaxIntegrate**2
+
+    Fintra_r = np.zeros(r.size)
+    numRows = max(chunkSize // (16*max(r.size, 1)), 1)
+    for start in range(0, distances.size, numRows):
+        d = distances[start:start+numRows, np.newaxis]
+        w = pairWeights[start:start+numRows, np.newaxis]
+        Fintra_r += np.sum(w / (2*d) * (calc_cosGaussIntegral(r-d, exponentFactor,
+            minQ, QmaxIntegrate) - calc_cosGaussIntegral(r+d, exponentFactor,
+            minQ, QmaxIntegrate)), axis=0)
+
+    return (2.0 / np.pi) * Fintra_r / Ztot**2
+
+
+def check_intraComponent(Q, fe_Q, Ztot, QmaxIntegrate, maxQ, elementList, element,
+    x, y, z, elementParameters, dampingFactor, typeFunction, binWidth=None,
+    FrEngine="simps", FintraEngine="numerical", cacheDir=None,
+    cacheSize=256*1024**2):
+    """Function to calculate or read from the cache the intra-molecular
+    components.
+    If cacheDir is given the result is read from the cache directory when it
+    was already calculated for the same molecule (elements and coordinates of
+    the xyz file), element parameters, Q grid, QmaxIntegrate, maxQ, damping
+    and engines; otherwise it is calculated and added to the cache, removing
+    the least recently used entries over cacheSize.
+
+    Parameters
+    ----------
+    Q                 : numpy array
+                        momentum transfer (nm^-1)
+    fe_Q              : numpy array
+                        effective electric form factor
+    Ztot              : int
+                        total Z number
+    QmaxIntegrate     : float
+                        maximum Q value for the intagrations
+    maxQ              : float
+                        maximum Q value
+    elementList       : dictionary("element": multiplicity)
+                        chemical elements of the sample with their multiplicity
+    element           : string array
+                        array with the elements in the xyz_file
+    x, y, z           : float array
+                        atomic coordinate in the xyz_file (nm)
+    elementParameters : dictionary("element": parameters)
+                        chemical elements of the sample with their parameters
+    dampingFactor     : float
+                        damping factor
+    typeFunction      : string
+                        type of function to use for the damping
+    binWidth          : float
+                        width of the distance bins (nm), see calc_iintra
+    FrEngine          : string
+                        engine of the numerical transform (MainFunctions.calc_Fr)
+    FintraEngine      : string
+                        "analytic" (calc_Fintra) or "numerical"
+    cacheDir          : string
+                        intra-molecular cache directory
+    cacheSize         : int
+                        maximum size of the cache directory (bytes)
+
+    Returns
+    -------
+    iintra_Q          : numpy array
+                        intramolecular contribution of i(Q)
+    iintradamp_Q      : numpy array
+                        damped intramolecular contribution of i(Q)
+    rintra            : numpy array
+                        atomic distance (nm)
+    Fintra_r          : numpy array
+                        intramolecular contribution of F(r)
+    """
+
+    if cacheDir is not None:
+        name = "intra_" + Cache.hash_values(Q, fe_Q, Ztot, QmaxIntegrate, maxQ,
+            sorted(elementList.items()), np.asarray(element, dtype=str),
+            np.asarray(x, dtype=float), np.asarray(y, dtype=float),
+            np.asarray(z, dtype=float),
+            [(elem, list(elementParameters[elem])) for elem in sorted(set(element))],
+            dampingFactor, typeFunction, binWidth, FrEngine.lower(),
+            FintraEngine.lower())
+        path = os.path.join(cacheDir, name + ".npy")
+        FintraPath = os.path.join(cacheDir, name + ".Fintra.npy")
+
+        iintra = Cache.load_array(path, mmap=False)
+        Fintra = Cache.load_array(FintraPath, mmap=False)
+        if iintra is not None and Fintra is not None:
+            return (iintra[0], iintra[1], Fintra[0], Fintra[1])
+
+    iintra_Q = calc_iintra(Q, fe_Q, Ztot, QmaxIntegrate, maxQ, elementList, element,
+        x, y, z, elementParameters, binWidth)
+    dampingFunction = UtilityAnalysis.calc_dampingFunction(Q, dampingFactor,
+        QmaxIntegrate, typeFunction)
+    iintradamp_Q = UtilityAnalysis.calc_iintradamp(iintra_Q, dampingFunction)
+    if FintraEngine.lower() == "analytic":
+        rintra = MainFunctions.calc_r(Q[Q<=QmaxIntegrate])
+        Fintra_r = calc_Fintra(rintra, Q, fe_Q, Ztot, QmaxIntegrate, element, x, y, z,
+            elementParameters, dampingFactor, typeFunction, binWidth=binWidth)
+    else:
+        rintra, Fintra_r = MainFunctions.calc_Fr(Q[Q<=QmaxIntegrate],
+            (Q*iintradamp_Q)[Q<=QmaxIntegrate], FrEngine)
+
+    if cacheDir is not None:
+        os.makedirs(cacheDir, exist_ok=True)
+        Cache.save_array(FintraPath, np.array([rintra, Fintra_r]))
+        Cache.save_array(path, np.array([iintra_Q, iintradamp_Q]))
+        Cache.evict_files(cacheDir, cacheSize, (name,))
+
+    return (iintra_Q, iintradamp_Q, rintra, Fintra_r)
+
+
 def calc_intraComponent(Q, fe_Q, Ztot, QmaxIntegrate, maxQ, elementList, element, \
     x, y, z, elementParameters, dampingFunction):
     """Function to calculate the intra-molecular components.
@@ -194,6 +572,7 @@ def calc_deltaFr(F_r, Fintra_r, r, density):
 
 def calc_iQi(i_Q, Q, Sinf, J_Q, deltaF_r, r, rmin):
     """Function to calculate the i-th iteration of i(Q) (eq. 46, 49).
+    i_Q and deltaF_r can be 2D arrays with a row for each sample.
 
     Parameters
     ----------
@@ -218,15 +597,15 @@ def calc_iQi(i_Q, Q, Sinf, J_Q, deltaF_r, r, rmin):
                i-th iteration of i(Q)
     """
 
-    mask = np.where(r < rmin)
+    mask = r < rmin
     rInt = r[mask]
-    deltaF_rInt = deltaF_r[mask]
+    deltaF_rInt = deltaF_r[..., mask]
 
     Deltar = np.diff(rInt)
     meanDeltar = np.mean(Deltar)
     Qr = np.outer(Q, rInt)
     sinQr = np.sin(Qr)
-    integral = np.sum(deltaF_rInt * sinQr, axis=1) * meanDeltar
+    integral = np.dot(deltaF_rInt, sinQr.T) * meanDeltar
 
     i_Qi = i_Q - ( 1/Q * ( i_Q / (Sinf + J_Q) + 1)) * integral
 
@@ -234,8 +613,12 @@ def calc_iQi(i_Q, Q, Sinf, J_Q, deltaF_r, r, rmin):
 
 
 def calc_optimize_Fr(iterations, F_r, Fintra_r, density, i_Q, Q, Sinf, J_Q, r,
-    rmin, plot_iter):
+    rmin, plot_iter, engine="simps", context=None):
     """Function to calculate the F(r) optimization (eq 47, 48, 49).
+    F_r and i_Q can be 2D arrays with a row for each sample, in this case
+    density is a column array (samples x 1).
+    With a context (Context.SampleContext) the transforms use its precomputed
+    sin matrices, Q, J_Q and r must be its Q_int, J_Qint and r.
 
     Parameters
     ----------
@@ -259,6 +642,10 @@ def calc_optimize_Fr(iterations, F_r, Fintra_r, density, i_Q, Q, Sinf, J_Q, r,
                  r cut-off value (nm)
     plot_iter  : string
                  flag to plot the F(r) iterations
+    engine     : string
+                 engine for the F(r) transform: "simps" or "fft"
+    context    : Context.SampleContext
+                 context of the dataset
 
     Returns
     -------
@@ -279,10 +666,13 @@ def calc_optimize_Fr(iterations, F_r, Fintra_r, density, i_Q, Q, Sinf, J_Q, r,
 
     for i in range(iterations):
         deltaF_r = calc_deltaFr(F_r, Fintra_r, r, density)
-        i_Q[0] = 0.0
-        i_Q[1:] = calc_iQi(i_Q[1:], Q[1:], Sinf, J_Q[1:], deltaF_r, r, rmin)
-        
-        r, F_r = MainFunctions.calc_Fr(Q, Q*i_Q)
+        i_Q[..., 0] = 0.0
+        if context is None:
+            i_Q[..., 1:] = calc_iQi(i_Q[..., 1:], Q[1:], Sinf, J_Q[1:], deltaF_r, r, rmin)
+            r, F_r = MainFunctions.calc_Fr(Q, Q*i_Q, engine)
+        else:
+            i_Q[..., 1:] = context.calc_iQi(i_Q[..., 1:], deltaF_r)
+            F_r = context.calc_Fr(Q*i_Q)
         # if plot_iter.lower() == "y":
             # j = i+1
             # plt.figure("F_rIt")
@@ -428,9 +428,10 @@ def read_inputFile(path):
                     "dacThickness", "phiMatrixThickness", "minQ",
                     "QmaxIntegrate", "maxQ", "NumPoints", "smoothingFactor",
                     "dampingFactor", "rmin", "scaleFactor",
-                    "density", "sth", "s0th"):
+                    "density", "sth", "s0th", "phiMatrixDenseThickness",
+                    "wavelength", "iintraBinWidth", "sthStep", "s0thStep"):
                     val = float(line.split()[2])
-                elif key in ("iterations"):
+                elif key in ("iterations", "numWorkers", "chi2CacheSize"):
                     val = int(line.split()[2])
                 else:
                     val = line.split()[2]
@@ -482,6 +483,33 @@ def read_MCC_file(path, type):
     return (ws1, ws2, r1, r2, d)
 
 
+def read_MCC_models(path):
+    """Function to read all the Soller Slits models of the MCC file.
+
+    Parameters
+    ----------
+    path   : string
+             path of the file
+
+    Returns
+    -------
+    models : dictionary
+             (ws1, ws2, r1, r2, d) for each model name, in cm
+    """
+
+    models = {}
+
+    with open(path, "r") as file:
+        # skip the header
+        file.readline()
+        for line in file:
+            columns = line.split()
+            if len(columns) >= 6:
+                models[columns[0]] = tuple(float(value) for value in columns[1:6])
+
+    return models
+
+
 def read_parameters(elementList, path):
     """Function to read the file containing the atomic form factor and incoherent parameters.
 
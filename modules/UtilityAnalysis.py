@@ -257,23 +257,24 @@ def remove_peaks(Q, I_Q):
     return I_Q
 
 
-def Qto2theta(Q):
+def Qto2theta(Q, wavelength=0.03738):
     """Function to convert Q into 2theta.
     
     Parameters
     ----------
-    Q         : numpy array
-                momentum transfer (nm^-1)
+    Q          : numpy array
+                 momentum transfer (nm^-1)
+    wavelength : float
+                 XRay beam wavelength (nm), @ESRF ID27 0.03738nm
 
 
     Returns
     -------
-    two_theta : numpy array
-                2theta angle (rad)
+    two_theta  : numpy array
+                 2theta angle (rad)
     """
 
-    wavelenght = 0.03738
-    theta = np.arcsin((wavelenght*Q) / (4*np.pi))
+    theta = np.arcsin((wavelength*Q) / (4*np.pi))
     two_theta = 2*theta
 
     # return np.degrees(theta2)
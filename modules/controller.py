@@ -19,6 +19,7 @@ from PyQt5.QtWidgets import QApplication, QMainWindow
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 
+from modules import Context
 from modules import Formalism
 from modules import Geometry
 from modules import IgorFunctions
@@ -70,6 +71,7 @@ class LASDiA(QtWidgets.QMainWindow, LASDiAGUI.Ui_LASDiAGUI):
         self.Iincoh_Q = None
         self.J_Q = None
         self.dampingFunct = None
+        self.context = None
         self.molecule = "Ar"
         
         self.XYZFilePath = None
@@ -389,6 +391,12 @@ class LASDiA(QtWidgets.QMainWindow, LASDiAGUI.Ui_LASDiAGUI):
         scaleFactor = self.ui.scaleFactorValue.value()
         density0 = self.ui.densityValue.value()
 
+        self.context = Context.SampleContext(self.Q, self.elementList,
+            self.elementParameters, self.ui.minQ.value(), self.ui.QmaxIntegrate.value(),
+            self.ui.maxQ.value(), self.ui.smoothingFactor.value(), self.ui.rmin.value(),
+            self.ui.dampingFactor.value(), self.ui.dampingFunction.currentText(),
+            self.ui.iterations.value())
+
         # ----------------------First scale minimization---------------------------
 
         scaleStep = 0.05
@@ -402,28 +410,27 @@ class LASDiA(QtWidgets.QMainWindow, LASDiAGUI.Ui_LASDiAGUI):
 
         scaleFactor = Minimization.OptimizeScale(self.Q, self.I_Q, self.Ibkg_Q, 
             self.J_Q, self.Iincoh_Q,
-            self.fe_Q, self.ui.maxQ.value(), self.ui.minQ.value(), 
-            self.ui.QmaxIntegrate.value(),
+            self.fe_Q, self.ui.minQ.value(), self.ui.QmaxIntegrate.value(),
+            self.ui.maxQ.value(),
             self.Ztot,
             density0, scaleFactor, self.Sinf, self.ui.smoothingFactor.value(),
             self.ui.rmin.value(),
             self.dampingFunct, Fintra_r, self.ui.iterations.value(), scaleStep,
-            sth, s0th, thickness_sampling, phi_matrix, "n")
+            sth, s0th, "n", thickness_sampling, phi_matrix, context=self.context)
 
         # ----------------------First density minimization-------------------------
 
         densityStep = density0/50
-        densityStepEnd = density0/250
 
         density = Minimization.OptimizeDensity(self.Q, self.I_Q, self.Ibkg_Q, 
             self.J_Q, self.Iincoh_Q,
-            self.fe_Q, self.ui.maxQ.value(), self.ui.minQ.value(), 
-            self.ui.QmaxIntegrate.value(),
+            self.fe_Q, self.ui.minQ.value(), self.ui.QmaxIntegrate.value(),
+            self.ui.maxQ.value(),
             self.Ztot, 
             density0, scaleFactor, self.Sinf, self.ui.smoothingFactor.value(),
             self.ui.rmin.value(),
             self.dampingFunct, Fintra_r, self.ui.iterations.value(), densityStep,
-            densityStepEnd, sth, s0th, thickness_sampling, phi_matrix, "n")
+            sth, s0th, "n", thickness_sampling, phi_matrix, context=self.context)
 
         # print("density0, density", density0, density)
         numLoopIteration = 0
@@ -450,25 +457,25 @@ class LASDiA(QtWidgets.QMainWindow, LASDiAGUI.Ui_LASDiAGUI):
             
             scaleFactor = Minimization.OptimizeScale(self.Q, self.I_Q, self.Ibkg_Q, 
                 self.J_Q, self.Iincoh_Q,
-                self.fe_Q, self.ui.maxQ.value(), self.ui.minQ.value(), 
-                self.ui.QmaxIntegrate.value(),
+                self.fe_Q, self.ui.minQ.value(), self.ui.QmaxIntegrate.value(),
+                self.ui.maxQ.value(),
                 self.Ztot,
                 density, scaleFactor, self.Sinf, self.ui.smoothingFactor.value(),
                 self.ui.rmin.value(),
                 self.dampingFunct, Fintra_r, self.ui.iterations.value(), scaleStep,
-                sth, s0th, thickness_sampling, phi_matrix, "n")
+                sth, s0th, "n", thickness_sampling, phi_matrix, context=self.context)
 
             density0=density
 
             density = Minimization.OptimizeDensity(self.Q, self.I_Q, self.Ibkg_Q, 
                 self.J_Q, self.Iincoh_Q,
-                self.fe_Q, self.ui.maxQ.value(), self.ui.minQ.value(), 
-                self.ui.QmaxIntegrate.value(),
+                self.fe_Q, self.ui.minQ.value(), self.ui.QmaxIntegrate.value(),
+                self.ui.maxQ.value(),
                 self.Ztot, 
                 density0, scaleFactor, self.Sinf, self.ui.smoothingFactor.value(),
                 self.ui.rmin.value(),
                 self.dampingFunct, Fintra_r, self.ui.iterations.value(), densityStep,
-                density/250, sth, s0th, thickness_sampling, phi_matrix, "n")
+                sth, s0th, "n", thickness_sampling, phi_matrix, context=self.context)
 
             numLoopIteration += 1
             # print("numLoopIteration", numLoopIteration, scaleFactor, density)